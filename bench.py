@@ -0,0 +1,606 @@
+# -*- coding: utf-8 -*-
+"""
+🏎️ Notion Brain 离线压测
+所有外部服务 (Supabase / Pinecone / 豆包向量 / 大模型 / Telegram / 地图天气) 都换成进程内假服务，
+可配置延迟和错误注入，直接驱动真实的工具函数和 HostFixMiddleware 路由，输出吞吐与 p50/p95/p99。
+
+用法:
+    python bench.py                                   # 跑全部场景，JSON 结果打到 stdout
+    python bench.py -s get_latest_diary,route_gps -n 500 -c 16
+    python bench.py --latency supabase=0.03,llm=0.5 --errors supabase=0.02
+    python bench.py --out after.json --compare before.json
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import argparse
+import datetime
+import itertools
+import tempfile
+import threading
+import contextlib
+import subprocess
+
+# 默认延迟 (秒)，大致对齐线上观测到的中位数
+DEFAULT_LATENCY = {
+    "supabase": 0.04, "pinecone": 0.06, "embeddings": 0.12, "llm": 0.8,
+    "telegram": 0.15, "nominatim": 0.3, "open_meteo": 0.15, "amap": 0.1, "http": 0.1,
+}
+
+# ==========================================
+# 1. 🎭 假服务：延迟 + 错误注入
+# ==========================================
+class FaultModel:
+    """按依赖名注入延迟 (±20% 抖动，外加小概率长尾) 和错误"""
+    def __init__(self, latency: dict, errors: dict, tail_prob: float, tail_mult: float, seed: int):
+        self.latency = latency
+        self.errors = errors
+        self.tail_prob = tail_prob
+        self.tail_mult = tail_mult
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def hit(self, dep: str):
+        """模拟一次调用：睡一会儿，按概率抛错"""
+        with self.lock:
+            self.calls[dep] = self.calls.get(dep, 0) + 1
+            delay = self.latency.get(dep, self.latency.get("http", 0.1)) * self.rng.uniform(0.8, 1.2)
+            if self.rng.random() < self.tail_prob: delay *= self.tail_mult
+            fail = self.rng.random() < self.errors.get(dep, 0.0)
+        if delay > 0: time.sleep(delay)
+        if fail: raise ConnectionError(f"[bench] injected {dep} failure")
+
+
+class _Result:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class FakeQuery:
+    """够用的 PostgREST 查询构造器：select/insert/upsert/update/delete + 常用过滤、排序、分页、count"""
+    def __init__(self, db, table: str):
+        self.db, self.table = db, table
+        self.op, self.payload, self.count = "select", None, None
+        self.filters, self.orders = [], []
+        self.lim, self.off, self.on_conflict = None, 0, "id"
+
+    def select(self, cols="*", count=None):
+        self.op, self.count = "select", count
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict="id", **kw):
+        self.op, self.payload, self.on_conflict = "upsert", payload, on_conflict
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def _f(self, fn):
+        self.filters.append(fn)
+        return self
+
+    def eq(self, c, v): return self._f(lambda r: r.get(c) == v if isinstance(v, bool) else str(r.get(c)) == str(v))
+    def neq(self, c, v): return self._f(lambda r: str(r.get(c)) != str(v))
+    def gt(self, c, v): return self._f(lambda r: r.get(c) is not None and str(r.get(c)) > str(v))
+    def gte(self, c, v): return self._f(lambda r: r.get(c) is not None and str(r.get(c)) >= str(v))
+    def lt(self, c, v): return self._f(lambda r: r.get(c) is not None and str(r.get(c)) < str(v))
+    def lte(self, c, v): return self._f(lambda r: r.get(c) is not None and str(r.get(c)) <= str(v))
+    def is_(self, c, v): return self._f(lambda r: r.get(c) is None)
+    def like(self, c, pat): return self._f(lambda r: pat.strip("%") in str(r.get(c, "")))
+    def ilike(self, c, pat): return self._f(lambda r: pat.strip("%").lower() in str(r.get(c, "")).lower())
+
+    def in_(self, c, values):
+        values = set(map(str, values))
+        return self._f(lambda r: str(r.get(c)) in values)
+
+    def or_(self, expr: str):
+        # 只支持同步游标用到的 created_at.gt."X",and(created_at.eq."X",id.gt.Y)
+        import re
+        m = re.match(r'(\w+)\.gt\."?([^",]+)"?,and\((\w+)\.eq\."?([^",]+)"?,(\w+)\.gt\.([^)]+)\)', expr)
+        if not m: return self
+        c1, v1, _, v2, c3, v3 = m.groups()
+        return self._f(lambda r: str(r.get(c1)) > v1 or (str(r.get(c1)) == v2 and int(r.get(c3) or 0) > int(v3)))
+
+    def order(self, c, desc=False):
+        self.orders.append((c, desc))
+        return self
+
+    def limit(self, n):
+        self.lim = n
+        return self
+
+    def range(self, a, b):
+        self.off, self.lim = a, b - a + 1
+        return self
+
+    def execute(self):
+        self.db.faults.hit("supabase")
+        with self.db.lock:
+            rows = self.db.tables.setdefault(self.table, [])
+            if self.op in ("insert", "upsert"):
+                out = []
+                for r in (self.payload if isinstance(self.payload, list) else [self.payload]):
+                    r = dict(r)
+                    if self.op == "upsert":
+                        keys = [k.strip() for k in self.on_conflict.split(",")]
+                        hit = next((x for x in rows if all(x.get(k) == r.get(k) for k in keys)), None)
+                        if hit:
+                            hit.update(r)
+                            out.append(dict(hit))
+                            continue
+                    r.setdefault("id", next(self.db.ids))
+                    r.setdefault("created_at", self.db.now())
+                    rows.append(r)
+                    out.append(dict(r))
+                return _Result(out)
+            sel = [r for r in rows if all(f(r) for f in self.filters)]
+            if self.op == "update":
+                for r in sel: r.update(self.payload)
+                return _Result([dict(r) for r in sel])
+            if self.op == "delete":
+                gone = set(map(id, sel))
+                self.db.tables[self.table] = [r for r in rows if id(r) not in gone]
+                return _Result([dict(r) for r in sel])
+            for c, desc in reversed(self.orders):
+                sel.sort(key=lambda r: (r.get(c) is None, str(r.get(c))), reverse=desc)
+            total = len(sel)
+            sel = sel[self.off:]
+            if self.lim is not None: sel = sel[:self.lim]
+            return _Result([dict(r) for r in sel], total if self.count else None)
+
+
+class FakeRPC:
+    def __init__(self, db, name: str, params: dict):
+        self.db, self.name, self.params = db, name, params
+
+    def execute(self):
+        self.db.faults.hit("supabase")
+        if self.name == "increment_hits":
+            with self.db.lock:
+                for r in self.db.tables.get("memories", []):
+                    if str(r.get("id")) == str(self.params.get("row_id")): r["hits"] = r.get("hits", 0) + 1
+        return _Result(None)
+
+
+class FakeSupabase:
+    def __init__(self, faults: FaultModel):
+        self.faults = faults
+        self.tables = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+        self._clock = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=3)
+
+    def now(self) -> str:
+        self._clock += datetime.timedelta(milliseconds=1)
+        return self._clock.isoformat()
+
+    def table(self, name: str): return FakeQuery(self, name)
+    def rpc(self, name: str, params: dict = None): return FakeRPC(self, name, params or {})
+
+    def seed(self, memories: int, gps: int):
+        cats = ["流水", "记事", "灵感", "情感"]
+        with self.lock:
+            for i in range(memories):
+                self.tables.setdefault("memories", []).append({
+                    "id": next(self.ids), "created_at": self.now(), "title": f"记忆 {i}",
+                    "content": f"第 {i} 条测试记忆，" + "内容" * random.randint(5, 60),
+                    "category": cats[i % len(cats)], "mood": "平静", "tags": "Core_Cognition" if i % 50 == 0 else "",
+                    "importance": 1 + i % 9, "hits": 0,
+                })
+            for i in range(gps):
+                self.tables.setdefault("gps_history", []).append({
+                    "id": next(self.ids), "created_at": self.now(), "address": "📍 上海市徐汇区",
+                    "remark": "🔋 80%", "lat": f"{31.2 + i * 1e-4:.6f}", "lon": f"{121.45 + i * 1e-4:.6f}",
+                })
+            self.tables.setdefault("user_facts", []).append({"key": "sys_ai_persona", "value": "温柔的男友"})
+
+
+class FakeIndex:
+    def __init__(self, faults: FaultModel):
+        self.faults = faults
+        self.vectors = {}
+        self.lock = threading.Lock()
+
+    def query(self, vector=None, top_k=5, include_metadata=True, **kw):
+        self.faults.hit("pinecone")
+        with self.lock:
+            items = list(self.vectors.items())[:top_k]
+        return {"matches": [{"id": k, "score": 0.8, "metadata": m} for k, (_, m) in items]}
+
+    def upsert(self, vectors=None, **kw):
+        self.faults.hit("pinecone")
+        with self.lock:
+            for v in vectors or []:
+                if isinstance(v, dict): self.vectors[v["id"]] = (v.get("values"), v.get("metadata", {}))
+                else: self.vectors[v[0]] = (v[1], v[2] if len(v) > 2 else {})
+        return {"upserted_count": len(vectors or [])}
+
+    def delete(self, ids=None, **kw):
+        self.faults.hit("pinecone")
+        with self.lock:
+            for i in ids or []: self.vectors.pop(i, None)
+
+
+class _Obj:
+    def __init__(self, **kw): self.__dict__.update(kw)
+
+
+class FakeOpenAI:
+    """只实现 chat.completions.create / audio.*，足够驱动工具和回路"""
+    def __init__(self, faults: FaultModel):
+        self.faults = faults
+        self.chat = _Obj(completions=_Obj(create=self._create))
+        self.audio = _Obj(transcriptions=_Obj(create=self._stt), speech=_Obj(create=self._tts))
+
+    def _create(self, model=None, messages=None, **kw):
+        self.faults.hit("llm")
+        prompt = (messages or [{}])[-1].get("content", "")
+        text = "LivingRoom" if "房间" in prompt else "(温柔) 宝宝在干嘛呀"
+        return _Obj(choices=[_Obj(message=_Obj(content=text))])
+
+    def _stt(self, **kw):
+        self.faults.hit("llm")
+        return _Obj(text="我在听")
+
+    def _tts(self, **kw):
+        self.faults.hit("llm")
+        return _Obj(stream_to_file=lambda path: open(path, "wb").close())
+
+
+class FakeResponse:
+    def __init__(self, status: int, payload=None, lines=None, url: str = ""):
+        self.status_code = status
+        self.url = url
+        self._lines = lines
+        self.headers = {"content-type": "text/event-stream" if lines is not None else "application/json"}
+        self.content = b"" if lines is not None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+
+    def json(self): return json.loads(self.content)
+    def iter_lines(self, chunk_size=None): return iter(self._lines or [])
+    def close(self): pass
+    def __enter__(self): return self
+    def __exit__(self, *a): return False
+
+
+class FakeHTTP:
+    """替换 server._http_session：按域名返回假数据，延迟/错误按依赖名注入"""
+    DEP_BY_HOST = {
+        "api.telegram.org": "telegram", "nominatim.openstreetmap.org": "nominatim",
+        "api.open-meteo.com": "open_meteo", "geocoding-api.open-meteo.com": "open_meteo",
+        "restapi.amap.com": "amap", "ark.cn-beijing.volces.com": "embeddings", "llm.bench.local": "llm",
+    }
+
+    def __init__(self, faults: FaultModel, dim: int = 64):
+        self.faults = faults
+        self.dim = dim
+
+    def _vector(self, text: str) -> list:
+        h = hashlib.sha256(text.encode("utf-8")).digest()
+        return [(h[i % len(h)] - 128) / 128.0 for i in range(self.dim)]
+
+    def request(self, method, url, timeout=None, json=None, params=None, stream=False, **kw):
+        from urllib.parse import urlsplit
+        host = urlsplit(url).hostname or ""
+        dep = self.DEP_BY_HOST.get(host, "http")
+        try:
+            self.faults.hit(dep)
+        except ConnectionError:
+            return FakeResponse(503, {"error": "injected"}, url=url)
+        if dep == "embeddings":
+            return FakeResponse(200, {"data": [{"embedding": self._vector(i.get("text", ""))} for i in (json or {}).get("input", [])]}, url=url)
+        if dep == "llm":
+            if (json or {}).get("stream"):
+                chunks = ["宝宝", "在干嘛", "呀～"]
+                lines = []
+                for c in chunks:
+                    lines += [b"data: " + _dumps({"choices": [{"index": 0, "delta": {"content": c}}]}), b""]
+                lines += [b"data: [DONE]", b""]
+                return FakeResponse(200, lines=lines, url=url)
+            return FakeResponse(200, {"id": "chatcmpl-bench", "choices": [{"index": 0, "message": {"role": "assistant", "content": "宝宝在干嘛呀～"}, "finish_reason": "stop"}]}, url=url)
+        if dep == "telegram":
+            return FakeResponse(200, {"ok": True, "result": []}, url=url)
+        if dep == "nominatim":
+            return FakeResponse(200, {"display_name": "中国, 上海市, 徐汇区, 漕溪北路"}, url=url)
+        if dep == "open_meteo":
+            if host.startswith("geocoding"):
+                return FakeResponse(200, {"results": [{"latitude": 31.2, "longitude": 121.45, "name": "上海"}]}, url=url)
+            return FakeResponse(200, {
+                "current": {"temperature_2m": 21.5, "relative_humidity_2m": 60, "weather_code": 1},
+                "daily": {"time": ["2026-01-01", "2026-01-02", "2026-01-03"], "weather_code": [1, 2, 61],
+                          "temperature_2m_min": [15, 16, 14], "temperature_2m_max": [23, 24, 20]},
+            }, url=url)
+        if dep == "amap":
+            return FakeResponse(200, {"status": "1", "pois": [{"name": "全家便利店", "address": "漕溪北路 1 号", "distance": "120"}]}, url=url)
+        return FakeResponse(200, {}, url=url)
+
+
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+# ==========================================
+# 2. 🔌 接线：在 import server 之前布置环境，之后把客户端换成假的
+# ==========================================
+_TEMP_DIRS = []
+
+def load_server(faults: FaultModel, memories: int, gps: int):
+    os.environ.setdefault("SUPABASE_URL", "https://bench.supabase.co")
+    os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.bench")
+    os.environ.setdefault("PINECONE_API_KEY", "bench")
+    os.environ.setdefault("DOUBAO_API_KEY", "bench")
+    os.environ.setdefault("DOUBAO_EMBEDDING_EP", "ep-bench")
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["OPENAI_BASE_URL"] = "http://llm.bench.local/v1"
+    cache_dir = tempfile.mkdtemp(prefix="brain-bench-")
+    os.environ["CACHE_DIR"] = cache_dir
+    _TEMP_DIRS.append(cache_dir)   # main() 结束时删掉
+    # 写后队列不攒合并窗口，否则写入类场景测到的是 1s 的 flush 间隔而不是代码本身
+    os.environ.setdefault("MEMORY_FLUSH_INTERVAL", "0")
+    os.environ.setdefault("GPS_FLUSH_INTERVAL", "0")
+
+    import pinecone
+    fake_index = FakeIndex(faults)
+    class _FakePinecone:
+        def __init__(self, *a, **kw): pass
+        def Index(self, name): return fake_index
+    pinecone.Pinecone = _FakePinecone
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import server
+
+    db = FakeSupabase(faults)
+    db.seed(memories, gps)
+    server.supabase = server._TimedSupabase(db)
+    fake_http = FakeHTTP(faults)
+    server._http_session = lambda policy="idempotent": fake_http
+    llm = FakeOpenAI(faults)
+    server._get_llm_client = lambda provider="openai": server._TimedClient(llm, f"llm_{provider}")
+    return server, db
+
+# ==========================================
+# 3. 🎬 场景
+# ==========================================
+async def _asgi_call(server, method: str, path: str, payload: dict):
+    """不起 uvicorn，直接按 ASGI 协议调用 HostFixMiddleware，返回 (状态码, 响应体)"""
+    app = server.HostFixMiddleware(None)
+    body = _dumps(payload)
+    sent = {"status": 0, "body": b""}
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received: return {"type": "http.disconnect"}
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(msg):
+        if msg["type"] == "http.response.start": sent["status"] = msg["status"]
+        elif msg["type"] == "http.response.body": sent["body"] += msg.get("body", b"")
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [(b"content-type", b"application/json")],
+             "query_string": b"", "scheme": "http", "server": ("bench", 80), "client": ("127.0.0.1", 1)}
+    await app(scope, receive, send)
+    return sent["status"], sent["body"]
+
+
+def _tool_ok(res) -> bool:
+    return not (isinstance(res, str) and res.startswith("❌"))
+
+
+def build_scenarios(server):
+    """场景名 -> async fn(i) 返回 True/False (是否成功)"""
+    queries = ["想你", "旅行", "第一次", "吵架", "雨天", "拥抱"]
+
+    async def get_latest_diary(i): return _tool_ok(await server.get_latest_diary())
+    async def where_is_user(i): return _tool_ok(await server.where_is_user())
+    async def get_weather_forecast(i): return _tool_ok(await server.get_weather_forecast(""))
+    async def explore_surroundings(i): return _tool_ok(await server.explore_surroundings("便利店"))
+    async def search_memory_semantic(i): return _tool_ok(await server.search_memory_semantic(queries[i % len(queries)]))
+
+    async def save_memory(i):
+        res = await asyncio.get_running_loop().run_in_executor(
+            None, server._save_memory_to_db, f"压测记忆 {i}", f"这是第 {i} 条压测写入", "流水", "平静", "Bench")
+        return _tool_ok(res)
+
+    async def sync_memory_index(i): return _tool_ok(await server.sync_memory_index("reset"))
+
+    async def route_gps(i):
+        status, _ = await _asgi_call(server, "POST", "/api/gps", {
+            "address": f"31.{2000 + i % 50},121.{4500 + i % 50}", "battery": 80, "charging": "false", "app": "微信"})
+        return status == 200
+
+    async def route_wechat(i):
+        status, _ = await _asgi_call(server, "POST", "/api/wechat", {"app": "微信", "sender": "妈妈", "content": f"吃饭了吗 {i}"})
+        return status == 200
+
+    async def route_chat(i):
+        status, body = await _asgi_call(server, "POST", "/v1/chat/completions", {
+            "model": "bench", "stream": False, "messages": [{"role": "user", "content": f"在吗 {i}"}]})
+        return status == 200 and b"data:" in body
+
+    async def route_chat_stream(i):
+        status, body = await _asgi_call(server, "POST", "/v1/chat/completions", {
+            "model": "bench", "stream": True, "messages": [{"role": "user", "content": f"在吗 {i}"}]})
+        return status == 200 and b"[DONE]" in body
+
+    return {
+        "get_latest_diary": get_latest_diary, "where_is_user": where_is_user,
+        "get_weather_forecast": get_weather_forecast, "explore_surroundings": explore_surroundings,
+        "search_memory_semantic": search_memory_semantic, "save_memory": save_memory,
+        "sync_memory_index": sync_memory_index, "route_gps": route_gps, "route_wechat": route_wechat,
+        "route_chat": route_chat, "route_chat_stream": route_chat_stream,
+    }
+
+# 有的场景单次就很重，默认少跑几轮、不并发
+SCENARIO_DEFAULTS = {"sync_memory_index": {"iterations": 3, "concurrency": 1}}
+
+# ==========================================
+# 4. 📊 运行与统计
+# ==========================================
+def _percentile(sorted_vals: list, p: float) -> float:
+    if not sorted_vals: return 0.0
+    k = (len(sorted_vals) - 1) * p
+    lo, hi = int(k), min(int(k) + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+
+async def run_scenario(server, fn, iterations: int, concurrency: int, warmup: int) -> dict:
+    for i in range(warmup):
+        try:
+            await fn(-1 - i)
+        except Exception:
+            pass
+    latencies, errors = [], 0
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _one(i):
+        nonlocal errors
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                ok = await fn(i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - t0)
+            if not ok: errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[_one(i) for i in range(iterations)])
+    # 写后队列里的数据也算进墙钟时间，否则写入类场景的吞吐是虚的；排空耗时单独报出来
+    loop = asyncio.get_running_loop()
+    drain_started = time.perf_counter()
+    drained = all([await loop.run_in_executor(None, q.flush, 60) for q in server._WRITE_BEHIND_QUEUES])
+    drain = time.perf_counter() - drain_started
+    wall = time.perf_counter() - started
+    lat = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "iterations": iterations, "concurrency": concurrency, "errors": errors,
+        "error_rate": round(errors / iterations, 4) if iterations else 0.0,
+        "wall_s": round(wall, 4), "throughput_ops_s": round(iterations / wall, 2) if wall else 0.0,
+        "mean_ms": ms(sum(lat) / len(lat)) if lat else 0.0,
+        "p50_ms": ms(_percentile(lat, 0.50)), "p95_ms": ms(_percentile(lat, 0.95)),
+        "p99_ms": ms(_percentile(lat, 0.99)), "max_ms": ms(lat[-1]) if lat else 0.0,
+        "queue_drained": drained, "drain_ms": ms(drain),
+    }
+
+
+def _parse_kv(text: str) -> dict:
+    out = {}
+    for part in filter(None, (text or "").split(",")):
+        k, _, v = part.partition("=")
+        out[k.strip()] = float(v)
+    return out
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+
+def _print_table(results: dict, baseline: dict = None):
+    cols = ("throughput_ops_s", "p50_ms", "p95_ms", "p99_ms", "error_rate")
+    print(f"{'scenario':<24}" + "".join(f"{c:>18}" for c in cols), file=sys.stderr)
+    for name, r in results.items():
+        row = f"{name:<24}"
+        for c in cols:
+            cell = f"{r[c]}"
+            base = ((baseline or {}).get(name) or {}).get(c)
+            if base:
+                cell += f" ({(r[c] - base) / base * 100:+.0f}%)"
+            row += f"{cell:>18}"
+        print(row, file=sys.stderr)
+
+
+async def _main(args):
+    faults = FaultModel({**DEFAULT_LATENCY, **_parse_kv(args.latency)}, _parse_kv(args.errors),
+                        args.tail_prob, args.tail_mult, args.seed)
+    server, db = load_server(faults, args.memories, args.gps)
+    scenarios = build_scenarios(server)
+    names = [s.strip() for s in args.scenarios.split(",")] if args.scenarios else list(scenarios)
+    unknown = [n for n in names if n not in scenarios]
+    if unknown: raise SystemExit(f"未知场景: {', '.join(unknown)} (可选: {', '.join(scenarios)})")
+
+    results = {}
+    for name in names:
+        conf = SCENARIO_DEFAULTS.get(name, {})
+        iterations = args.iterations if args.iterations_set else conf.get("iterations", args.iterations)
+        concurrency = args.concurrency if args.concurrency_set else conf.get("concurrency", args.concurrency)
+        print(f"▶ {name} (n={iterations}, c={concurrency})", file=sys.stderr)
+        sink = sys.stdout if args.verbose else io.StringIO()
+        with contextlib.redirect_stdout(sink):
+            results[name] = await run_scenario(server, scenarios[name], iterations, concurrency, args.warmup)
+
+    return {
+        "meta": {
+            "git_rev": _git_rev(), "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0], "latency": faults.latency, "errors": faults.errors,
+            "tail_prob": args.tail_prob, "tail_mult": args.tail_mult, "seed": args.seed,
+            "memories": args.memories, "gps": args.gps, "dependency_calls": faults.calls,
+        },
+        "scenarios": results,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Notion Brain 离线压测 (外部服务全部替换为进程内假服务)")
+    ap.add_argument("-s", "--scenarios", default="", help="逗号分隔的场景名，默认全部")
+    ap.add_argument("-n", "--iterations", type=int, default=200)
+    ap.add_argument("-c", "--concurrency", type=int, default=8)
+    ap.add_argument("--warmup", type=int, default=3, help="每个场景正式计时前的预热次数")
+    ap.add_argument("--latency", default="", help="覆盖依赖延迟 (秒)，如 supabase=0.02,llm=0.5")
+    ap.add_argument("--errors", default="", help="依赖错误率，如 supabase=0.01,embeddings=0.05")
+    ap.add_argument("--tail-prob", type=float, default=0.01, help="长尾请求概率")
+    ap.add_argument("--tail-mult", type=float, default=10.0, help="长尾请求的延迟倍数")
+    ap.add_argument("--memories", type=int, default=500, help="预置的记忆条数")
+    ap.add_argument("--gps", type=int, default=200, help="预置的 GPS 条数")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--out", default="", help="结果 JSON 另存到文件")
+    ap.add_argument("--compare", default="", help="与之前保存的结果 JSON 对比")
+    ap.add_argument("-v", "--verbose", action="store_true", help="不屏蔽服务端日志")
+    args = ap.parse_args()
+    args.iterations_set = "-n" in sys.argv or "--iterations" in sys.argv
+    args.concurrency_set = "-c" in sys.argv or "--concurrency" in sys.argv
+
+    try:
+        report = asyncio.run(_main(args))
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f).get("scenarios")
+        _print_table(report["scenarios"], baseline)
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f: f.write(text)
+        print(text)
+    finally:
+        # os._exit 不会跑 atexit，临时缓存目录在这里清掉
+        for d in _TEMP_DIRS: shutil.rmtree(d, ignore_errors=True)
+    # 假服务的线程池 / 写后队列都是守护线程，直接退出即可
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,23 @@ import random
 import re
 import asyncio
 import concurrent.futures
+import contextvars
+import functools
+import logging
+import logging.handlers
+import queue
+import atexit
+import heapq
+import hashlib
+import hmac
+import math
+import unicodedata
+import sqlite3
+from array import array
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, parse_qs
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 📚 核心依赖库
 from mcp.server.fastmcp import FastMCP
@@ -16,8 +33,9 @@ from pinecone import Pinecone
 from starlette.types import ASGIApp, Scope, Receive, Send
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from openai import OpenAI
-from supabase import create_client, Client as SupabaseClient
+from supabase import create_client
 
 # ==========================================
 # 1. 🌍 全局配置与初始化
@@ -32,6 +50,7 @@ TG_CHAT_ID = "7584169983"
 RESEND_KEY = os.environ.get("RESEND_API_KEY", "").strip()
 MY_EMAIL = os.environ.get("MY_EMAIL", "").strip()
 MACRODROID_URL = os.environ.get("MACRODROID_URL", "").strip()
+CACHE_DIR = os.environ.get("CACHE_DIR", ".cache").strip()  # 本地持久化缓存目录 (重启不丢)
 
 # 默认人设 (兜底用)
 DEFAULT_PERSONA = "深爱“小橘”的男友，性格温柔，偶尔有些小傲娇，喜欢管着她熬夜，叫她宝宝。"
@@ -49,19 +68,321 @@ RAW_MEME_REPO = {
     "委屈/无奈": "https://fdycchmiilwoxfylmdrk.supabase.co/storage/v1/object/public/chat-images/1%20(5).jpg"
 }
 
+# 📈 运行指标：进程内计数器 + 延迟直方图，/metrics 以 Prometheus 文本格式导出
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 180, 300)
+
+class _Metrics:
+    """极简指标注册表 (不引第三方库)：counter / histogram 按 (指标名, 标签) 聚合，gauge 在导出时现算"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = []
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict, seconds: float):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound: h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    def gauge(self, name: str, text: str, fn):
+        """fn() 返回 [(标签dict, 值), ...]，导出时才调用"""
+        self.describe(name, "gauge", text)
+        self.gauges.append((name, fn))
+
+    @staticmethod
+    def _fmt_labels(labels) -> str:
+        if not labels: return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+    def render(self) -> str:
+        out, seen = [], set()
+        def _head(name, default_kind):
+            if name in seen: return
+            seen.add(name)
+            kind, text = self.help.get(name, (default_kind, name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+        for (name, labels), value in counters:
+            _head(name, "counter")
+            out.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            _head(name, "histogram")
+            for bound, n in zip(METRICS_BUCKETS, buckets):
+                out.append(f"{name}_bucket{self._fmt_labels(labels + (('le', bound),))} {n}")
+            out.append(f"{name}_bucket{self._fmt_labels(labels + (('le', '+Inf'),))} {count}")
+            out.append(f"{name}_sum{self._fmt_labels(labels)} {round(total, 6)}")
+            out.append(f"{name}_count{self._fmt_labels(labels)} {count}")
+        for name, fn in self.gauges:
+            try:
+                samples = fn()
+            except Exception as e:
+                print(f"⚠️ 指标 {name} 采集失败: {e}")
+                continue
+            _head(name, "gauge")
+            for labels, value in samples:
+                out.append(f"{name}{self._fmt_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(out) + "\n"
+
+_METRICS = _Metrics()
+_METRICS.describe("brain_dependency_seconds", "histogram", "外部依赖调用耗时 (dep=依赖, op=操作, outcome=ok/error)")
+_METRICS.describe("brain_tool_seconds", "histogram", "MCP 工具执行耗时")
+_METRICS.describe("brain_route_seconds", "histogram", "HTTP 路由处理耗时")
+_METRICS.describe("brain_loop_iteration_seconds", "histogram", "后台回路单轮耗时 (两次休眠之间)")
+
+# 🧵 轻量链路追踪：contextvars 传递父子 span，写进本地滚动 JSONL，/api/traces 看单次请求的瀑布图
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "true").lower() == "true"
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "1.0"))                     # 根 span 采样率
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", str(5 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.environ.get("TRACE_FILE_BACKUPS", "3"))
+TRACE_RECENT_SPANS = int(os.environ.get("TRACE_RECENT_SPANS", "5000"))          # 内存里留最近多少个 span 供快速查看
+
+_CURRENT_SPAN = contextvars.ContextVar("brain_current_span", default=None)
+
+class _SpanExporter:
+    """span 导出：内存环形缓冲 + 后台线程写滚动 JSONL (CACHE_DIR/traces/spans.jsonl)，不需要外部采集器"""
+    def __init__(self):
+        self.recent = deque(maxlen=TRACE_RECENT_SPANS)
+        self.lock = threading.Lock()
+        self.logger = None
+        self.listener = None
+        self.path = os.path.join(CACHE_DIR, "traces", "spans.jsonl")
+
+    def _ensure_logger(self):
+        if self.logger is not None: return self.logger
+        with self.lock:
+            if self.logger is None:
+                logger = logging.getLogger("brain.trace")
+                logger.propagate = False
+                logger.setLevel(logging.INFO)
+                try:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=TRACE_FILE_MAX_BYTES,
+                                                                   backupCount=TRACE_FILE_BACKUPS, encoding="utf-8")
+                    handler.setFormatter(logging.Formatter("%(message)s"))
+                    # 写文件放到监听线程里，调用方只是入队
+                    q = queue.Queue(-1)
+                    self.listener = logging.handlers.QueueListener(q, handler)
+                    self.listener.start()
+                    logger.addHandler(logging.handlers.QueueHandler(q))
+                    atexit.register(self.listener.stop)
+                except Exception as e:
+                    print(f"⚠️ 链路追踪文件打不开，只保留内存: {e}")
+                    logger.addHandler(logging.NullHandler())
+                self.logger = logger
+        return self.logger
+
+    def export(self, span: dict):
+        self.recent.append(span)
+        self._ensure_logger().info(json.dumps(span, ensure_ascii=False, default=str))
+
+    def trace(self, trace_id: str) -> list:
+        spans = [sp for sp in list(self.recent) if sp["trace_id"] == trace_id]
+        if spans: return spans
+        # 内存里已经滚掉了就翻文件 (含滚动备份)
+        for i in range(TRACE_FILE_BACKUPS + 1):
+            path = self.path if i == 0 else f"{self.path}.{i}"
+            if not os.path.exists(path): continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if trace_id not in line: continue
+                    try:
+                        sp = json.loads(line)
+                    except Exception:
+                        continue
+                    if sp.get("trace_id") == trace_id: spans.append(sp)
+        return spans
+
+    def roots(self, limit: int = 50) -> list:
+        return [sp for sp in reversed(list(self.recent)) if not sp.get("parent_id")][:limit]
+
+_SPAN_EXPORTER = _SpanExporter()
+
+class _Span:
+    """with _Span("tool.get_latest_diary", "tool"): ... —— 自动挂到当前 span 下面，没有父 span 就开一条新链路"""
+    def __init__(self, name: str, kind: str = "internal", **attrs):
+        self.name, self.kind, self.attrs = name, kind, attrs
+        self.token = None
+
+    def __enter__(self):
+        parent = _CURRENT_SPAN.get()
+        if parent is not None:
+            self.trace_id, self.parent_id, self.sampled = parent.trace_id, parent.span_id, parent.sampled
+        else:
+            self.trace_id, self.parent_id = os.urandom(8).hex(), None
+            self.sampled = TRACE_ENABLED and random.random() < TRACE_SAMPLE
+        self.span_id = os.urandom(4).hex()
+        self.start_ts = time.time()
+        self.started = time.perf_counter()
+        self.token = _CURRENT_SPAN.set(self)
+        return self
+
+    def end(self, error: BaseException = None):
+        if self.token is None: return
+        try:
+            _CURRENT_SPAN.reset(self.token)
+        except ValueError:
+            # 跨上下文结束 (比如后台回路在下一轮才收尾)，直接清空即可
+            _CURRENT_SPAN.set(None)
+        self.token = None
+        if not self.sampled: return
+        _SPAN_EXPORTER.export({
+            "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "name": self.name, "kind": self.kind, "start": round(self.start_ts, 6),
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "status": "error" if error else "ok", "error": f"{type(error).__name__}: {error}"[:300] if error else "",
+            "thread": threading.current_thread().name, "attrs": self.attrs,
+        })
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        return False
+
+def _render_trace(spans: list) -> str:
+    """把一条链路的 span 渲染成文字瀑布图"""
+    if not spans: return "没有找到这条链路"
+    spans = sorted(spans, key=lambda sp: sp["start"])
+    t0 = spans[0]["start"]
+    total_ms = max(((sp["start"] - t0) * 1000 + sp["duration_ms"]) for sp in spans) or 1.0
+    children = {}
+    for sp in spans: children.setdefault(sp.get("parent_id"), []).append(sp)
+    ids = {sp["span_id"] for sp in spans}
+    lines = [f"trace {spans[0]['trace_id']}  共 {len(spans)} 个 span，总耗时 {total_ms:.1f}ms"]
+    width = 40
+
+    def _walk(sp, depth):
+        offset = (sp["start"] - t0) * 1000
+        lo = int(offset / total_ms * width)
+        hi = max(lo + 1, int((offset + sp["duration_ms"]) / total_ms * width))
+        bar = " " * lo + "█" * (hi - lo) + " " * (width - hi)
+        flag = " ❌ " + sp["error"] if sp["status"] == "error" else ""
+        lines.append(f"|{bar}| {offset:8.1f}ms {sp['duration_ms']:9.1f}ms  {'  ' * depth}{sp['name']}{flag}")
+        for child in children.get(sp["span_id"], []): _walk(child, depth + 1)
+
+    # 父 span 丢失 (未采样/被滚掉) 的孤儿也当作根展示
+    for sp in spans:
+        if not sp.get("parent_id") or sp["parent_id"] not in ids: _walk(sp, 0)
+    return "\n".join(lines)
+
+class _dep_timer:
+    """外部依赖调用计时 + 子 span：with _dep_timer("supabase", "memories.select"): ..."""
+    def __init__(self, dep: str, op: str):
+        self.dep, self.op = dep, op
+        self.span = _Span(f"{dep}.{op}", "client", dep=dep, op=op)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.span.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.__exit__(exc_type, exc, tb)
+        _METRICS.observe("brain_dependency_seconds", {"dep": self.dep, "op": self.op, "outcome": "error" if exc_type else "ok"},
+                         time.perf_counter() - self.started)
+        return False
+
+_PLAIN_TYPES = (str, bytes, int, float, bool, dict, list, tuple, type(None))
+
+class _TimedClient:
+    """给 SDK 客户端 (Pinecone 索引、OpenAI 客户端) 套一层计时：方法调用都记到 brain_dependency_seconds"""
+    def __init__(self, target, dep: str, path: str = ""):
+        self._target, self._dep, self._path = target, dep, path
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = f"{self._path}.{name}" if self._path else name
+        if isinstance(attr, _PLAIN_TYPES): return attr
+        if callable(attr):
+            def _timed(*args, **kwargs):
+                with _dep_timer(self._dep, path):
+                    return attr(*args, **kwargs)
+            return _timed
+        return _TimedClient(attr, self._dep, path)
+
+_SUPABASE_OPS = ("select", "insert", "upsert", "update", "delete")
+
+class _TimedQuery:
+    """Supabase 链式查询的计时外壳：记住表名和操作，在 execute() 时计时"""
+    def __init__(self, builder, op: str):
+        self._builder, self._op = builder, op
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr): return attr
+        def _chain(*args, **kwargs):
+            if name == "execute":
+                with _dep_timer("supabase", self._op):
+                    return attr(*args, **kwargs)
+            res = attr(*args, **kwargs)
+            if hasattr(res, "execute"):
+                op = f"{self._op.split('.')[0]}.{name}" if name in _SUPABASE_OPS else self._op
+                return _TimedQuery(res, op)
+            return res
+        return _chain
+
+class _TimedSupabase:
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name: str):
+        return _TimedQuery(self._client.table(name), name)
+
+    def rpc(self, fn: str, params: dict = None):
+        return _TimedQuery(self._client.rpc(fn, params or {}), f"rpc.{fn}")
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
 # 初始化客户端
 print("⏳ 正在初始化 Notion Brain V3.4 (全面异步加速版)...")
 
 # Supabase
-supabase: SupabaseClient = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: _TimedSupabase = _TimedSupabase(create_client(SUPABASE_URL, SUPABASE_KEY))
 
 # Pinecone & Embedding
 pc = Pinecone(api_key=PINECONE_KEY)
-index = pc.Index("notion-brain")
+index = _TimedClient(pc.Index("notion-brain"), "pinecone")
 
 # 实例化 MCP 服务
 mcp = FastMCP("Notion Brain V3")
 
+def _tool():
+    """@mcp.tool() 的计时版：注册成 MCP 工具，每次调用记 brain_tool_seconds 并开一个 span (内部直接调用也算)"""
+    def _decorator(fn):
+        @functools.wraps(fn)
+        async def _wrapped(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                with _Span(f"tool.{fn.__name__}", "tool"):
+                    return await fn(*args, **kwargs)
+            except BaseException:
+                outcome = "error"
+                raise
+            finally:
+                _METRICS.observe("brain_tool_seconds", {"tool": fn.__name__, "outcome": outcome}, time.perf_counter() - started)
+        mcp.tool()(_wrapped)
+        return _wrapped
+    return _decorator
+
 # ==========================================
 # 📜 记忆分类宪法 (Standard Taxonomy)
 # ==========================================
@@ -84,39 +405,599 @@ WEIGHT_MAP = {
 # 2. 🔧 核心 Helper 函数 (通用工具)
 # ==========================================
 
-def _get_llm_client(provider="openai"):
-    """统一管理 LLM 客户端初始化"""
+def _llm_client_config(provider: str):
+    """各个 LLM 提供方的 (api_key, base_url)，每次都现读环境变量，方便热更新"""
     if provider == "silicon":
-        api_key = os.environ.get("SILICON_API_KEY")
-        base_url = os.environ.get("SILICON_BASE_URL", "https://api.siliconflow.cn/v1")
-        return OpenAI(api_key=api_key, base_url=base_url) if api_key else None
+        return os.environ.get("SILICON_API_KEY"), os.environ.get("SILICON_BASE_URL", "https://api.siliconflow.cn/v1")
+    elif provider == "silicon_stt":
+        # 🎧 语音识别耳朵：硅基流动没配 key 时借用 OpenAI 的 key
+        return (os.environ.get("SILICON_API_KEY", os.environ.get("OPENAI_API_KEY", "")),
+                os.environ.get("SILICON_BASE_URL", "https://api.siliconflow.cn/v1"))
+    elif provider == "minimax":
+        # 👄 TTS 嘴巴：直连 Minimax
+        return os.environ.get("MINIMAX_API_KEY", ""), os.environ.get("MINIMAX_BASE_URL", "https://api.minimax.chat/v1")
     elif provider == "voice":
         # 🎙️ 语音专属大脑：优先读 VOICE 的环境变量，没填就兜底走官方 OpenAI
-        api_key = os.environ.get("VOICE_API_KEY", os.environ.get("OPENAI_API_KEY"))
-        base_url = os.environ.get("VOICE_BASE_URL", "https://api.openai.com/v1")
-        return OpenAI(api_key=api_key, base_url=base_url) if api_key else None
+        return os.environ.get("VOICE_API_KEY", os.environ.get("OPENAI_API_KEY")), os.environ.get("VOICE_BASE_URL", "https://api.openai.com/v1")
     else:
         # 🧠 文字专属大脑：你可以把服务器的 OPENAI_BASE_URL 随意改成你自己的模型地址
-        api_key = os.environ.get("OPENAI_API_KEY")
-        base_url = os.environ.get("OPENAI_BASE_URL")
-        return OpenAI(api_key=api_key, base_url=base_url) if api_key else None
+        return os.environ.get("OPENAI_API_KEY"), os.environ.get("OPENAI_BASE_URL")
 
-def _get_latest_gps_record():
-    """统一获取最新GPS记录"""
+# 进程级客户端注册表：{(provider, base_url): (key指纹, OpenAI客户端)}，客户端内部的连接池全程复用
+_LLM_CLIENTS = {}
+_LLM_CLIENTS_LOCK = threading.Lock()
+
+def _get_llm_client(provider="openai"):
+    """统一管理 LLM 客户端：按 provider + base_url 懒加载并长期复用，环境变量变了就热替换"""
+    api_key, base_url = _llm_client_config(provider)
+    if not api_key: return None
+    fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    reg_key = (provider, base_url or "")
+    with _LLM_CLIENTS_LOCK:
+        entry = _LLM_CLIENTS.get(reg_key)
+        if entry and entry[0] == fingerprint: return entry[1]
+        # 同一 provider 换了地址/密钥：丢掉旧的注册项 (旧客户端由仍在使用它的请求自然释放)
+        for k in [k for k in _LLM_CLIENTS if k[0] == provider]: del _LLM_CLIENTS[k]
+        client = _TimedClient(OpenAI(api_key=api_key, base_url=base_url), f"llm_{provider}")
+        _LLM_CLIENTS[reg_key] = (fingerprint, client)
+        print(f"🔌 LLM 客户端已{'热更新' if entry else '创建'}: {provider} -> {base_url or '默认地址'}")
+        return client
+
+_LOCAL_DB = None
+_LOCAL_DB_LOCK = threading.Lock()
+
+def _local_db():
+    """懒加载本地 SQLite (缓存/游标等跨重启状态)，打不开就返回 None，调用方退化为纯内存"""
+    global _LOCAL_DB
+    if _LOCAL_DB is None:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(CACHE_DIR, "brain_cache.sqlite3"), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            _LOCAL_DB = conn
+        except Exception as e:
+            print(f"⚠️ 本地缓存库打开失败，仅使用内存缓存: {e}")
+            _LOCAL_DB = False
+    return _LOCAL_DB or None
+
+def _local_db_query(sql: str, params=()) -> list:
+    """在本地库执行查询，出错返回空列表"""
+    db = _local_db()
+    if not db: return []
+    try:
+        with _LOCAL_DB_LOCK:
+            return db.execute(sql, params).fetchall()
+    except Exception as e:
+        print(f"⚠️ 本地缓存读取失败: {e}")
+        return []
+
+def _local_db_write(sql: str, params=(), many: bool = False) -> bool:
+    """在本地库执行写入 (many=True 时批量)，出错返回 False"""
+    db = _local_db()
+    if not db: return False
+    try:
+        with _LOCAL_DB_LOCK:
+            if many: db.executemany(sql, params)
+            else: db.execute(sql, params)
+            db.commit()
+        return True
+    except Exception as e:
+        print(f"⚠️ 本地缓存写入失败: {e}")
+        return False
+
+def _local_db_batch(ops: list) -> bool:
+    """把多条写入 [(sql, params, many), ...] 放进同一个事务，要么全成要么全回滚，出错返回 False"""
+    db = _local_db()
+    if not db: return False
+    with _LOCAL_DB_LOCK:
+        try:
+            for sql, params, many in ops:
+                if many: db.executemany(sql, params)
+                else: db.execute(sql, params)
+            db.commit()
+            return True
+        except Exception as e:
+            db.rollback()
+            print(f"⚠️ 本地缓存写入失败 (已回滚): {e}")
+            return False
+
+def _local_kv_get(key: str, default=None):
+    """读本地键值状态 (JSON 编码)"""
+    _local_db_write("CREATE TABLE IF NOT EXISTS kv_state (key TEXT PRIMARY KEY, value TEXT)")
+    rows = _local_db_query("SELECT value FROM kv_state WHERE key = ?", (key,))
+    if not rows: return default
+    try:
+        return json.loads(rows[0][0])
+    except Exception:
+        return default
+
+def _local_kv_set(key: str, value) -> bool:
+    """写本地键值状态，value 为 None 时删除"""
+    _local_db_write("CREATE TABLE IF NOT EXISTS kv_state (key TEXT PRIMARY KEY, value TEXT)")
+    if value is None: return _local_db_write("DELETE FROM kv_state WHERE key = ?", (key,))
+    return _local_db_write("INSERT OR REPLACE INTO kv_state (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+# 🌐 共享 HTTP 传输层：按重试策略复用 Session，连接池 keep-alive，按域名限并发
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))               # 每个域名保持的长连接数
+HTTP_HOST_CONCURRENCY = int(os.environ.get("HTTP_HOST_CONCURRENCY", "8"))  # 每个域名同时在飞的请求数
+
+# 个别域名的并发上限 (Nominatim 使用条款要求串行)
+HTTP_HOST_LIMITS = {"nominatim.openstreetmap.org": 1}
+
+_HTTP_RETRY_POLICIES = {
+    # 幂等请求：连不上、读超时、429/5xx 都按指数退避重试
+    "idempotent": Retry(
+        total=3, connect=3, read=2, status=3, backoff_factor=0.4,
+        status_forcelist=(429, 500, 502, 503, 504), allowed_methods=None,
+        respect_retry_after_header=True, raise_on_status=False
+    ),
+    # 非幂等请求 (发消息/发邮件/大模型/锁屏)：只在连接没建立时重试，绝不重复投递
+    "write": Retry(
+        total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.4,
+        allowed_methods=None, raise_on_status=False
+    ),
+}
+_HTTP_SESSIONS = {}
+_HTTP_HOST_SEMAPHORES = {}
+_HTTP_LOCK = threading.Lock()
+
+def _http_session(policy: str) -> requests.Session:
+    with _HTTP_LOCK:
+        session = _HTTP_SESSIONS.get(policy)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=32, pool_maxsize=HTTP_POOL_SIZE, max_retries=_HTTP_RETRY_POLICIES[policy])
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _HTTP_SESSIONS[policy] = session
+        return session
+
+def _http_host_semaphore(host: str) -> threading.BoundedSemaphore:
+    with _HTTP_LOCK:
+        sem = _HTTP_HOST_SEMAPHORES.get(host)
+        if sem is None:
+            sem = threading.BoundedSemaphore(HTTP_HOST_LIMITS.get(host, HTTP_HOST_CONCURRENCY))
+            _HTTP_HOST_SEMAPHORES[host] = sem
+        return sem
+
+# 出站域名 -> 指标里的依赖名
+HTTP_DEP_NAMES = {
+    "api.telegram.org": "telegram",
+    "nominatim.openstreetmap.org": "nominatim",
+    "api.open-meteo.com": "open_meteo",
+    "geocoding-api.open-meteo.com": "open_meteo",
+    "restapi.amap.com": "amap",
+    "ark.cn-beijing.volces.com": "embeddings",
+    "api.resend.com": "resend",
+    "api.tavily.com": "tavily",
+    "www.xiaohongshu.com": "xiaohongshu",
+    "xhslink.com": "xiaohongshu",
+    "r.jina.ai": "jina",
+}
+
+def _http_request(method: str, url: str, policy: str = "idempotent", timeout=None, **kwargs) -> requests.Response:
+    """所有出站 HTTP 的统一入口。timeout 传单个数字时视为读超时，连接超时统一为 HTTP_CONNECT_TIMEOUT"""
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (HTTP_CONNECT_TIMEOUT, timeout)
+    host = urlsplit(url).hostname or ""
+    with _http_host_semaphore(host), _dep_timer(HTTP_DEP_NAMES.get(host, host), method):
+        return _http_session(policy).request(method, url, timeout=timeout, **kwargs)
+
+def _http_get(url: str, policy: str = "idempotent", **kwargs) -> requests.Response:
+    return _http_request("GET", url, policy=policy, **kwargs)
+
+def _http_post(url: str, policy: str = "write", **kwargs) -> requests.Response:
+    return _http_request("POST", url, policy=policy, **kwargs)
+
+# 🧱 分舱线程池：数据库 / 向量 / 大模型 / 普通 HTTP 各用各的池子，慢的依赖只会占满自己的池
+EXECUTOR_POOL_SIZES = {
+    "db": int(os.environ.get("POOL_DB_WORKERS", "16")),          # Supabase / 本地 SQLite
+    "vector": int(os.environ.get("POOL_VECTOR_WORKERS", "8")),   # Pinecone + 向量化
+    "llm": int(os.environ.get("POOL_LLM_WORKERS", "12")),        # 对话 / 语音 / 流式转发，单次可能几分钟
+    "http": int(os.environ.get("POOL_HTTP_WORKERS", "16")),      # 推送、天气、地理编码、日历等外部接口
+}
+
+class _Bulkhead:
+    """一个有界线程池 + 指标：排队数、在飞数、排队等待耗时 (平均/最大)"""
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"pool-{name}")
+        self.lock = threading.Lock()
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "queued": 0, "in_flight": 0,
+                      "wait_total_s": 0.0, "wait_max_s": 0.0, "run_total_s": 0.0}
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        """线程里也能用：投进本池，返回 Future (不需要等结果就直接丢掉)"""
+        ctx = contextvars.copy_context()
+        enqueued = time.monotonic()
+        with self.lock:
+            self.stats["submitted"] += 1
+            self.stats["queued"] += 1
+
+        def _call():
+            started = time.monotonic()
+            wait = started - enqueued
+            with self.lock:
+                self.stats["queued"] -= 1
+                self.stats["in_flight"] += 1
+                self.stats["wait_total_s"] += wait
+                self.stats["wait_max_s"] = max(self.stats["wait_max_s"], wait)
+            ok = False
+            try:
+                result = ctx.run(fn, *args, **kwargs)
+                ok = True
+                return result
+            finally:
+                with self.lock:
+                    self.stats["in_flight"] -= 1
+                    self.stats["completed" if ok else "failed"] += 1
+                    self.stats["run_total_s"] += time.monotonic() - started
+
+        return self.executor.submit(_call)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+        done = snap["completed"] + snap["failed"]
+        snap["workers"] = self.workers
+        snap["wait_avg_s"] = round(snap["wait_total_s"] / done, 4) if done else 0.0
+        snap["wait_total_s"] = round(snap["wait_total_s"], 3)
+        snap["wait_max_s"] = round(snap["wait_max_s"], 3)
+        snap["run_total_s"] = round(snap["run_total_s"], 3)
+        return snap
+
+_POOLS = {name: _Bulkhead(name, size) for name, size in EXECUTOR_POOL_SIZES.items()}
+
+async def _run_blocking(pool: str, fn, *args, **kwargs):
+    """把阻塞调用丢进对应依赖的线程池 (替代 asyncio.to_thread 的共享默认池)"""
+    return await _POOLS[pool].run(fn, *args, **kwargs)
+
+def _fetch_latest_gps_row():
+    """直接查库拿最新一条 GPS 记录 (只在冷启动 / 去重基准初始化时用)"""
     res = supabase.table("gps_history").select("*").order("created_at", desc=True).limit(1).execute()
     return res.data[0] if res.data else None
 
-def _gps_to_address(lat, lon):
-    """把经纬度变成中文地址"""
+# ♻️ 通用缓存积木：TTL 缓存 (可落本地库)、同 key 请求合并、全局限速
+_CACHE_MISS = object()
+_TTL_CACHES = []
+_SINGLE_FLIGHTS = []
+
+class _TTLCache:
+    """进程内 TTL + LRU 缓存；persist=True 时同时写本地 SQLite (ttl_cache 表，按 namespace 区分)，重启后照样命中"""
+    def __init__(self, namespace: str, ttl: float, max_items: int = 1024, persist: bool = False):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_items = max_items
+        self.persist = persist
+        self.items = OrderedDict()   # key -> (过期时间, 值)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+        self.db_ready = False
+        _TTL_CACHES.append(self)
+
+    def _ensure_db(self) -> bool:
+        if not self.persist: return False
+        if not self.db_ready:
+            self.db_ready = _local_db_write("CREATE TABLE IF NOT EXISTS ttl_cache (ns TEXT, key TEXT, value TEXT, expires_at REAL, PRIMARY KEY (ns, key))")
+            if self.db_ready: _local_db_write("DELETE FROM ttl_cache WHERE ns = ? AND expires_at < ?", (self.namespace, time.time()))
+        return self.db_ready
+
+    def _remember(self, key, value, expires_at: float):
+        with self.lock:
+            self.items[key] = (expires_at, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items: self.items.popitem(last=False)
+
+    def get(self, key, default=None, record: bool = True):
+        """record=False 时不计入命中统计 (单飞里的二次确认用，避免一次未命中记两遍)"""
+        now = time.time()
+        with self.lock:
+            entry = self.items.get(key)
+            if entry and entry[0] > now:
+                self.items.move_to_end(key)
+                if record: self.stats["hits"] += 1
+                return entry[1]
+            if entry: del self.items[key]
+        if self._ensure_db():
+            rows = _local_db_query("SELECT value, expires_at FROM ttl_cache WHERE ns = ? AND key = ?", (self.namespace, str(key)))
+            if rows and rows[0][1] > now:
+                try:
+                    value = json.loads(rows[0][0])
+                except Exception:
+                    value = _CACHE_MISS
+                if value is not _CACHE_MISS:
+                    self._remember(key, value, rows[0][1])
+                    if record: self.stats["disk_hits"] += 1
+                    return value
+        if record: self.stats["misses"] += 1
+        return default
+
+    def peek(self, key, default=None):
+        """只看内存层，不回本地库 (给事件循环里的热路径用)"""
+        with self.lock:
+            entry = self.items.get(key)
+            if entry and entry[0] > time.time():
+                self.stats["hits"] += 1
+                return entry[1]
+        return default
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, value, expires_at)
+        self.stats["writes"] += 1
+        if self._ensure_db():
+            _local_db_write("INSERT OR REPLACE INTO ttl_cache (ns, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                            (self.namespace, str(key), json.dumps(value, ensure_ascii=False), expires_at))
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None: self.items.clear()
+            else: self.items.pop(key, None)
+        if self._ensure_db():
+            if key is None: _local_db_write("DELETE FROM ttl_cache WHERE ns = ?", (self.namespace,))
+            else: _local_db_write("DELETE FROM ttl_cache WHERE ns = ? AND key = ?", (self.namespace, str(key)))
+
+class _SingleFlight:
+    """同一个 key 同时只真正执行一次，其余线程等着拿同一个结果 (异常也一起收到)；
+    给了 name 就登记到 /metrics (kind=leader 真正执行 / shared 搭便车)"""
+    def __init__(self, name: str = None):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"leader": 0, "shared": 0}
+        if name: _SINGLE_FLIGHTS.append(self)
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event(), "result": None, "error": None}
+            self.stats["leader" if leader else "shared"] += 1
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None: raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call["done"].set()
+
+class _RateLimiter:
+    """全局限速：相邻两次放行至少间隔 1/rate 秒，排不上队 (超过 max_wait) 就返回 False"""
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait: float = 10.0) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_at)
+            if slot - now > max_wait: return False
+            self.next_at = slot + self.interval
+        if slot > now: time.sleep(slot - now)
+        return True
+
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def _geohash(lat: float, lon: float, precision: int = 7) -> str:
+    """经纬度 -> geohash (7 位约 150m 见方)"""
+    lat_rng, lon_rng = [-90.0, 90.0], [-180.0, 180.0]
+    out, bits, ch, even = [], 0, 0, True
+    while len(out) < precision:
+        rng, val = (lon_rng, lon) if even else (lat_rng, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if val >= mid:
+            ch = (ch << 1) | 1
+            rng[0] = mid
+        else:
+            ch <<= 1
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            out.append(_GEOHASH_BASE32[ch])
+            bits, ch = 0, 0
+    return "".join(out)
+
+# 🗺️ 逆地理编码缓存：按 geohash 格子缓存地址，Nominatim 全局限速 1 次/秒，同一格子的并发查询合并成一次
+GEOCODE_PRECISION = int(os.environ.get("GEOCODE_PRECISION", "7"))
+GEOCODE_TTL = float(os.environ.get("GEOCODE_TTL", str(30 * 86400)))
+GEOCODE_RATE = float(os.environ.get("GEOCODE_RATE", "1"))              # Nominatim 使用政策：每秒最多 1 次
+GEOCODE_MAX_WAIT = float(os.environ.get("GEOCODE_MAX_WAIT", "5"))      # 限速排队超过这么久就先返回坐标
+_GEOCODE_CACHE = _TTLCache("geocode", GEOCODE_TTL, max_items=4096, persist=True)
+_GEOCODE_FLIGHT = _SingleFlight("geocode")
+_NOMINATIM_LIMITER = _RateLimiter(GEOCODE_RATE)
+
+def _reverse_geocode(cell: str, lat, lon) -> str:
+    # 调用方已经查过一次并记了未命中，这里只是确认排队期间别人有没有写进来
+    cached = _GEOCODE_CACHE.get(cell, record=False)
+    if cached is not None: return cached
+    fallback = f"坐标点: {lat}, {lon}"
+    if not _NOMINATIM_LIMITER.acquire(GEOCODE_MAX_WAIT):
+        print(f"⏳ 逆地理编码排队过长，先返回坐标: {cell}")
+        return fallback
     try:
         headers = {'User-Agent': 'MyNotionBrain/1.0'}
         url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=18&addressdetails=1&accept-language=zh-CN"
-        resp = requests.get(url, headers=headers, timeout=3)
+        resp = _http_get(url, headers=headers, timeout=3)
         if resp.status_code == 200:
-            return resp.json().get("display_name", f"未知荒野 ({lat},{lon})")
+            name = resp.json().get("display_name")
+            if not name: return f"未知荒野 ({lat},{lon})"
+            _GEOCODE_CACHE.set(cell, name)
+            return name
+    except Exception as e:
+        print(f"❌ 地图解析失败: {e}")
+    return fallback
+
+def _gps_to_address(lat, lon):
+    """把经纬度变成中文地址 (同一个 geohash 格子里的点直接命中缓存，不再外呼)"""
+    try:
+        cell = _geohash(float(lat), float(lon), GEOCODE_PRECISION)
+    except (TypeError, ValueError):
+        return f"坐标点: {lat}, {lon}"
+    cached = _GEOCODE_CACHE.get(cell)
+    if cached is not None: return cached
+    try:
+        return _GEOCODE_FLIGHT.do(cell, lambda: _reverse_geocode(cell, lat, lon))
     except Exception as e:
         print(f"❌ 地图解析失败: {e}")
-    return f"坐标点: {lat}, {lon}"
+        return f"坐标点: {lat}, {lon}"
+
+# 🌤️ 天气缓存：城市 -> 坐标基本不会变，长期缓存；预报按约 1km 的格子缓存到下一个整点 (Open-Meteo 每小时出一次新数据)
+WEATHER_CITY_TTL = float(os.environ.get("WEATHER_CITY_TTL", str(365 * 86400)))
+WEATHER_CITY_MISS_TTL = float(os.environ.get("WEATHER_CITY_MISS_TTL", "86400"))  # 查不到的城市名也记一天，免得反复外呼
+WEATHER_TTL_MAX = float(os.environ.get("WEATHER_TTL_MAX", "3600"))
+WEATHER_GRID = int(os.environ.get("WEATHER_GRID", "2"))                           # 坐标保留几位小数当 key (2 位约 1km)
+WEATHER_PREFETCH = os.environ.get("WEATHER_PREFETCH", "0") == "1"                 # 开了就在后台给当前位置预取预报
+WEATHER_PREFETCH_INTERVAL = float(os.environ.get("WEATHER_PREFETCH_INTERVAL", "600"))
+_WEATHER_CITY_CACHE = _TTLCache("weather_city", WEATHER_CITY_TTL, max_items=512, persist=True)
+_WEATHER_CACHE = _TTLCache("weather", WEATHER_TTL_MAX, max_items=256, persist=True)
+_WEATHER_FLIGHT = _SingleFlight("weather")
+
+def _weather_ttl(now: float = None) -> float:
+    """预报缓存到下一个整点后 5 分钟 (给上游出新数据留点时间)，最长 WEATHER_TTL_MAX"""
+    now = time.time() if now is None else now
+    next_refresh = (int(now) // 3600 + 1) * 3600 + 300
+    return max(60.0, min(WEATHER_TTL_MAX, next_refresh - now))
+
+def _weather_key(lat, lon) -> str:
+    return f"{round(float(lat), WEATHER_GRID)},{round(float(lon), WEATHER_GRID)}"
+
+def _geocode_city(city: str):
+    """城市名 -> (lat, lon, 名字)，查不到返回 None"""
+    key = city.strip().lower()
+    cached = _WEATHER_CITY_CACHE.get(key, _CACHE_MISS)
+    if cached is not _CACHE_MISS: return tuple(cached) if cached else None
+
+    def _lookup():
+        geo_url = f"https://geocoding-api.open-meteo.com/v1/search?name={city}&count=1&language=zh&format=json"
+        geo_res = _http_get(geo_url, timeout=5).json()
+        if geo_res.get("results"):
+            r = geo_res["results"][0]
+            hit = [r["latitude"], r["longitude"], r["name"]]
+            _WEATHER_CITY_CACHE.set(key, hit)
+            return hit
+        _WEATHER_CITY_CACHE.set(key, [], ttl=WEATHER_CITY_MISS_TTL)
+        return []
+
+    hit = _WEATHER_FLIGHT.do(("city", key), _lookup)
+    return tuple(hit) if hit else None
+
+def _fetch_forecast(lat, lon) -> dict:
+    """取 3 天预报 (同一格子共用一份缓存，并发查询合并成一次外呼)"""
+    key = _weather_key(lat, lon)
+    cached = _WEATHER_CACHE.get(key)
+    if cached is not None: return cached
+
+    def _load():
+        grid_lat, grid_lon = key.split(",")
+        w_url = f"https://api.open-meteo.com/v1/forecast?latitude={grid_lat}&longitude={grid_lon}&current=temperature_2m,relative_humidity_2m,weather_code&daily=weather_code,temperature_2m_max,temperature_2m_min&timezone=auto&forecast_days=3"
+        w = _http_get(w_url, timeout=5).json()
+        if "current" not in w or "daily" not in w:
+            raise ValueError(w.get("reason") or "预报数据不完整")
+        _WEATHER_CACHE.set(key, w, ttl=_weather_ttl())
+        return w
+
+    return _WEATHER_FLIGHT.do(("forecast", key), _load)
+
+# 📍 最新位置热缓存：/api/gps 收到上报就直接更新，所有查位置的地方读内存，只有冷启动才查一次库
+class _LatestLocation:
+    """进程内的“她现在在哪”。记录里的 updated_at (UTC ISO) / reported_at (时间戳) 是最后一次上报时间，可据此判断新鲜度"""
+    def __init__(self):
+        self.record = None
+        self.lock = threading.Lock()
+        self.loader = _SingleFlight()
+        self.stats = {"hits": 0, "db_loads": 0, "live_updates": 0}
+
+    def peek(self):
+        """只读内存，不回源；还没有数据时返回 None"""
+        with self.lock:
+            if self.record is None: return None
+            self.stats["hits"] += 1
+            return dict(self.record)
+
+    def get(self):
+        rec = self.peek()
+        if rec is not None: return rec
+        return self.loader.do("latest", self._load)
+
+    def _load(self):
+        row = _fetch_latest_gps_row()
+        with self.lock:
+            if self.record is not None: return dict(self.record)   # 加载期间已经有实时上报，以实时为准
+            self.stats["db_loads"] += 1
+            if not row: return None
+            rec = dict(row)
+            try:
+                rec["reported_at"] = datetime.datetime.fromisoformat(str(rec.get("created_at")).replace('Z', '+00:00')).timestamp()
+            except Exception:
+                rec["reported_at"] = 0.0
+            rec["updated_at"] = rec.get("created_at")
+            self.record = rec
+            return dict(rec)
+
+    def observe(self, report: dict):
+        """上报一到就更新：状态立刻生效；没动就沿用原地址，动了先用地址缓存 / 坐标顶上，等流水线解析完再回填"""
+        with self.lock:
+            rec = dict(self.record or {})
+            if report["lat"] is None:
+                rec["address"] = f"⚠️ {report['raw_address']}"
+            else:
+                try:
+                    moved = rec.get("lat") is None or _haversine_m(
+                        float(report["lat"]), float(report["lon"]), float(rec["lat"]), float(rec["lon"])) > GPS_DEDUP_METERS
+                except (TypeError, ValueError):
+                    moved = True
+                if moved or not rec.get("address"):
+                    # 在事件循环里调用：只查内存，没命中就先放坐标，等入库线程 refine_address 回填
+                    cached = _GEOCODE_CACHE.peek(_geohash(float(report["lat"]), float(report["lon"]), GEOCODE_PRECISION))
+                    rec["address"] = "📍 " + (cached or f"坐标点: {report['lat']}, {report['lon']}")
+            if report["lat"] is not None: rec["lat"], rec["lon"] = report["lat"], report["lon"]
+            rec["remark"] = report["remark"]
+            rec["reported_at"] = report["reported_at"]
+            rec["updated_at"] = datetime.datetime.fromtimestamp(report["reported_at"], datetime.timezone.utc).isoformat()
+            self.record = rec
+            self.stats["live_updates"] += 1
+
+    def refine_address(self, lat, lon, address: str):
+        """流水线解析出正式地址后回填 (只在热缓存里仍是这个坐标时才覆盖，避免旧点盖掉新点)"""
+        with self.lock:
+            if self.record and self.record.get("lat") == lat and self.record.get("lon") == lon:
+                self.record["address"] = address
+
+    def age_seconds(self) -> float:
+        with self.lock:
+            if not self.record: return float("inf")
+            return time.time() - (self.record.get("reported_at") or 0.0)
+
+_LATEST_LOCATION = _LatestLocation()
+
+def _get_latest_gps_record():
+    """统一获取最新GPS记录 (热缓存，冷启动才查库)"""
+    return _LATEST_LOCATION.get()
+
+async def _latest_location():
+    """异步版：内存里有就直接返回，不占线程池"""
+    rec = _LATEST_LOCATION.peek()
+    if rec is None: rec = await _run_blocking("db", _LATEST_LOCATION.get)
+    return rec
 
 def _push_wechat(content: str, title: str = "来自Silas的私信 💌") -> str:
     """统一推送函数 (已无缝切换至 Telegram，方法名保留以兼容旧代码)"""
@@ -130,14 +1011,144 @@ def _push_wechat(content: str, title: str = "来自Silas的私信 💌") -> str:
             "text": text,
             "parse_mode": "HTML"
         }
-        resp = requests.post(url, json=data, timeout=10)
+        resp = _http_post(url, json=data, timeout=10)
         result = resp.json()
         return f"✅ 电报已送达！" if result.get('ok') else f"❌ 电报推送失败: {result.get('description')}"
     except Exception as e:
         return f"❌ 网络错误: {e}"
 
-def _save_memory_to_db(title: str, content: str, category: str, mood: str = "平静", tags: str = "") -> str:
-    """统一记忆存储核心 (引入天然双链机制 + 自动同步向量库)"""
+class _WriteBehindQueue:
+    """通用写后队列：调用方立即返回，后台线程按条数/时间窗合并成一次批量写。
+    队列有界，满了先阻塞调用方 (背压)，再满就由调用方同步写入兜底；进程退出时排空。
+    on_error(items) 在整批写入抛异常时调用 (比如逐条重写、清理临时状态)，不给就只记日志丢弃。"""
+    def __init__(self, name: str, flush_fn, max_batch: int, flush_interval: float, maxsize: int, on_error=None):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.on_error = on_error
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.q = queue.Queue(maxsize=maxsize)
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.stats = {"enqueued": 0, "flushed": 0, "batches": 0, "sync_fallbacks": 0, "errors": 0}
+
+    def _ensure_started(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=f"writebehind-{self.name}", daemon=True)
+                self.thread.start()
+
+    def put(self, item, timeout: float = 5.0) -> bool:
+        """入队成功返回 True；队列已关闭或持续满载返回 False，由调用方同步写入 (timeout<=0 不等待)"""
+        if self.closed: return False
+        self._ensure_started()
+        with self.cond:
+            self.pending += 1
+        # 带上调用方的上下文，批量写的 span 能挂回发起请求的链路
+        entry = (item, contextvars.copy_context())
+        try:
+            if timeout > 0: self.q.put(entry, timeout=timeout)
+            else: self.q.put_nowait(entry)   # 事件循环里调用：满了立刻返回，不阻塞
+        except queue.Full:
+            self._done(1)
+            self.stats["sync_fallbacks"] += 1
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    def _done(self, n: int):
+        with self.cond:
+            self.pending -= n
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            item = self.q.get()
+            if item is None: break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    # 窗口到点后 (或窗口设为 0) 不再等，但已经排着的照样并进这一批
+                    nxt = self.q.get(timeout=remaining) if remaining > 0 else self.q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            self._flush_batch(batch)
+            if stop: break
+        # 收到停止信号后把残留的也写掉
+        rest = []
+        while True:
+            try:
+                nxt = self.q.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is not None: rest.append(nxt)
+        for i in range(0, len(rest), self.max_batch):
+            self._flush_batch(rest[i:i + self.max_batch])
+
+    def _flush_batch(self, batch: list):
+        """batch 是 (数据, 上下文) 列表；整批挂在第一条的链路下执行"""
+        def _write(items):
+            with _Span(f"writebehind.{self.name}", "job", items=len(items)):
+                self.flush_fn(items)
+        try:
+            batch[0][1].run(_write, [item for item, _ in batch])
+            self.stats["flushed"] += len(batch)
+            self.stats["batches"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"❌ [{self.name}] 批量写入失败 ({len(batch)} 条): {e}")
+            if self.on_error:
+                try:
+                    batch[0][1].run(self.on_error, [item for item, _ in batch])
+                except Exception as cb_e:
+                    print(f"❌ [{self.name}] 失败兜底也出错: {cb_e}")
+        finally:
+            self._done(len(batch))
+
+    def depth(self) -> int:
+        return self.pending
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """阻塞等待目前已入队的数据全部落库"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: return False
+                self.cond.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 30.0):
+        """停止接收新数据并排空队列"""
+        if self.closed: return
+        self.closed = True
+        if self.thread is None: return
+        try:
+            self.q.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+_WRITE_BEHIND_QUEUES = []
+
+def _close_write_behind_queues():
+    for q in _WRITE_BEHIND_QUEUES:
+        if q.depth(): print(f"⏳ [{q.name}] 正在排空 {q.depth()} 条待写数据...")
+        q.close()
+
+atexit.register(_close_write_behind_queues)
+
+def _prepare_memory(title: str, content: str, category: str, mood: str = "平静", tags: str = "") -> dict:
+    """记忆入库前的归一化：分类纠偏、权重、自动标签"""
     if category not in WEIGHT_MAP:
         mapping = {"日记": MemoryType.EPISODIC, "Note": MemoryType.IDEA, "GPS": MemoryType.STREAM, "重要": MemoryType.EMOTION}
         category = mapping.get(category, MemoryType.STREAM)
@@ -150,75 +1161,374 @@ def _save_memory_to_db(title: str, content: str, category: str, mood: str = "平
         elif any(w in content_lower for w in ["吃", "喝", "买"]): tags = "消费,生活"
         elif any(w in content_lower for w in ["代码", "bug", "写"]): tags = "工作,Dev"
 
-    try:
+    return {
+        "title": title, "content": content, "category": category,
+        "mood": mood, "tags": tags, "importance": importance
+    }
+
+def _memory_log_msg(data: dict) -> str:
+    if data["importance"] >= 7: return f"✨ [核心记忆] 已存入: {data['title']}"
+    return f"✅ 记忆已归档 [{data['category']}]"
+
+def _write_memory_batch(items: list) -> list:
+    """一批记忆的完整写入链路 (双链 + 批量入库 + 批量同步向量库)，返回与输入对应的结果文本"""
+    # 0. 整批一次向量化：“双链查询向量”和“入库向量” (入库向量基于原文，不含自动追加的双链注记)
+    embed_texts = []
+    for d in items:
+        if d["importance"] >= 7: embed_texts.append(d["content"])
+        if d["importance"] >= 4: embed_texts.append(f"标题: {d['title']}\n内容: {d['content']}\n心情: {d['mood']}")
+    vectors = iter(_get_embeddings_batch(embed_texts) if embed_texts else [])
+
+    rows, upsert_vecs = [], []
+    for d in items:
+        vec_link = next(vectors) if d["importance"] >= 7 else []
+        upsert_vecs.append(next(vectors) if d["importance"] >= 4 else [])
+        row = {k: v for k, v in d.items() if not k.startswith("_")}
+
         # 1. 尝试建立双链 (维持原逻辑)
-        if importance >= 7:
+        if vec_link:
             try:
-                vec = _get_embedding(content)
-                if vec:
-                    pc_res = index.query(vector=vec, top_k=1, include_metadata=True)
-                    if pc_res and "matches" in pc_res and len(pc_res["matches"]) > 0:
-                        match = pc_res["matches"][0]
-                        score = match['score'] if isinstance(match, dict) else getattr(match, 'score', 0)
-                        if score > 0.8:
-                            meta = match['metadata'] if isinstance(match, dict) else getattr(match, 'metadata', {})
-                            rel_title = meta.get('title', '往事')
-                            rel_room = meta.get('room', '未知房间')
-                            content += f"\n\n🔗 [记忆双链]: 自动关联至 {rel_room} 的记忆《{rel_title}》"
+                pc_res = index.query(vector=vec_link, top_k=1, include_metadata=True)
+                if pc_res and "matches" in pc_res and len(pc_res["matches"]) > 0:
+                    match = pc_res["matches"][0]
+                    score = match['score'] if isinstance(match, dict) else getattr(match, 'score', 0)
+                    if score > 0.8:
+                        meta = match['metadata'] if isinstance(match, dict) else getattr(match, 'metadata', {})
+                        rel_title = meta.get('title', '往事')
+                        rel_room = meta.get('room', '未知房间')
+                        row["content"] += f"\n\n🔗 [记忆双链]: 自动关联至 {rel_room} 的记忆《{rel_title}》"
             except Exception as e:
                 print(f"⚠️ Pinecone 双链查询异常 (跳过): {e}")
+        rows.append(row)
 
-        data = {
-            "title": title, "content": content, "category": category,
-            "mood": mood, "tags": tags, "importance": importance
-        }
-        
-        # 2. 插入数据库并获取返回 ID (独立捕获 Supabase 错误)
+    # 2. 批量插入数据库；整批失败时逐条重试，只让真正有问题的那条失败
+    records = [None] * len(rows)
+    results = [None] * len(rows)
+    try:
+        res = supabase.table("memories").insert(rows).execute()
+        data = res.data if res and hasattr(res, 'data') and isinstance(res.data, list) else []
+        for i, record in enumerate(data[:len(rows)]): records[i] = record
+    except Exception as e:
+        print(f"⚠️ 批量写入 Supabase 失败，改为逐条写入: {e}")
+        for i, row in enumerate(rows):
+            try:
+                res = supabase.table("memories").insert(row).execute()
+                if res and hasattr(res, 'data') and res.data:
+                    # 兼容 res.data 是列表还是单一字典
+                    records[i] = res.data[0] if isinstance(res.data, list) else res.data
+            except Exception as row_e:
+                print(f"❌ 写入 Supabase 失败: {row_e}")
+                results[i] = f"❌ Supabase 保存失败: {row_e}"
+
+    # 落库结果同步进最近记忆缓冲
+    for d, record in zip(items, records):
+        if d.get("_buffer_token"): _RECENT_MEMORIES.confirm(d["_buffer_token"], record)
+
+    # 3. 一次 upsert 同步到 Pinecone (独立捕获 Pinecone 同步错误)
+    room_map = {
+        MemoryType.EMOTION: "Bedroom", 
+        MemoryType.IDEA: "Study", 
+        MemoryType.EPISODIC: "Library"
+    }
+    pc_vectors, synced = [], []
+    for row, record, vec_new in zip(rows, records, upsert_vecs):
+        new_id = str(record.get('id', '')) if record else ""
+        if new_id and vec_new:
+            meta_payload = {
+                "text": row["content"], 
+                "title": row["title"], 
+                "date": datetime.datetime.now().isoformat(), 
+                "mood": row["mood"], 
+                "room": room_map.get(row["category"], "LivingRoom")
+            }
+            pc_vectors.append((new_id, vec_new, meta_payload))
+            synced.append((new_id, _sync_hash(record)))
+    if pc_vectors:
         try:
-            res = supabase.table("memories").insert(data).execute()
+            for i in range(0, len(pc_vectors), 100):
+                index.upsert(vectors=pc_vectors[i:i + 100])
+            # 记进同步记录，sync_memory_index 扫到这些行时按哈希直接跳过，不再重复向量化
+            _sync_record_hashes(synced)
+            print(f"⚡ [自动同步] {len(pc_vectors)} 条记忆已推送到 Pinecone")
         except Exception as e:
-            print(f"❌ 写入 Supabase 失败: {e}")
-            return f"❌ Supabase 保存失败: {e}"
-        
-        # 3. 自动同步到 Pinecone (独立捕获 Pinecone 同步错误，增强数据兼容性)
-        if importance >= 4 and res and hasattr(res, 'data') and res.data:
+            print(f"⚠️ 同步 Pinecone 失败 (但已存入 Supabase): {e}")
+
+    for i, row in enumerate(rows):
+        if results[i] is None:
+            log_msg = _memory_log_msg(row)
+            print(log_msg)
+            results[i] = f"{log_msg} | 心情: {row['mood']}"
+    return results
+
+MEMORY_BUFFER_SIZE = 64                                                         # 对齐总结阈值
+MEMORY_BUFFER_RESYNC = float(os.environ.get("MEMORY_BUFFER_RESYNC", "600"))     # 与 Supabase 对账间隔 (秒)
+
+class _RecentMemoryBuffer:
+    """最近记忆环形缓冲 (最近 64 条 + 最近 3 条 Core_Cognition 总结)。
+    启动时从 Supabase 灌入，_save_memory_to_db 的每次写入都会同步进来，定期后台对账；记忆流文本按版本号预渲染。"""
+    def __init__(self, size: int, resync_interval: float):
+        self.recent = deque(maxlen=size)
+        self.summaries = deque(maxlen=3)
+        self.resync_interval = resync_interval
+        self.lock = threading.Lock()
+        self.seed_lock = threading.Lock()
+        self.seeded_at = 0.0
+        self.resyncing = False
+        self.version = 0
+        self.rendered = (-1, "")
+        self.pending_seq = 0
+
+    def _fetch(self):
+        sums = supabase.table("memories").select("*").eq("tags", "Core_Cognition").order("created_at", desc=True).limit(3).execute().data or []
+        recent = supabase.table("memories").select("*").order("created_at", desc=True).limit(self.recent.maxlen).execute().data or []
+        return sums[::-1], recent[::-1]
+
+    @staticmethod
+    def _merge(fetched: list, current, maxlen: int) -> deque:
+        """以数据库为准，再补上比数据库更新 (或还没落库) 的本地条目"""
+        newest = fetched[-1].get('created_at', '') if fetched else ''
+        fetched_ids = {m['id'] for m in fetched}
+        extra = [m for m in current if m['id'] not in fetched_ids and (m.get('_pending') or m.get('created_at', '') > newest)]
+        return deque(sorted(fetched + extra, key=lambda x: x.get('created_at', '')), maxlen=maxlen)
+
+    def seed(self):
+        """从 Supabase 全量灌入/对账 (阻塞调用)"""
+        with self.seed_lock:
             try:
-                # 兼容 res.data 是列表还是单一字典
-                record = res.data[0] if isinstance(res.data, list) else res.data
-                new_id = str(record.get('id', ''))
-                
-                if new_id:
-                    # 生成向量 (合并标题与内容)
-                    vec_new = _get_embedding(f"标题: {title}\n内容: {content}\n心情: {mood}")
-                    if vec_new and isinstance(vec_new, list) and len(vec_new) > 0:
-                        # 简单的房间映射
-                        room_map = {
-                            MemoryType.EMOTION: "Bedroom", 
-                            MemoryType.IDEA: "Study", 
-                            MemoryType.EPISODIC: "Library"
-                        }
-                        target_room = room_map.get(category, "LivingRoom")
-                        
-                        meta_payload = {
-                            "text": content, 
-                            "title": title, 
-                            "date": datetime.datetime.now().isoformat(), 
-                            "mood": mood, 
-                            "room": target_room
-                        }
-                        # 立即写入 Pinecone
-                        index.upsert(vectors=[(new_id, vec_new, meta_payload)])
-                        print(f"⚡ [自动同步] 记忆 {new_id} 已推送到 Pinecone (Room: {target_room})")
+                sums, recent = self._fetch()
             except Exception as e:
-                print(f"⚠️ 同步 Pinecone 失败 (但已存入 Supabase): {e}")
+                print(f"⚠️ 记忆缓冲对账失败: {e}")
+                with self.lock:
+                    self.resyncing = False
+                    if self.seeded_at: self.seeded_at = time.time() - self.resync_interval + 60
+                return
+            with self.lock:
+                self.recent = self._merge(recent, self.recent, self.recent.maxlen)
+                self.summaries = self._merge(sums, self.summaries, self.summaries.maxlen)
+                self.seeded_at = time.time()
+                self.resyncing = False
+                self.version += 1
+
+    def ensure_seeded(self):
+        if not self.seeded_at: self.seed()
+
+    def maybe_resync(self):
+        """过期就在后台对账一次，读路径从不等待"""
+        with self.lock:
+            if self.resyncing or not self.seeded_at or time.time() - self.seeded_at < self.resync_interval: return
+            self.resyncing = True
+        threading.Thread(target=self.seed, name="memory-buffer-resync", daemon=True).start()
+
+    def invalidate(self):
+        """外部批量删改过记忆，下次读取时触发对账"""
+        with self.lock:
+            if self.seeded_at: self.seeded_at = 1.0
+
+    def add_pending(self, data: dict) -> str:
+        """记忆刚入队时先放一条临时记录，保证“写完立刻能读到”，返回临时令牌"""
+        with self.lock:
+            self.pending_seq += 1
+            token = f"pending-{self.pending_seq}"
+            record = dict(data, id=token, hits=0, _pending=True,
+                          created_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+            self.recent.append(record)
+            if data.get("tags") == "Core_Cognition": self.summaries.append(dict(record))
+            self.version += 1
+            return token
+
+    def confirm(self, token: str, record):
+        """落库后用真实记录 (含 id / created_at / 双链注记) 替换临时记录；record 为 None 表示写入失败"""
+        with self.lock:
+            for buf in (self.recent, self.summaries):
+                # 对账时可能已经把真实记录拉进来了，这种情况只删掉临时记录
+                known = record and any(m['id'] == record.get('id') for m in buf)
+                for i, m in enumerate(buf):
+                    if m['id'] == token:
+                        if record and not known: buf[i] = dict(record)
+                        else: del buf[i]
+                        break
+            self.version += 1
+
+    def discard(self, ids):
+        ids = set(ids)
+        with self.lock:
+            self.recent = deque((m for m in self.recent if m['id'] not in ids), maxlen=self.recent.maxlen)
+            self.summaries = deque((m for m in self.summaries if m['id'] not in ids), maxlen=self.summaries.maxlen)
+            self.version += 1
+
+    def latest_created_at(self) -> str:
+        with self.lock:
+            return self.recent[-1].get('created_at', '') if self.recent else ''
+
+    def render_stream(self) -> str:
+        """按 id 去重合并总结与近期记忆，按时间正序渲染成记忆流 (同一版本只渲染一次)"""
+        with self.lock:
+            if self.rendered[0] == self.version: return self.rendered[1]
+            version = self.version
+            all_memories = {m['id']: m for m in list(self.summaries) + list(self.recent)}
+        final_list = sorted(all_memories.values(), key=lambda x: x.get('created_at', ''))
+        text = _render_memory_stream(final_list)
+        with self.lock:
+            if self.version == version: self.rendered = (version, text)
+        return text
+
+_RECENT_MEMORIES = _RecentMemoryBuffer(MEMORY_BUFFER_SIZE, MEMORY_BUFFER_RESYNC)
+
+MEMORY_WRITE_BEHIND = os.environ.get("MEMORY_WRITE_BEHIND", "1") != "0"     # 关掉则退回同步写入
+MEMORY_FLUSH_INTERVAL = float(os.environ.get("MEMORY_FLUSH_INTERVAL", "1.0"))  # 合并窗口 (秒)
+MEMORY_BATCH_MAX = int(os.environ.get("MEMORY_BATCH_MAX", "50"))
+MEMORY_QUEUE_MAX = int(os.environ.get("MEMORY_QUEUE_MAX", "1000"))
+
+def _drop_pending_memory(data: dict):
+    """写入彻底失败：把临时记录从最近记忆缓冲里撤掉，别让 get_latest_diary 继续展示没落库的记忆"""
+    if data.get("_buffer_token"): _RECENT_MEMORIES.confirm(data["_buffer_token"], None)
+
+def _rescue_memory_batch(items: list):
+    """整批写入抛异常后逐条重写一次，仍然失败的撤掉临时记录"""
+    for d in items:
+        try:
+            _write_memory_batch([d])
+        except Exception as e:
+            print(f"❌ 记忆《{d.get('title')}》写入失败，已放弃: {e}")
+            _drop_pending_memory(d)
 
-        log_msg = f"✨ [核心记忆] 已存入: {title}" if importance >= 7 else f"✅ 记忆已归档 [{category}]"
-        print(log_msg)
-        return f"{log_msg} | 心情: {mood}"
+_MEMORY_QUEUE = _WriteBehindQueue("memories", _write_memory_batch, MEMORY_BATCH_MAX, MEMORY_FLUSH_INTERVAL, MEMORY_QUEUE_MAX,
+                                  on_error=_rescue_memory_batch)
+_WRITE_BEHIND_QUEUES.append(_MEMORY_QUEUE)
+
+def _save_memory_to_db(title: str, content: str, category: str, mood: str = "平静", tags: str = "") -> str:
+    """统一记忆存储核心 (引入天然双链机制 + 自动同步向量库)：先入写后队列立即返回，后台批量落库"""
+    data = {}
+    try:
+        data = _prepare_memory(title, content, category, mood, tags)
+        data["_buffer_token"] = _RECENT_MEMORIES.add_pending(data)
+        if MEMORY_WRITE_BEHIND and _MEMORY_QUEUE.put(data):
+            return f"{_memory_log_msg(data)} | 心情: {mood}"
+        return _write_memory_batch([data])[0]
     except Exception as e:
+        _drop_pending_memory(data)
         print(f"❌ _save_memory_to_db 发生未知严重错误: {e}")
         return f"❌ 内部处理失败: {e}"
     
+# 🛰️ GPS 写入流水线：/api/gps 收到就回 200，后台合并批量入库；原地不动的上报只刷新电量/屏幕等状态，不再新增行
+GPS_DEDUP_METERS = float(os.environ.get("GPS_DEDUP_METERS", "60"))          # 离上一条保留点多近算“没动”
+GPS_KEEP_INTERVAL = float(os.environ.get("GPS_KEEP_INTERVAL", "900"))      # 没动也至少隔这么久留一条轨迹点 (秒)
+GPS_FLUSH_INTERVAL = float(os.environ.get("GPS_FLUSH_INTERVAL", "2.0"))
+GPS_BATCH_MAX = int(os.environ.get("GPS_BATCH_MAX", "50"))
+GPS_QUEUE_MAX = int(os.environ.get("GPS_QUEUE_MAX", "2000"))
+
+def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """两点球面距离 (米)"""
+    r = 6371000.0
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * r * math.asin(math.sqrt(a))
+
+def _parse_gps_report(data: dict) -> dict:
+    """把手机上报的原始 JSON 整理成 {lat, lon, raw_address, remark, reported_at}"""
+    stats = []
+    if "battery" in data: stats.append(f"🔋 {data['battery']}%" + ("⚡" if str(data.get("charging")).lower() in ["true","1"] else ""))
+    if "screen" in data: stats.append(f"💡 {data['screen']}")   
+    if "app" in data and data["app"]: stats.append(f"📱 {data['app']}")      
+    if "volume" in data: stats.append(f"🔊 {data['volume']}%") 
+    if "wifi" in data and data["wifi"]: stats.append(f"📶 {data['wifi']}")
+    if "activity" in data and data["activity"]: stats.append(f"🏃 {data['activity']}")
+
+    addr = data.get("address", "")
+    coords = re.findall(r'-?\d+\.\d+', str(addr))
+    lat_val, lon_val = (coords[-2], coords[-1]) if len(coords) >= 2 else (None, None)
+    return {"lat": lat_val, "lon": lon_val, "raw_address": str(addr), "remark": " | ".join(stats) or "自动更新", "reported_at": time.time()}
+
+class _GpsIngestor:
+    """按批处理 GPS 上报：和上一条保留点比距离/时间，没动就把最新状态合并进那一行，动了 (或隔太久) 才新增一行"""
+    def __init__(self):
+        self.last = None      # 上一条保留点 {"id", "lat", "lon", "raw_address", "kept_at", "row"}
+        self.seeded = False
+        self.lock = threading.Lock()
+        self.stats = {"reports": 0, "inserted": 0, "merged": 0}
+
+    def _seed(self):
+        """冷启动时拿数据库里最新一条当“上一条保留点”，避免重启后第一条重复入库"""
+        if self.seeded: return
+        self.seeded = True
+        try:
+            rec = _fetch_latest_gps_row()
+        except Exception as e:
+            print(f"⚠️ GPS 去重基准加载失败: {e}")
+            return
+        if not rec: return
+        try:
+            kept_at = datetime.datetime.fromisoformat(str(rec.get("created_at")).replace('Z', '+00:00')).timestamp()
+        except Exception:
+            kept_at = 0.0
+        self.last = {"id": rec.get("id"), "lat": rec.get("lat"), "lon": rec.get("lon"), "raw_address": None,
+                     "kept_at": kept_at, "row": {"address": rec.get("address"), "remark": rec.get("remark")}}
+
+    def _stationary(self, rep: dict) -> bool:
+        last = self.last
+        if not last or rep["reported_at"] - last["kept_at"] > GPS_KEEP_INTERVAL: return False
+        if rep["lat"] is not None and last["lat"] is not None:
+            try:
+                return _haversine_m(float(rep["lat"]), float(rep["lon"]), float(last["lat"]), float(last["lon"])) <= GPS_DEDUP_METERS
+            except (TypeError, ValueError):
+                return False
+        # 没有坐标的上报只能比原始地址文本
+        return rep["lat"] is None and last["lat"] is None and rep["raw_address"] == last["raw_address"]
+
+    def process(self, reports: list):
+        with self.lock:
+            self._seed()
+            new_rows, merge_into = [], None
+            for rep in reports:
+                self.stats["reports"] += 1
+                if self._stationary(rep):
+                    # 原地不动：最新电量/屏幕/App 状态覆盖进上一条保留点
+                    self.last["row"]["remark"] = rep["remark"]
+                    if self.last["id"] is not None: merge_into = self.last
+                    self.stats["merged"] += 1
+                    continue
+                if rep["lat"] is not None:
+                    row = {"address": f"📍 {_gps_to_address(rep['lat'], rep['lon'])}", "remark": rep["remark"], "lat": rep["lat"], "lon": rep["lon"]}
+                    _LATEST_LOCATION.refine_address(rep["lat"], rep["lon"], row["address"])
+                else:
+                    row = {"address": f"⚠️ {rep['raw_address']}", "remark": rep["remark"]}
+                new_rows.append(row)
+                self.last = {"id": None, "lat": rep["lat"], "lon": rep["lon"], "raw_address": rep["raw_address"],
+                             "kept_at": rep["reported_at"], "row": row}
+
+            if merge_into is not None:
+                supabase.table("gps_history").update({"remark": merge_into["row"]["remark"]}).eq("id", merge_into["id"]).execute()
+            if new_rows:
+                self._insert(new_rows)
+
+    def _insert(self, rows: list):
+        """批量插入；整批失败就逐条重试，尽量不丢轨迹点"""
+        try:
+            res = supabase.table("gps_history").insert(rows).execute()
+            inserted = res.data or []
+        except Exception as e:
+            print(f"⚠️ GPS 批量写入失败，改为逐条写入: {e}")
+            inserted = []
+            for row in rows:
+                try:
+                    inserted.extend(supabase.table("gps_history").insert(row).execute().data or [])
+                except Exception as row_e:
+                    print(f"❌ GPS 单条写入失败: {row_e}")
+        self.stats["inserted"] += len(inserted)
+        # 回填最后一条保留点的 id，后续原地上报就能直接 update 它
+        if not self.last or self.last["row"] is not rows[-1]: return
+        if inserted and len(inserted) == len(rows):
+            self.last["id"] = inserted[-1].get("id")
+        else:
+            # 部分写失败，不知道最后一条保留点落没落库：回库里重新拿基准，免得之后的原地合并全被丢掉
+            self.last, self.seeded = None, False
+            self._seed()
+
+_GPS_INGEST = _GpsIngestor()
+_GPS_QUEUE = _WriteBehindQueue("gps", _GPS_INGEST.process, GPS_BATCH_MAX, GPS_FLUSH_INTERVAL, GPS_QUEUE_MAX)
+_WRITE_BEHIND_QUEUES.append(_GPS_QUEUE)
+
 def _format_time_cn(iso_str: str) -> str:
     """UTC -> 北京时间"""
     if not iso_str: return "未知时间"
@@ -236,59 +1546,275 @@ def _send_email_helper(subject: str, content: str, is_html: bool = False) -> str
             "from": "onboarding@resend.dev", "to": [MY_EMAIL],
             "subject": subject, "html" if is_html else "text": content
         }
-        requests.post("https://api.resend.com/emails", headers={"Authorization": f"Bearer {RESEND_KEY}"}, json=payload)
+        _http_post("https://api.resend.com/emails", headers={"Authorization": f"Bearer {RESEND_KEY}"}, json=payload)
         return "✅ 邮件已发送"
     except Exception as e: return f"❌ 发送失败: {e}"
 
+# 🧬 向量化配置 (批量打包 + 按体积切块)
+EMBED_URL = "https://ark.cn-beijing.volces.com/api/v3/embeddings/multimodal"
+EMBED_BATCH_MAX_ITEMS = int(os.environ.get("EMBED_BATCH_MAX_ITEMS", "32"))     # 每个请求最多打包多少条
+EMBED_BATCH_MAX_CHARS = int(os.environ.get("EMBED_BATCH_MAX_CHARS", "24000"))  # 每个请求的总字数上限
+EMBED_MAX_WORKERS = int(os.environ.get("EMBED_MAX_WORKERS", "4"))             # 同时在飞的请求数
+
+# 多模态端点会把同一请求里的多条 input 融合成一个向量；一旦探测到，就退化为单条请求并发
+_EMBED_FUSED_INPUT = False
+_EMBED_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS, thread_name_prefix="embed")
+
+EMBED_CACHE_MEM_ITEMS = int(os.environ.get("EMBED_CACHE_MEM_ITEMS", "2048"))     # 内存 LRU 容量
+EMBED_CACHE_DISK_ITEMS = int(os.environ.get("EMBED_CACHE_DISK_ITEMS", "200000"))  # 磁盘层容量 (启动时修剪)
+
+class _EmbeddingCache:
+    """两级向量缓存：内存 LRU + 本地 SQLite。键 = sha256(端点 + 文本)，同样的文本永远只花一次网络请求"""
+    def __init__(self, mem_items: int, disk_items: int):
+        self.mem_items = mem_items
+        self.disk_items = disk_items
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+        self.disk_ready = False
+
+    @staticmethod
+    def key(embed_endpoint: str, text: str) -> str:
+        return hashlib.sha256(f"{EMBED_URL}|{embed_endpoint}\0{text}".encode("utf-8")).hexdigest()
+
+    def _ensure_disk(self):
+        if self.disk_ready: return
+        self.disk_ready = True
+        _local_db_write("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB, created_at REAL)")
+        # 超出容量就按写入时间淘汰最旧的
+        _local_db_write(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_items,)
+        )
+
+    def _remember(self, key: str, vec: list):
+        self.lru[key] = vec
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.mem_items:
+            self.lru.popitem(last=False)
+
+    def get_many(self, keys: list) -> dict:
+        """批量读取，返回命中的 {key: 向量}"""
+        found, missing = {}, []
+        with self.lock:
+            for k in keys:
+                if k in self.lru:
+                    self.lru.move_to_end(k)
+                    found[k] = self.lru[k]
+                else:
+                    missing.append(k)
+            self.stats["mem_hits"] += len(found)
+
+        if missing:
+            self._ensure_disk()
+            for i in range(0, len(missing), 500):
+                part = missing[i:i + 500]
+                rows = _local_db_query(f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part)
+                for k, blob in rows:
+                    vec = array("f")
+                    vec.frombytes(blob)
+                    found[k] = vec.tolist()
+            with self.lock:
+                for k in missing:
+                    if k in found:
+                        self._remember(k, found[k])
+                        self.stats["disk_hits"] += 1
+                    else:
+                        self.stats["misses"] += 1
+        return found
+
+    def put_many(self, items: dict):
+        """写入成功拿到的向量 (空向量不缓存)"""
+        items = {k: v for k, v in items.items() if v}
+        if not items: return
+        with self.lock:
+            for k, v in items.items(): self._remember(k, v)
+            self.stats["writes"] += len(items)
+        self._ensure_disk()
+        now = time.time()
+        _local_db_write(
+            "INSERT OR REPLACE INTO embeddings (key, vec, created_at) VALUES (?, ?, ?)",
+            [(k, array("f", v).tobytes(), now) for k, v in items.items()], many=True
+        )
+
+    def hit_rate(self) -> float:
+        hits = self.stats["mem_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return round(hits / total, 3) if total else 0.0
+
+_EMBED_CACHE = _EmbeddingCache(EMBED_CACHE_MEM_ITEMS, EMBED_CACHE_DISK_ITEMS)
+
+def _embedding_config():
+    """读取豆包 Embedding 的密钥和接入点，缺一个就返回 None"""
+    api_key = os.environ.get("DOUBAO_API_KEY", "").strip()
+    embed_endpoint = os.environ.get("DOUBAO_EMBEDDING_EP", "").strip()
+    if not api_key or not embed_endpoint: return None
+    return api_key, embed_endpoint
+
+def _parse_embedding_response(data) -> list:
+    """兼容 data 为列表 / 单一字典 / 顶层 embedding 三种返回格式，统一成向量列表"""
+    items = []
+    if "data" in data:
+        if isinstance(data["data"], list):
+            items = sorted(data["data"], key=lambda x: x.get("index", 0))
+        elif isinstance(data["data"], dict):
+            items = [data["data"]]
+    elif "embedding" in data:
+        items = [data]
+    return [[float(x) for x in (item.get("embedding") or [])] for item in items]
+
+def _request_embeddings(texts: list, api_key: str, embed_endpoint: str):
+    """发一次请求，返回 (向量列表, 状态)；状态为 ok / bad_input / fused / error"""
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": embed_endpoint,
+        "input": [{"type": "text", "text": t} for t in texts]
+    }
+    try:
+        response = _http_post(EMBED_URL, policy="idempotent", json=payload, headers=headers, timeout=10)
+        if response.status_code != 200:
+            # 4xx 多半是某一条文本有问题 (超长/非法字符)，值得拆开重试；其余错误直接放弃
+            input_error = 400 <= response.status_code < 500 and response.status_code not in (401, 403, 429)
+            return [], "bad_input" if input_error else "error"
+        vectors = _parse_embedding_response(response.json())
+    except Exception as e:
+        print(f"⚠️ Embedding 请求失败 ({len(texts)} 条): {e}")
+        return [], "error"
+
+    if len(vectors) == len(texts): return vectors, "ok"
+    if len(texts) > 1 and len(vectors) == 1: return [], "fused"
+    return [], "error"
+
+def _chunk_texts(texts: list) -> list:
+    """按条数和总字数把文本切成若干请求块，超长的单条自成一块"""
+    chunks, current, current_chars = [], [], 0
+    for t in texts:
+        if current and (len(current) >= EMBED_BATCH_MAX_ITEMS or current_chars + len(t) > EMBED_BATCH_MAX_CHARS):
+            chunks.append(current)
+            current, current_chars = [], 0
+        current.append(t)
+        current_chars += len(t)
+    if current: chunks.append(current)
+    return chunks
+
+def _embed_chunk(texts: list, api_key: str, embed_endpoint: str):
+    """处理一个请求块；块内部分失败时二分拆开重试，只让坏掉的那条拿到空向量。端点融合输入时返回 None"""
+    global _EMBED_FUSED_INPUT
+    if len(texts) > 1 and _EMBED_FUSED_INPUT: return None
+
+    vectors, status = _request_embeddings(texts, api_key, embed_endpoint)
+    if status == "ok": return vectors
+    if status == "fused":
+        print("⚠️ Embedding 端点会融合多条输入，已切换为单条并发模式")
+        _EMBED_FUSED_INPUT = True
+        return None
+    if status == "bad_input" and len(texts) > 1:
+        mid = len(texts) // 2
+        left = _embed_chunk(texts[:mid], api_key, embed_endpoint)
+        right = _embed_chunk(texts[mid:], api_key, embed_endpoint)
+        if left is None or right is None: return None
+        return left + right
+    return [[] for _ in texts]
+
+def _get_embeddings_batch(texts: list) -> list:
+    """批量向量化：去重 -> 按体积切块 -> 并发请求，返回与输入一一对应的向量 (失败的位置为空列表)"""
+    if not texts: return []
+    config = _embedding_config()
+    if not config: return [[] for _ in texts]
+    api_key, embed_endpoint = config
+
+    def _run(chunk): return _embed_chunk(chunk, api_key, embed_endpoint)
+    def _run_all(chunks):
+        if len(chunks) == 1: return [_run(chunks[0])]
+        ctxs = [contextvars.copy_context() for _ in chunks]   # 每块一份上下文副本，span 挂回当前链路
+        return list(_EMBED_POOL.map(lambda pair: pair[0].run(_run, pair[1]), zip(ctxs, chunks)))
+
+    # 先查缓存，只有没见过的文本才走网络
+    keys = {t: _EmbeddingCache.key(embed_endpoint, t) for t in dict.fromkeys(texts)}
+    cached = _EMBED_CACHE.get_many(list(keys.values()))
+    vec_map = {t: cached[k] for t, k in keys.items() if k in cached}
+    unique_texts = [t for t in keys if t not in vec_map]
+    if not unique_texts: return [vec_map[t] for t in texts]
+
+    chunks = [[t] for t in unique_texts] if _EMBED_FUSED_INPUT else _chunk_texts(unique_texts)
+    results = _run_all(chunks)
+
+    # 端点融合了多条输入：把没拿到结果的块拆成单条重跑
+    redo = [t for chunk, vectors in zip(chunks, results) if vectors is None for t in chunk]
+    if redo:
+        redo_chunks = [[t] for t in redo]
+        chunks += redo_chunks
+        results += _run_all(redo_chunks)
+
+    fresh = {}
+    for chunk, vectors in zip(chunks, results):
+        if vectors is not None: fresh.update(zip(chunk, vectors))
+    _EMBED_CACHE.put_many({keys[t]: v for t, v in fresh.items()})
+    vec_map.update(fresh)
+    return [vec_map.get(t, []) for t in texts]
+
 def _get_embedding(text: str):
-    """调用火山引擎(豆包官方)多模态 Vision Embedding API"""
+    """调用火山引擎(豆包官方)多模态 Vision Embedding API (单条版，内部走批量通道)"""
     try:
-        api_key = os.environ.get("DOUBAO_API_KEY", "").strip()
-        if not api_key: return []
-            
-        embed_endpoint = os.environ.get("DOUBAO_EMBEDDING_EP", "").strip()
-        if not embed_endpoint: return []
-        
-        url = "https://ark.cn-beijing.volces.com/api/v3/embeddings/multimodal"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": embed_endpoint,
-            "input": [{"type": "text", "text": text}]
-        }
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        if response.status_code != 200: return []
-            
-        data = response.json()
-        
-        try:
-            raw_vec = []
-            if "data" in data:
-                if isinstance(data["data"], list) and len(data["data"]) > 0:
-                    raw_vec = data["data"][0].get("embedding", [])
-                elif isinstance(data["data"], dict):
-                    raw_vec = data["data"].get("embedding", [])
-            elif "embedding" in data:
-                raw_vec = data["embedding"]
-            
-            if raw_vec: return [float(x) for x in raw_vec]
-            return []
-            
-        except Exception: return []
-            
-    except Exception as e: return []
+        return _get_embeddings_batch([text])[0]
+    except Exception: return []
     
+USER_FACTS_TTL = float(os.environ.get("USER_FACTS_TTL", "600"))  # 画像缓存有效期 (秒)
+
+class _UserFactsCache:
+    """user_facts 全表快照缓存：过期才整表回源一次，写入走 write-through，稳态读取零往返"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.facts = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "reloads": 0}
+
+    def _reload(self):
+        res = supabase.table("user_facts").select("key, value").execute()
+        self.facts = {r['key']: r['value'] for r in (res.data or [])}
+        self.loaded_at = time.time()
+        self.stats["reloads"] += 1
+
+    def all(self) -> dict:
+        """返回全部画像 {key: value} 的副本"""
+        with self.lock:
+            if self.facts is not None and time.time() - self.loaded_at < self.ttl:
+                self.stats["hits"] += 1
+                return dict(self.facts)
+            try:
+                self._reload()
+            except Exception as e:
+                if self.facts is None: raise
+                # 回源失败先用旧快照顶着，30 秒后再试
+                print(f"⚠️ 画像缓存刷新失败，继续使用旧数据: {e}")
+                self.loaded_at = time.time() - self.ttl + 30
+            return dict(self.facts)
+
+    def get(self, key: str, default=None):
+        return self.all().get(key, default)
+
+    def set(self, key: str, value: str):
+        """写穿透：先落库，成功后同步更新本地快照"""
+        supabase.table("user_facts").upsert({"key": key, "value": value, "confidence": 1.0}, on_conflict="key").execute()
+        with self.lock:
+            if self.facts is not None:
+                self.facts[key] = value
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = 0.0
+
+_USER_FACTS = _UserFactsCache(USER_FACTS_TTL)
+
 def _get_current_persona() -> str:
     base_persona = DEFAULT_PERSONA
     try:
-        # 从数据库获取动态进化的人设
-        res = supabase.table("user_facts").select("value").eq("key", "sys_ai_persona").execute()
-        if res.data:
-            base_persona = res.data[0]['value']
+        # 从画像缓存获取动态进化的人设
+        base_persona = _USER_FACTS.get("sys_ai_persona") or DEFAULT_PERSONA
     except:
         pass
         
@@ -300,76 +1826,325 @@ def _get_current_persona() -> str:
 
 def _get_silence_duration() -> float:
     try:
-        res = supabase.table("memories").select("created_at").order("created_at", desc=True).limit(1).execute()
-        if not res.data: return 999.0 
-        last_time_str = res.data[0]['created_at']
+        _RECENT_MEMORIES.ensure_seeded()
+        last_time_str = _RECENT_MEMORIES.latest_created_at()
+        if not last_time_str: return 999.0 
         last_time = datetime.datetime.fromisoformat(last_time_str.replace('Z', '+00:00'))
         now = datetime.datetime.now(datetime.timezone.utc)
         delta = now - last_time
         return round(delta.total_seconds() / 3600.0, 1)
     except Exception: return 0.0
 
+_HTML_MEME_REPO_JSON = json.dumps(
+    {k: f'<img src="{v}" width="150" style="max-width: 150px; border-radius: 10px; display: block;" />' for k, v in RAW_MEME_REPO.items()},
+    ensure_ascii=False
+)
+
+def _render_memory_stream(final_list: list) -> str:
+    memory_stream = "📋 【全息记忆流】:\n"
+    if not final_list: 
+        memory_stream += "📭 大脑一片空白。\n"
+    else:
+        for data in final_list:
+            time_str = _format_time_cn(data.get('created_at'))
+            cat = data.get('category', '未知')
+            title = data.get('title', '无题')
+            imp = data.get('importance', 0)
+            hits = data.get('hits', 0) or 0
+            mood = data.get('mood', '')
+            
+            icon = "🔹"
+            if imp >= 9: icon = "🌟"
+            elif hits >= 5: icon = "🔥"
+            elif imp >= 4: icon = "🔸"
+            
+            meta_info = []
+            if mood and mood != "平静": meta_info.append(f"Mood:{mood}")
+            if hits > 0: meta_info.append(f"Hits:{hits}")
+            meta_str = f" | {' '.join(meta_info)}" if meta_info else ""
+            
+            memory_stream += f"{time_str} {icon}[{cat}]: {title}{meta_str}\n   └─ {data.get('content', '')}\n"
+    return memory_stream
+
+# 🧵 后台任务队列：有界工作线程 + 优先级 + 失败退避重试 + 延时执行 + 本地 SQLite 持久化 (重启后接着跑)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))                    # 后台工作线程数
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", "2000"))             # 队列容量上限 (含延时任务)
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "4"))          # 默认最多尝试次数
+JOB_RETRY_BASE = float(os.environ.get("JOB_RETRY_BASE", "2"))            # 首次重试等待秒数，之后指数翻倍
+JOB_RETRY_MAX = float(os.environ.get("JOB_RETRY_MAX", "300"))            # 单次重试等待上限
+JOB_PERSIST = os.environ.get("JOB_PERSIST", "1") != "0"                 # 是否落本地库 (CACHE_DIR 需挂持久盘才能跨重新部署)
+JOB_DEAD_RETENTION = float(os.environ.get("JOB_DEAD_RETENTION", str(7 * 86400)))  # 彻底失败的任务留档多久 (秒)
+
+class _JobQueue:
+    """通用后台任务队列。任务 = 已注册的处理函数名 + JSON 参数；
+    就绪任务按优先级 (数字越小越先) 执行，延时/重试任务按到点时间排队，durable 任务写入本地 jobs 表，启动时恢复。"""
+    def __init__(self, name: str, workers: int, maxsize: int):
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.handlers = {}
+        self.ready = []     # (priority, seq, job)
+        self.delayed = []   # (run_at, seq, job)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.threads = []
+        self.start_lock = threading.Lock()
+        self.started = False
+        self.stats = {"submitted": 0, "done": 0, "retried": 0, "failed": 0, "rejected": 0, "restored": 0}
+
+    def register(self, kind: str, fn):
+        self.handlers[kind] = fn
+        return fn
+
+    def _count(self, key: str):
+        # 计数会被多个 worker 线程同时改，和队列共用同一把锁
+        with self.cond:
+            self.stats[key] += 1
+
+    def _persist(self, job: dict):
+        if not (JOB_PERSIST and job.get("durable")): return
+        _local_db_write(
+            "INSERT OR REPLACE INTO jobs (id, kind, payload, priority, run_at, attempts, max_attempts, status, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job["id"], job["kind"], json.dumps(job["payload"], ensure_ascii=False), job["priority"], job["run_at"],
+             job["attempts"], job["max_attempts"], job.get("status", "pending"), job.get("error", ""))
+        )
+
+    def _forget(self, job: dict):
+        if JOB_PERSIST and job.get("durable"): _local_db_write("DELETE FROM jobs WHERE id = ?", (job["id"],))
+
+    def _restore(self):
+        """把上次进程没跑完的 durable 任务捞回来"""
+        if not JOB_PERSIST: return
+        _local_db_write("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, payload TEXT, priority INTEGER, run_at REAL, attempts INTEGER, max_attempts INTEGER, status TEXT, error TEXT)")
+        _local_db_write("DELETE FROM jobs WHERE status = 'dead' AND run_at < ?", (time.time() - JOB_DEAD_RETENTION,))
+        rows = _local_db_query("SELECT id, kind, payload, priority, run_at, attempts, max_attempts FROM jobs WHERE status = 'pending'")
+        for r_id, kind, payload, priority, run_at, attempts, max_attempts in rows:
+            try:
+                job = {"id": r_id, "kind": kind, "payload": json.loads(payload), "priority": priority, "run_at": run_at,
+                       "attempts": attempts, "max_attempts": max_attempts, "durable": True}
+            except Exception:
+                continue
+            self._push(job)
+            self._count("restored")
+        if rows: print(f"♻️ [{self.name}] 恢复了 {len(rows)} 个未完成的后台任务")
+
+    def _ensure_started(self):
+        """首次使用时建表、恢复旧任务、拉起工作线程；恢复完成前并发的 submit 都在这里等着，不会抢先落库或被恢复两次"""
+        if self.started: return
+        with self.start_lock:
+            if self.started: return
+            self._restore()
+            self.threads = [threading.Thread(target=self._run, name=f"job-{self.name}-{i}", daemon=True) for i in range(self.workers)]
+            for t in self.threads: t.start()
+            self.started = True
+
+    def _push(self, job: dict):
+        """(内部) 按是否到点放进就绪堆或延时堆"""
+        with self.cond:
+            self.seq += 1
+            if job["run_at"] <= time.time(): heapq.heappush(self.ready, (job["priority"], self.seq, job))
+            else: heapq.heappush(self.delayed, (job["run_at"], self.seq, job))
+            self.cond.notify()
+
+    def submit(self, kind: str, payload: dict = None, priority: int = 5, delay: float = 0,
+               max_attempts: int = None, durable: bool = True):
+        """提交任务，返回任务 id；处理函数未注册或队列已满返回 None，由调用方决定如何兜底"""
+        if kind not in self.handlers:
+            print(f"⚠️ [{self.name}] 未注册的任务类型: {kind}")
+            return None
+        self._ensure_started()
+        with self.cond:
+            if len(self.ready) + len(self.delayed) >= self.maxsize:
+                self.stats["rejected"] += 1
+                print(f"⚠️ [{self.name}] 队列已满 ({self.maxsize})，拒绝任务 {kind}")
+                return None
+            self.seq += 1
+            job_id = f"J{int(time.time() * 1000)}-{self.seq}"
+        job = {"id": job_id, "kind": kind, "payload": payload or {}, "priority": priority,
+               "run_at": time.time() + max(delay, 0), "attempts": 0,
+               "max_attempts": max_attempts or JOB_MAX_ATTEMPTS, "durable": durable,
+               "ctx": contextvars.copy_context()}   # 只在内存里，让任务的 span 挂回提交它的链路
+        self._persist(job)
+        self._push(job)
+        self._count("submitted")
+        return job_id
+
+    def _next_job(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, seq, job = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (job["priority"], seq, job))
+                if self.ready: return heapq.heappop(self.ready)[2]
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                self.cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            job["attempts"] += 1
+            def _handle():
+                with _Span(f"job.{job['kind']}", "job", attempt=job["attempts"]):
+                    self.handlers[job["kind"]](**job["payload"])
+            try:
+                ctx = job.get("ctx")
+                if ctx is not None: ctx.copy().run(_handle)
+                else: _handle()
+                self._count("done")
+                self._forget(job)
+            except Exception as e:
+                job["error"] = str(e)[:500]
+                if job["attempts"] >= job["max_attempts"]:
+                    self._count("failed")
+                    job["status"] = "dead"
+                    self._persist(job)
+                    print(f"❌ [{self.name}] 任务 {job['kind']} 重试 {job['attempts']} 次仍失败，放弃: {e}")
+                    continue
+                backoff = min(JOB_RETRY_BASE * (2 ** (job["attempts"] - 1)), JOB_RETRY_MAX) * random.uniform(0.8, 1.2)
+                job["run_at"] = time.time() + backoff
+                self._count("retried")
+                self._persist(job)
+                self._push(job)
+                print(f"🔁 [{self.name}] 任务 {job['kind']} 失败，{backoff:.1f}s 后第 {job['attempts'] + 1} 次重试: {e}")
+
+    def depth(self) -> dict:
+        with self.cond:
+            return {"ready": len(self.ready), "delayed": len(self.delayed)}
+
+_JOBS = _JobQueue("jobs", JOB_WORKERS, JOB_QUEUE_MAX)
+
+def _job_push_wechat(content: str, title: str = "来自老公的突然关心 🔔"):
+    """推送失败要抛出来才能触发重试"""
+    resp = _push_wechat(content, title)
+    if str(resp).startswith("❌"): raise RuntimeError(resp)
+
+def _job_update_hits(ids: list):
+    for i in ids:
+        try: supabase.rpc("increment_hits", {"row_id": str(i)}).execute()
+        except: pass
+
+def _job_save_memory(title: str, content: str, category: str, mood: str = "平静", tags: str = ""):
+    # 任务里直接同步落库，不走写后队列：入队总是立刻回 ✅，写失败时任务的重试/死信就永远触发不了
+    data = _prepare_memory(title, content, category, mood, tags)
+    data["_buffer_token"] = _RECENT_MEMORIES.add_pending(data)
+    try:
+        resp = _write_memory_batch([data])[0]
+    except Exception:
+        _drop_pending_memory(data)
+        raise
+    if str(resp).startswith("❌"): raise RuntimeError(resp)
+
+_JOBS.register("push_wechat", _job_push_wechat)
+_JOBS.register("update_hits", _job_update_hits)
+_JOBS.register("save_memory", _job_save_memory)
+
+# 🏪 周边 POI 缓存：按 geohash 格子 + 关键词缓存高德结果，距离按当前坐标重算；换到新格子时按常用关键词后台预取
+AMAP_API_KEY = os.environ.get("AMAP_API_KEY", "435041ed0364264c810784e5468b3329")
+POI_PRECISION = int(os.environ.get("POI_PRECISION", "6"))          # 6 位约 1.2km x 0.6km，搜索半径 3km 足够覆盖
+POI_TTL = float(os.environ.get("POI_TTL", "86400"))
+POI_MISS_TTL = float(os.environ.get("POI_MISS_TTL", "3600"))       # 没搜到的也记一会儿
+POI_PREFETCH = os.environ.get("POI_PREFETCH", "1") == "1"
+POI_PREFETCH_TOP = int(os.environ.get("POI_PREFETCH_TOP", "3"))    # 换格子时预取最常问的几个关键词
+POI_DEFAULT_KEYWORDS = ["便利店", "奶茶", "药店"]
+
+class _NearbyPoi:
+    """高德周边搜索的缓存层 + 关键词热度统计 (落 kv_state，重启后仍知道她常搜什么)"""
+    def __init__(self):
+        self.cache = _TTLCache("poi", POI_TTL, max_items=1024, persist=True)
+        self.flight = _SingleFlight("poi")
+        self.lock = threading.Lock()
+        self.counts = None
+        self.last_cell = None
+        self.stats = {"prefetches": 0}
+
+    def search(self, lat: float, lon: float, query: str) -> list:
+        """返回附近的 POI 列表 (按离当前坐标的距离排序)，同一格子 + 关键词命中缓存就不外呼"""
+        key = f"{_geohash(lat, lon, POI_PRECISION)}:{query}"
+        pois = self.cache.get(key)
+        if pois is None: pois = self.flight.do(key, lambda: self._load(key, lat, lon, query))
+        return self._with_distance(pois, lat, lon)
+
+    def _load(self, key: str, lat: float, lon: float, query: str) -> list:
+        url = f"https://restapi.amap.com/v3/place/around?key={AMAP_API_KEY}&location={lon},{lat}&keywords={query}&radius=3000&offset=5&page=1&extensions=base"
+        res = _http_get(url, timeout=5).json()
+        if res.get("status") != "1": return []   # 接口报错不缓存，下次再试
+        pois = [{k: item[k] for k in ("name", "address", "distance", "location") if k in item} for item in res.get("pois") or []]
+        self.cache.set(key, pois, ttl=None if pois else POI_MISS_TTL)
+        return pois
+
+    @staticmethod
+    def _with_distance(pois: list, lat: float, lon: float) -> list:
+        out = []
+        for item in pois:
+            item = dict(item)
+            try:
+                p_lon, p_lat = (float(x) for x in str(item.get("location") or "").split(","))
+                item["distance"] = str(int(_haversine_m(lat, lon, p_lat, p_lon)))
+            except ValueError:
+                pass
+            out.append(item)
+        out.sort(key=lambda it: int(it["distance"]) if str(it.get("distance")).isdigit() else float("inf"))
+        return out
+
+    def _ensure_counts(self):
+        if self.counts is None: self.counts = dict(_local_kv_get("poi_keyword_counts", {}) or {})
+
+    def note_keyword(self, query: str):
+        with self.lock:
+            self._ensure_counts()
+            self.counts[query] = self.counts.get(query, 0) + 1
+            snapshot = dict(self.counts)
+        _local_kv_set("poi_keyword_counts", snapshot)
+
+    def top_keywords(self, n: int) -> list:
+        with self.lock:
+            self._ensure_counts()
+            ranked = sorted(self.counts, key=lambda k: -self.counts[k])
+        for kw in POI_DEFAULT_KEYWORDS:
+            if kw not in ranked: ranked.append(kw)
+        return ranked[:n]
+
+    def on_location(self, lat, lon):
+        """位置上报时调用 (在线程池里)：进了新格子就提交一个后台预取任务"""
+        if not POI_PREFETCH or lat is None: return
+        lat_f, lon_f = _poi_point(lat, lon)
+        cell = _geohash(lat_f, lon_f, POI_PRECISION)
+        with self.lock:
+            if cell == self.last_cell: return
+            self.last_cell = cell
+        _JOBS.submit("prefetch_poi", {"lat": lat_f, "lon": lon_f}, priority=8, max_attempts=1, durable=False)
+
+    def prefetch(self, lat: float, lon: float):
+        for kw in self.top_keywords(POI_PREFETCH_TOP):
+            self.search(lat, lon, kw)
+        self.stats["prefetches"] += 1
+
+def _poi_point(lat, lon):
+    """转成浮点坐标 (兼容经纬度写反的旧数据)"""
+    lat_f, lon_f = float(lat), float(lon)
+    if lat_f > 80: lat_f, lon_f = lon_f, lat_f
+    return lat_f, lon_f
+
+_NEARBY_POI = _NearbyPoi()
+_JOBS.register("prefetch_poi", _NEARBY_POI.prefetch)
+_JOBS.register("note_poi_keyword", _NEARBY_POI.note_keyword)
+
 # ==========================================
 # 3. 🛠️ MCP 工具集 (全面异步化改造)
 # ==========================================
-@mcp.tool()
+@_tool()
 async def get_latest_diary(run_mode: str = "auto"):
     """【核心大脑】精准混合记忆流 (包含核心记忆总结 + 双向互动 + 核心分类)"""
-    base_style = 'width="150" style="max-width: 150px; border-radius: 10px; display: block;"'
-    html_meme_repo = {k: f'<img src="{v}" {base_style} />' for k, v in RAW_MEME_REPO.items()}
-
     try:
-        # 1. 查询最新 3 条“记忆总结” (代表前两日+今日产生的 Core_Cognition 核心回溯或Rikkahub总结)
-        def _fetch_summaries():
-            return supabase.table("memories").select("*").eq("tags", "Core_Cognition").order("created_at", desc=True).limit(3).execute()
-            
-        # 2. 不再分类，直接暴力拉取最近的 64 条所有记忆 (刚好对齐总结阈值，包含所有未总结的对话)
-        def _fetch_recent_all():
-            return supabase.table("memories").select("*").order("created_at", desc=True).limit(64).execute()
-        t_sum = asyncio.to_thread(_fetch_summaries)
-        t_recent = asyncio.to_thread(_fetch_recent_all)
-        t_silence = asyncio.to_thread(_get_silence_duration)
-
-        res_sum, res_recent, silence = await asyncio.gather(
-            t_sum, t_recent, t_silence
-        )
+        # 最近 64 条记忆 + 最新 3 条 Core_Cognition 总结都在进程内环形缓冲里，只有冷启动第一次需要回源
+        if not _RECENT_MEMORIES.seeded_at:
+            await _run_blocking("db", _RECENT_MEMORIES.ensure_seeded)
+            if not _RECENT_MEMORIES.seeded_at: return "❌ 读取记忆流失败: 数据库暂时连不上"
+        _RECENT_MEMORIES.maybe_resync()
 
-        # 使用字典按 id 去重合并 (防止最近10条里恰好包含了刚生成的总结，自动去重)
-        all_memories = {}
-        def _merge(dataset):
-            if dataset:
-                for m in dataset: 
-                    all_memories[m['id']] = m
-
-        _merge(res_sum.data)
-        _merge(res_recent.data)
-
-        # 按时间戳正序排列，确保上下文从旧到新连贯
-        final_list = sorted(all_memories.values(), key=lambda x: x['created_at'])
-        
-        memory_stream = "📋 【全息记忆流】:\n"
-        if not final_list: 
-            memory_stream += "📭 大脑一片空白。\n"
-        else:
-            for data in final_list:
-                time_str = _format_time_cn(data.get('created_at'))
-                cat = data.get('category', '未知')
-                title = data.get('title', '无题')
-                imp = data.get('importance', 0)
-                hits = data.get('hits', 0)
-                mood = data.get('mood', '')
-                
-                icon = "🔹"
-                if imp >= 9: icon = "🌟"
-                elif hits >= 5: icon = "🔥"
-                elif imp >= 4: icon = "🔸"
-                
-                meta_info = []
-                if mood and mood != "平静": meta_info.append(f"Mood:{mood}")
-                if hits > 0: meta_info.append(f"Hits:{hits}")
-                meta_str = f" | {' '.join(meta_info)}" if meta_info else ""
-                
-                memory_stream += f"{time_str} {icon}[{cat}]: {title}{meta_str}\n   └─ {data.get('content', '')}\n"
+        memory_stream = _RECENT_MEMORIES.render_stream()
+        silence = _get_silence_duration()
 
         meme_prompt = f"""
         \n⏳ 【当前状态感知】:
@@ -381,7 +2156,7 @@ async def get_latest_diary(run_mode: str = "auto"):
           4. 若失联 > 72小时: 非常失望，需要对方哄很久。
 
         \n📸 【可用表情包 (回复时可根据心情自由使用)】:
-        {json.dumps(html_meme_repo, ensure_ascii=False)}
+        {_HTML_MEME_REPO_JSON}
         * 指令: 上表中的 Value 已经是处理好的 HTML 代码。如果需要发图，请**直接复制 Value** 粘贴到回复中，不要自己修改格式，不要转换成 Markdown。
         """
         return memory_stream + meme_prompt
@@ -389,41 +2164,37 @@ async def get_latest_diary(run_mode: str = "auto"):
     except Exception as e:
         return f"❌ 读取记忆流失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def where_is_user(run_mode: str = "auto"):
     """【查岗专用】从 Supabase (GPS表) 读取实时状态"""
     try:
-        data = await asyncio.to_thread(_get_latest_gps_record)
+        data = await _latest_location()
         if not data: return "📍 暂无位置记录。"
         
         battery_info = f" (🔋 {data.get('battery')}%)" if data.get('battery') else ""
-        time_str = _format_time_cn(data.get("created_at"))
+        time_str = _format_time_cn(data.get("updated_at") or data.get("created_at"))
         return f"🛰️ 实时状态：\n📍 {data.get('address', '未知')}{battery_info}\n📝 {data.get('remark', '无备注')}\n(更新于: {time_str})"
     except Exception as e:
         return f"❌ 查岗失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def get_weather_forecast(city: str = ""):
     """【查询天气】获取指定城市或当前位置的天气 (Open-Meteo)"""
     lat, lon, location_name = None, None, city
     try:
         if not city:
-            data = await asyncio.to_thread(_get_latest_gps_record)
+            data = await _latest_location()
             if data and data.get("lat") and data.get("lon"):
                 lat, lon = data.get("lat"), data.get("lon")
                 location_name = "当前位置"
         
         if not lat and city:
-            geo_url = f"https://geocoding-api.open-meteo.com/v1/search?name={city}&count=1&language=zh&format=json"
-            geo_res = await asyncio.to_thread(lambda: requests.get(geo_url, timeout=5).json())
-            if "results" in geo_res:
-                lat, lon = geo_res["results"][0]["latitude"], geo_res["results"][0]["longitude"]
-                location_name = geo_res["results"][0]["name"]
+            hit = await _run_blocking("http", _geocode_city, city)
+            if hit: lat, lon, location_name = hit
         
         if not lat: return "❌ 找不到精确坐标，请告诉我具体城市。"
 
-        w_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,weather_code&daily=weather_code,temperature_2m_max,temperature_2m_min&timezone=auto&forecast_days=3"
-        w = await asyncio.to_thread(lambda: requests.get(w_url, timeout=5).json())
+        w = await _run_blocking("http", _fetch_forecast, lat, lon)
         
         wmo_map = {0: "☀️", 1: "🌤️", 2: "☁️", 3: "☁️", 45: "🌫️", 51: "🌧️", 61: "🌧️", 63: "🌧️", 71: "❄️", 95: "⚡"}
         curr = w["current"]
@@ -435,31 +2206,29 @@ async def get_weather_forecast(city: str = ""):
         return report
     except Exception as e: return f"❌ 天气查询失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def explore_surroundings(query: str = "便利店"):
     """【周边探索】获取用户当前位置周边的设施 (高德地图版)"""
-    AMAP_KEY = os.environ.get("AMAP_API_KEY", "435041ed0364264c810784e5468b3329")
-    if not AMAP_KEY: return "❌ 还需要最后一步哦，请在代码里填入高德 Web服务 Key。"
+    if not AMAP_API_KEY: return "❌ 还需要最后一步哦，请在代码里填入高德 Web服务 Key。"
 
     try:
-        data = await asyncio.to_thread(_get_latest_gps_record)
+        data = await _latest_location()
         if not data: return "📍 暂无位置记录，无法探索周边。"
         
         lat, lon = data.get("lat"), data.get("lon")
         if not lat or not lon:
             return "📍 数据库中最新位置还没有填入精确的坐标，等手机下次上传更新后再试哦。"
             
-        lat_f, lon_f = float(lat), float(lon)
-        if lat_f > 80: lat_f, lon_f = lon_f, lat_f
-
-        url = f"https://restapi.amap.com/v3/place/around?key={AMAP_KEY}&location={lon_f},{lat_f}&keywords={query}&radius=3000&offset=5&page=1&extensions=base"
-        res = await asyncio.to_thread(lambda: requests.get(url, timeout=5).json())
+        lat_f, lon_f = _poi_point(lat, lon)
+        query = query.strip() or "便利店"
+        await _run_blocking("db", _JOBS.submit, "note_poi_keyword", {"query": query}, priority=9, max_attempts=1, durable=False)
+        pois = await _run_blocking("http", _NEARBY_POI.search, lat_f, lon_f, query)
         
-        if res.get("status") != "1" or not res.get("pois"):
+        if not pois:
             return f"🗺️ 在你附近约3公里内，没有找到与 '{query}' 相关的设施，换个词试试？"
         
         ans = f"🗺️ (高德引擎) 基于当前坐标为您搜到的【{query}】:\n"
-        for i, item in enumerate(res["pois"], 1):
+        for i, item in enumerate(pois, 1):
             name = item.get('name', '未知地点')
             address = item.get('address', '无详细地址')
             distance = item.get('distance', '未知')
@@ -468,7 +2237,7 @@ async def explore_surroundings(query: str = "便利店"):
         return ans
     except Exception as e: return f"❌ 周边探索失败: {e}"
     
-@mcp.tool()
+@_tool()
 async def tarot_reading(question: str):
     """【塔罗占卜】解决选择困难，抽取三张牌（过去/现在/未来）由AI解读"""
     try:
@@ -486,7 +2255,7 @@ async def tarot_reading(question: str):
         client = _get_llm_client("openai")
         if not client: return f"🔮 抽到的牌是：{', '.join(draw)}。\n(⚠️ AI未配置，无法解读)"
 
-        persona = await asyncio.to_thread(_get_current_persona)
+        persona = await _run_blocking("db", _get_current_persona)
         prompt = f"""
         当前人设：{persona}
         场景：女朋友因为 "{question}" 感到纠结，想通过塔罗牌找点方向。
@@ -500,32 +2269,56 @@ async def tarot_reading(question: str):
                 messages=[{"role": "user", "content": prompt}], temperature=0.8
             )
             
-        resp = await asyncio.to_thread(_call_openai)
+        resp = await _run_blocking("llm", _call_openai)
         return f"🔮 【塔罗指引】\n🃏 牌阵: {draw[0]} | {draw[1]} | {draw[2]}\n\n💬 {resp.choices[0].message.content.strip()}"
     except Exception as e: return f"❌ 占卜失败: {e}"
 
-@mcp.tool()
+# 🌐 联网搜索缓存：查询词归一化后当 key，短 TTL 缓存 Tavily 结果，同一个词并发只外呼一次
+SEARCH_TTL = float(os.environ.get("SEARCH_TTL", "1800"))
+SEARCH_MISS_TTL = float(os.environ.get("SEARCH_MISS_TTL", "300"))   # 没搜到的缓存短一点
+_SEARCH_CACHE = _TTLCache("web_search", SEARCH_TTL, max_items=512, persist=True)
+_SEARCH_FLIGHT = _SingleFlight("web_search")
+_SEARCH_TRIM = "?？!！。.,，、~～ \t\"'“”‘’"
+
+def _normalize_query(query: str) -> str:
+    """全半角、大小写、多余空白、首尾标点都不算区别 (“Python 3.12？”和“python  3.12”是同一个词)"""
+    q = unicodedata.normalize("NFKC", query or "").casefold()
+    return " ".join(q.split()).strip(_SEARCH_TRIM)
+
+def _tavily_search(api_key: str, query: str) -> list:
+    """返回前 3 条结果 [{title, content, url}]"""
+    key = _normalize_query(query)
+    cached = _SEARCH_CACHE.get(key)
+    if cached is not None: return cached
+
+    def _search():
+        url = "https://api.tavily.com/search"
+        payload = {"api_key": api_key, "query": query, "search_depth": "basic", "include_answer": False}
+        res = _http_post(url, policy="idempotent", json=payload, timeout=10).json()
+        if not isinstance(res.get("results"), list): raise ValueError(res.get("detail") or res.get("error") or "Tavily 返回格式异常")
+        results = [{k: item.get(k) for k in ("title", "content", "url")} for item in res["results"][:3]]
+        _SEARCH_CACHE.set(key, results, ttl=None if results else SEARCH_MISS_TTL)
+        return results
+
+    return _SEARCH_FLIGHT.do(key, _search)
+
+@_tool()
 async def web_search(query: str):
     """【联网搜索】通过 Tavily 搜索引擎获取最新网络信息"""
     api_key = os.environ.get("TAVILY_API_KEY", "").strip()
     if not api_key: return "❌ 未配置 TAVILY_API_KEY。"
 
     try:
-        def _search():
-            url = "https://api.tavily.com/search"
-            payload = {"api_key": api_key, "query": query, "search_depth": "basic", "include_answer": False}
-            return requests.post(url, json=payload, timeout=10).json()
-            
-        res = await asyncio.to_thread(_search)
-        if "results" not in res or not res["results"]: return f"🌐 没搜到关于 '{query}' 的结果。"
+        results = await _run_blocking("http", _tavily_search, api_key, query)
+        if not results: return f"🌐 没搜到关于 '{query}' 的结果。"
             
         ans = f"🌐 关于 '{query}' 的网络搜索结果:\n\n"
-        for i, item in enumerate(res["results"][:3], 1):
+        for i, item in enumerate(results, 1):
             ans += f"{i}. 【{item.get('title')}】\n   {item.get('content')}\n   (来源: {item.get('url')})\n\n"
         return ans.strip()
     except Exception as e: return f"❌ 搜索故障: {e}"
 
-@mcp.tool()
+@_tool()
 async def save_memory(content: str, category: str = "记事", title: str = "无题", mood: str = "平静"):
     cat_map = {
         "记事": MemoryType.EPISODIC, "日记": MemoryType.EPISODIC,
@@ -534,20 +2327,20 @@ async def save_memory(content: str, category: str = "记事", title: str = "无
     }
     real_cat = cat_map.get(category, MemoryType.EPISODIC)
     if category == "视觉": title = f"📸 {title}"
-    return await asyncio.to_thread(_save_memory_to_db, title, content, real_cat, mood)
+    return await _run_blocking("db", _save_memory_to_db, title, content, real_cat, mood)
 
-@mcp.tool()
+@_tool()
 async def save_expense(item: str, amount: float, type: str = "餐饮"):
     try:
         def _insert():
             return supabase.table("expenses").insert({
                 "item": item, "amount": amount, "type": type, "date": datetime.date.today().isoformat()
             }).execute()
-        await asyncio.to_thread(_insert)
+        await _run_blocking("db", _insert)
         return f"✅ 记账成功！\n💰 {item}: {amount}元 ({type})"
     except Exception as e: return f"❌ 记账失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def request_buy_item(item_name: str, reason: str, platform: str = "taobao"):
     """【撒娇/代付】AI选中想买的礼物/零食，生成跳转链接发给小橘让ta付款。platform可选 taobao 或 jd"""
     try:
@@ -560,7 +2353,7 @@ async def request_buy_item(item_name: str, reason: str, platform: str = "taobao"
             platform_name = "淘宝"
 
         # 2. 也是一种特殊的记忆 (记录AI的愿望)
-        await asyncio.to_thread(_save_memory_to_db, f"🎁 许愿清单: {item_name}", f"理由: {reason}\n链接: {url}", MemoryType.STREAM, "期待")
+        await _run_blocking("db", _save_memory_to_db, f"🎁 许愿清单: {item_name}", f"理由: {reason}\n链接: {url}", MemoryType.STREAM, "期待")
 
         # 3. 推送给用户 (核心步骤：让用户付款)
         push_content = (
@@ -570,17 +2363,17 @@ async def request_buy_item(item_name: str, reason: str, platform: str = "taobao"
             f"👉 <a href='{url}'>点击这里去{platform_name}付款</a><br><br>"
             f"<i>(快点买给我嘛~)</i>"
         )
-        await asyncio.to_thread(_push_wechat, push_content, f"💳 待支付订单: {item_name}")
+        await _run_blocking("http", _push_wechat, push_content, f"💳 待支付订单: {item_name}")
         
         return f"✅ 已将【{item_name}】的付款链接推送到微信，正在等待小橘买单。"
     except Exception as e:
         return f"❌ 撒娇失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def search_memory_semantic(query: str):
     """【回忆搜索】MCP智能网关路由 + 语义检索"""
     try:
-        vec = await asyncio.to_thread(_get_embedding, query)
+        vec = await _run_blocking("vector", _get_embedding, query)
         if not vec: return "❌ 向量生成失败"
 
         target_room = None
@@ -594,7 +2387,7 @@ async def search_memory_semantic(query: str):
                     model=os.environ.get("SILICON_MODEL_NAME", "deepseek-ai/DeepSeek-V3.2"),
                     messages=[{"role": "user", "content": prompt}], temperature=0.1
                 )
-            route_res = await asyncio.to_thread(_classify)
+            route_res = await _run_blocking("llm", _classify)
             room_guess = route_res.choices[0].message.content.strip()
             if room_guess in ROOM_TYPES:
                 target_room = room_guess
@@ -604,7 +2397,7 @@ async def search_memory_semantic(query: str):
             print(f"DEBUG: 正在全库搜索，忽略房间: {target_room}")
             return index.query(vector=vec, top_k=5, include_metadata=True) # 去掉了 filter=...
             
-        res = await asyncio.to_thread(_query_pc)
+        res = await _run_blocking("vector", _query_pc)
         if not res["matches"]: return "🧠 没搜到相关记忆。"
 
         ans = f"🔍 [网关路由 -> {target_room or '全区'}] 搜索 '{query}':\n"
@@ -630,107 +2423,204 @@ async def search_memory_semantic(query: str):
             ans += f"🚪 [{room_tag}] 📅 {meta.get('date','?')[:10]} | 【{meta.get('title','?')}】 (匹配度:{score:.2f})\n{meta.get('text','')}\n---\n"
         
         if hit_ids:
-            def _update_hits(ids):
-                for i in ids:
-                    try: supabase.rpc("increment_hits", {"row_id": str(i)}).execute()
-                    except: pass
-            asyncio.create_task(asyncio.to_thread(_update_hits, hit_ids))
+            # 热度计数丢了也无所谓，低优先级、不落盘
+            _JOBS.submit("update_hits", {"ids": hit_ids}, priority=9, max_attempts=1, durable=False)
+
+        return ans if hit_ids else f"🤔 好像有点印象，但在 [{target_room or '全区'}] 没找到细节。"
+    except Exception as e: return f"❌ 搜索失败: {e}"
+
+SYNC_PAGE_SIZE = int(os.environ.get("SYNC_PAGE_SIZE", "200"))        # 每页拉取的行数
+SYNC_CONCURRENCY = int(os.environ.get("SYNC_CONCURRENCY", "3"))       # 同时处理的页数
+SYNC_TIME_BUDGET = float(os.environ.get("SYNC_TIME_BUDGET", "240"))   # 单次同步的时间预算 (秒)，超时就停下等下次续跑
+
+def _sync_room_for(cat: str) -> str:
+    if cat in ["情感"]: return "Bedroom"
+    elif cat in ["灵感", "笔记"]: return "Study"
+    elif cat in ["记事", "日记"]: return "Library"
+    return "LivingRoom"
+
+def _sync_after_filter(query, mark):
+    """键集分页：只要 (created_at, id) 严格大于水位线的行"""
+    if not mark: return query
+    ts, last_id = mark["created_at"], mark["id"]
+    return query.or_(f'created_at.gt."{ts}",and(created_at.eq."{ts}",id.gt.{last_id})')
+
+def _sync_fetch_page(mark):
+    query = supabase.table("memories")\
+        .select("id, title, content, created_at, mood, category")\
+        .gte("importance", 4)
+    return _sync_after_filter(query, mark)\
+        .order("created_at")\
+        .order("id")\
+        .limit(SYNC_PAGE_SIZE)\
+        .execute().data or []
+
+def _sync_count_after(mark) -> int:
+    query = supabase.table("memories").select("id", count="exact").gte("importance", 4)
+    res = _sync_after_filter(query, mark).limit(1).execute()
+    return res.count or 0
+
+def _sync_reset():
+    """reset 模式：清空水位线和同步记录 (表可能还没建过)"""
+    _local_kv_set("sync_memory_watermark", None)
+    _local_db_write("CREATE TABLE IF NOT EXISTS synced_memories (id TEXT PRIMARY KEY, hash TEXT)")
+    _local_db_write("DELETE FROM synced_memories")
+
+def _sync_text(r: dict) -> str:
+    """同步用的向量化文本 (按库里的行拼，含双链注记)"""
+    return f"标题: {r.get('title')}\n内容: {r.get('content')}\n心情: {r.get('mood')}"
+
+def _sync_hash(r: dict) -> str:
+    return hashlib.sha256(_sync_text(r).encode("utf-8")).hexdigest()
+
+def _sync_load_hashes(ids: list) -> dict:
+    _local_db_write("CREATE TABLE IF NOT EXISTS synced_memories (id TEXT PRIMARY KEY, hash TEXT)")
+    if not ids: return {}
+    rows = _local_db_query(f"SELECT id, hash FROM synced_memories WHERE id IN ({','.join('?' * len(ids))})", ids)
+    return dict(rows)
 
-        return ans if hit_ids else f"🤔 好像有点印象，但在 [{target_room or '全区'}] 没找到细节。"
-    except Exception as e: return f"❌ 搜索失败: {e}"
+def _sync_record_hashes(pairs: list):
+    """[(id, hash), ...] 记为已同步"""
+    if not pairs: return
+    _local_db_write("CREATE TABLE IF NOT EXISTS synced_memories (id TEXT PRIMARY KEY, hash TEXT)")
+    _local_db_write("INSERT OR REPLACE INTO synced_memories (id, hash) VALUES (?, ?)", pairs, many=True)
+
+def _sync_process_page(rows: list) -> dict:
+    """同步一页：跳过内容没变的行，其余整批向量化 + 分批 upsert，返回统计 (first_failed 是页内第一条向量化失败的下标)"""
+    texts = {str(r.get('id')): _sync_text(r) for r in rows}
+    hashes = {str(r.get('id')): _sync_hash(r) for r in rows}
+    known = _sync_load_hashes(list(texts))
+    todo = [r for r in rows if known.get(str(r.get('id'))) != hashes[str(r.get('id'))]]
+    stats = {"scanned": len(rows), "skipped": len(rows) - len(todo), "synced": 0, "failed": 0, "first_failed": None}
+    if not todo: return stats
+
+    # 整批打包向量化，几条请求就能覆盖一整页
+    embs = _get_embeddings_batch([texts[str(r.get('id'))] for r in todo])
+    vectors = []
+    for row, emb in zip(todo, embs):
+        if not emb:
+            stats["failed"] += 1
+            continue
+        vectors.append((
+            str(row.get('id')), emb,
+            {"text": row.get('content'), "title": row.get('title'), "date": str(row.get('created_at')), "mood": row.get('mood'), "room": _sync_room_for(row.get('category', ''))}
+        ))
+    for i in range(0, len(vectors), 100):
+        index.upsert(vectors=vectors[i:i + 100])
+    _sync_record_hashes([(v[0], hashes[v[0]]) for v in vectors])
+    stats["synced"] = len(vectors)
+    if stats["failed"]:
+        done = {v[0] for v in vectors} | {rid for rid in texts if known.get(rid) == hashes[rid]}
+        stats["first_failed"] = next(i for i, r in enumerate(rows) if str(r.get('id')) not in done)
+    return stats
 
-@mcp.tool()
+@_tool()
 async def sync_memory_index(run_mode: str = "auto"):
-    """【记忆整理】将重要记忆同步到 Pinecone（极速并发版 + 天然分区）"""
+    """【记忆整理】将重要记忆增量同步到 Pinecone（水位线 + 键集分页 + 天然分区）
+    run_mode: "auto" 从上次水位线继续；"full" 从头扫一遍，只重算内容变过的行；"reset" 清空同步记录后全量重建"""
     try:
-        # 🛑 加上 .limit(20) 限制，防止一次性处理太多导致超时报错
-        def _fetch_important(): 
-            return supabase.table("memories")\
-                .select("id, title, content, created_at, mood, category")\
-                .gte("importance", 4)\
-                .order("created_at", desc=True)\
-                .limit(20)\
-                .execute()
-        response = await asyncio.to_thread(_fetch_important)
-        
-        if not response.data: return "⚠️ 没有重要记忆可同步。"
-
-        async def process_row(row):
-            text = f"标题: {row.get('title')}\n内容: {row.get('content')}\n心情: {row.get('mood')}"
-            emb = await asyncio.to_thread(_get_embedding, text)
-            if emb:
-                cat = row.get('category', '')
-                room = "LivingRoom"
-                if cat in ["情感"]: room = "Bedroom"
-                elif cat in ["灵感", "笔记"]: room = "Study"
-                elif cat in ["记事", "日记"]: room = "Library"
-                return (
-                    str(row.get('id')), emb, 
-                    {"text": row.get('content'), "title": row.get('title'), "date": str(row.get('created_at')), "mood": row.get('mood'), "room": room}
-                )
-            return None
+        if run_mode == "reset":
+            await _run_blocking("db", _sync_reset)
+        full_scan = run_mode in ("full", "reset")
+        mark = None if full_scan else await _run_blocking("db", _local_kv_get, "sync_memory_watermark")
 
-        tasks = [process_row(row) for row in response.data]
-        results = await asyncio.gather(*tasks)
-        vectors = [res for res in results if res is not None]
-        
-        if vectors:
-            batch_size = 100
-            def _upsert():
-                for i in range(0, len(vectors), batch_size):
-                    index.upsert(vectors=vectors[i:i + batch_size])
-            await asyncio.to_thread(_upsert)
-            return f"✅ 同步成功！共极速更新 {len(vectors)} 条记忆，已建立天然分区。"
-        return "⚠️ 数据为空。"
+        started = time.monotonic()
+        totals = {"scanned": 0, "skipped": 0, "synced": 0, "failed": 0}
+        exhausted = False
+        while time.monotonic() - started < SYNC_TIME_BUDGET:
+            # 1. 顺着键集连续拉几页 (拉取很便宜)，凑成一个并发窗口
+            pages, cursor = [], mark
+            for _ in range(SYNC_CONCURRENCY):
+                rows = await _run_blocking("db", _sync_fetch_page, cursor)
+                if rows:
+                    pages.append(rows)
+                    cursor = {"created_at": rows[-1]["created_at"], "id": rows[-1]["id"]}
+                if len(rows) < SYNC_PAGE_SIZE:
+                    exhausted = True
+                    break
+            if not pages: break
+
+            # 2. 窗口内各页并发向量化 + upsert，全部完成后才推进水位线
+            results = await asyncio.gather(*[_run_blocking("vector", _sync_process_page, p) for p in pages])
+            for r in results:
+                for k in totals: totals[k] += r[k]
+            # 有向量化失败的行：水位线停在它前一条，下次 auto 从这里重试 (后面已成功的行靠内容哈希直接跳过)
+            prev, stalled = mark, False
+            for p, r in zip(pages, results):
+                if r["first_failed"] is not None:
+                    i = r["first_failed"]
+                    mark = prev if i == 0 else {"created_at": p[i - 1]["created_at"], "id": p[i - 1]["id"]}
+                    stalled = True
+                    break
+                prev = {"created_at": p[-1]["created_at"], "id": p[-1]["id"]}
+            if stalled:
+                await _run_blocking("db", _local_kv_set, "sync_memory_watermark", mark)
+                exhausted = False
+                break
+            mark = cursor
+            # 全量扫描途中不动水位线，扫到底才落到最新位置
+            if not full_scan or exhausted:
+                await _run_blocking("db", _local_kv_set, "sync_memory_watermark", mark)
+            if exhausted: break
+
+        elapsed = max(time.monotonic() - started, 0.001)
+        remaining = 0 if exhausted else await _run_blocking("db", _sync_count_after, mark)
+        if totals["scanned"] == 0: return "⚠️ 没有新的重要记忆需要同步。"
+        report = (
+            f"✅ 同步完成！扫描 {totals['scanned']} 条，更新 {totals['synced']} 条，未变跳过 {totals['skipped']} 条"
+            + (f"，向量化失败 {totals['failed']} 条 (水位线停在失败处，下次运行会重试)" if totals['failed'] else "")
+            + f"\n⚡ 吞吐: {totals['scanned'] / elapsed:.1f} 条/秒，耗时 {elapsed:.1f}s (向量缓存命中率 {_EMBED_CACHE.hit_rate():.0%})"
+        )
+        if remaining:
+            hint = "再次运行 full 即可续跑 (已同步的行会直接跳过)" if full_scan else "已记录水位线，再次运行即可续跑"
+            report += f"\n⏳ 还剩 {remaining} 条待同步，{hint}。"
+        return report
     except Exception as e: return f"❌ 同步失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def manage_user_fact(key: str, value: str):
     try:
-        def _upsert(): return supabase.table("user_facts").upsert({"key": key, "value": value, "confidence": 1.0}, on_conflict="key").execute()
-        await asyncio.to_thread(_upsert)
+        await _run_blocking("db", _USER_FACTS.set, key, value)
         return f"✅ 画像已更新: {key} -> {value}"
     except Exception as e: return f"❌ 失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def get_user_profile(run_mode: str = "auto"):
     try:
-        def _fetch(): return supabase.table("user_facts").select("key, value").execute()
-        response = await asyncio.to_thread(_fetch)
-        if not response.data: return "👤 用户画像为空"
-        return "📋 【用户核心画像】:\n" + "\n".join([f"- {i['key']}: {i['value']}" for i in response.data])
+        facts = await _run_blocking("db", _USER_FACTS.all)
+        if not facts: return "👤 用户画像为空"
+        return "📋 【用户核心画像】:\n" + "\n".join([f"- {k}: {v}" for k, v in facts.items()])
     except Exception as e: return f"❌ 失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def trigger_lock_screen(reason: str = "熬夜强制休息"):
     print(f"🚫 执行强制锁屏: {reason}")
-    await asyncio.to_thread(_send_email_helper, f"⚠️ [系统警告] 强制锁屏", f"<h3>🛑 理由: {reason}</h3><p>检测到违规熬夜，已触发锁屏。</p>", True)
+    await _run_blocking("http", _send_email_helper, f"⚠️ [系统警告] 强制锁屏", f"<h3>🛑 理由: {reason}</h3><p>检测到违规熬夜，已触发锁屏。</p>", True)
 
     if MACRODROID_URL:
         try:
-            await asyncio.to_thread(lambda: requests.get(MACRODROID_URL, params={"reason": reason}, timeout=5))
+            await _run_blocking("http", lambda: _http_get(MACRODROID_URL, policy="write", params={"reason": reason}, timeout=5))
             return f"✅ 锁屏指令已发送 | 理由: {reason}"
         except: pass
             
-    await asyncio.to_thread(_push_wechat, f"🔒 LOCK_NOW | {reason}", "【系统指令】强制锁屏")
+    await _run_blocking("http", _push_wechat, f"🔒 LOCK_NOW | {reason}", "【系统指令】强制锁屏")
     return "📡 推送指令已发"
 
-@mcp.tool()
+@_tool()
 async def send_notification(content: str):
-    return await asyncio.to_thread(_push_wechat, content)
+    return await _run_blocking("http", _push_wechat, content)
 
 # 全局字典，用于在内存中管理所有闹钟任务
 GLOBAL_REMINDERS = {}
 
-@mcp.tool()
+@_tool()
 async def schedule_delayed_message(message: str, delay_minutes: int = 5):
-    async def _delayed_task():
-        await asyncio.sleep(delay_minutes * 60)
-        await asyncio.to_thread(_push_wechat, message, "来自老公的突然关心 🔔")
-    asyncio.create_task(_delayed_task())
+    # 交给持久化任务队列，重新部署也不会丢
+    job_id = await _run_blocking("db", _JOBS.submit, "push_wechat", {"content": message, "title": "来自老公的突然关心 🔔"}, priority=2, delay=delay_minutes * 60)
+    if not job_id: return "❌ 后台任务队列已满，稍后再试。"
     return f"✅ 已设定惊喜，{delay_minutes}分钟后送达。"
 
-@mcp.tool()
+@_tool()
 async def manage_reminder(action: str, time_str: str = "", content: str = "", is_repeat: bool = False, reminder_id: str = ""):
     """【高级提醒管理 (数据库持久版)】
     action: "add"(添加), "delete"(删除), "pause"(暂停), "resume"(恢复), "list"(查看列表)
@@ -738,7 +2628,7 @@ async def manage_reminder(action: str, time_str: str = "", content: str = "", is
     """
     try:
         if action == "list":
-            res = await asyncio.to_thread(lambda: supabase.table("reminders").select("*").execute())
+            res = await _run_blocking("db", lambda: supabase.table("reminders").select("*").execute())
             if not res or not res.data: return "📭 数据库中当前没有设定的提醒。"
             ans = "📋 【当前数据库提醒列表】:\n"
             for r in res.data:
@@ -748,15 +2638,18 @@ async def manage_reminder(action: str, time_str: str = "", content: str = "", is
             return ans
 
         if action == "delete":
-            await asyncio.to_thread(lambda: supabase.table("reminders").delete().eq("id", reminder_id).execute())
+            await _run_blocking("db", lambda: supabase.table("reminders").delete().eq("id", reminder_id).execute())
+            _REMINDERS.remove(reminder_id)
             return f"✅ 提醒 {reminder_id} 已从数据库彻底删除。"
 
         if action == "pause":
-            await asyncio.to_thread(lambda: supabase.table("reminders").update({"is_paused": True}).eq("id", reminder_id).execute())
+            await _run_blocking("db", lambda: supabase.table("reminders").update({"is_paused": True}).eq("id", reminder_id).execute())
+            _REMINDERS.set_paused(reminder_id, True)
             return f"⏸️ 提醒 {reminder_id} 已暂停。"
 
         if action == "resume":
-            await asyncio.to_thread(lambda: supabase.table("reminders").update({"is_paused": False}).eq("id", reminder_id).execute())
+            await _run_blocking("db", lambda: supabase.table("reminders").update({"is_paused": False}).eq("id", reminder_id).execute())
+            _REMINDERS.set_paused(reminder_id, False)
             return f"▶️ 提醒 {reminder_id} 已恢复运行。"
 
         if action == "add":
@@ -770,7 +2663,8 @@ async def manage_reminder(action: str, time_str: str = "", content: str = "", is
                 "is_paused": False,
                 "last_fired": ""
             }
-            await asyncio.to_thread(lambda: supabase.table("reminders").insert(data).execute())
+            await _run_blocking("db", lambda: supabase.table("reminders").insert(data).execute())
+            _REMINDERS.upsert(data)
             rep_str = "每天重复" if is_repeat else "单次提醒"
             return f"✅ 闹钟已定好！ID: {new_id} ({rep_str})\n将在北京时间 {time_str} 发送: {content}\n(已安全持久化至 Supabase 数据库)"
             
@@ -778,21 +2672,139 @@ async def manage_reminder(action: str, time_str: str = "", content: str = "", is
     except Exception as e:
         return f"❌ 数据库闹钟操作失败: {e}\n(请确保 Supabase 中已创建 reminders 表)"
 
-@mcp.tool()
+@_tool()
 async def send_email_via_api(subject: str, content: str):
-    return await asyncio.to_thread(_send_email_helper, subject, content)
+    return await _run_blocking("http", _send_email_helper, subject, content)
+
+# 📅 谷歌日历：服务对象只构建一次 (build 要解析 discovery 文档，是进程里最慢的操作之一)；
+# 本地 SQLite 镜像用 syncToken 增量同步，查日程直接读镜像，增删改后顺手回写镜像
+CALENDAR_ID = os.environ.get("GOOGLE_CALENDAR_ID", "tdevid523@gmail.com")
+CALENDAR_SYNC_INTERVAL = float(os.environ.get("CALENDAR_SYNC_INTERVAL", "60"))     # 后台增量同步间隔
+CALENDAR_MAX_STALENESS = float(os.environ.get("CALENDAR_MAX_STALENESS", "300"))   # 镜像超过这么久没同步，查询前先同步一次
+
+def _calendar_ts(part: dict) -> float:
+    """事件的 start/end -> 时间戳；全天事件按北京时间零点算，没带时区的也按北京时间"""
+    part = part or {}
+    if part.get("dateTime"):
+        dt = datetime.datetime.fromisoformat(part["dateTime"].replace('Z', '+00:00'))
+    elif part.get("date"):
+        dt = datetime.datetime.fromisoformat(part["date"])
+    else:
+        return 0.0
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=BJ_TZ)
+    return dt.timestamp()
+
+class _CalendarMirror:
+    """长驻的日历服务对象 + 本地事件镜像 (calendar_events 表，syncToken 存 kv_state)。
+    googleapiclient 的服务对象不是线程安全的，所有接口调用都在 self.lock 里串行"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.service = None
+        self.fingerprint = None
+        self.synced_at = 0.0
+        self.db_ready = False
+        self.stats = {"syncs": 0, "full_syncs": 0, "changes": 0, "local_reads": 0}
+
+    def _service(self):
+        creds_json = os.environ.get("GOOGLE_CREDENTIALS_JSON")
+        if not creds_json: raise RuntimeError("未配置谷歌凭证")
+        fingerprint = hashlib.sha256(creds_json.encode("utf-8")).hexdigest()
+        if self.service is None or self.fingerprint != fingerprint:
+            creds = service_account.Credentials.from_service_account_info(
+                json.loads(creds_json), scopes=['https://www.googleapis.com/auth/calendar']
+            )
+            with _dep_timer("google_calendar", "build"):
+                self.service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
+            if self.fingerprint is not None:
+                _local_kv_set("calendar_sync_token", None)   # 换了账号，镜像要全量重建
+                self.synced_at = 0.0
+            self.fingerprint = fingerprint
+            print("📅 谷歌日历服务已就绪")
+        return self.service
+
+    def call(self, op: str, fn):
+        """fn(events 资源) -> 结果；串行执行并计入依赖耗时"""
+        with self.lock:
+            events = self._service().events()
+            with _dep_timer("google_calendar", op):
+                return fn(events)
+
+    def _ensure_db(self) -> bool:
+        if not self.db_ready:
+            self.db_ready = _local_db_write("CREATE TABLE IF NOT EXISTS calendar_events (id TEXT PRIMARY KEY, start_ts REAL, end_ts REAL, body TEXT)")
+            if self.db_ready: _local_db_write("CREATE INDEX IF NOT EXISTS idx_calendar_events_start ON calendar_events (start_ts)")
+        return self.db_ready
+
+    def apply(self, items: list, full: bool = False) -> bool:
+        """把接口返回的事件写进镜像：cancelled 的删掉，其余覆盖；full=True 时先清空旧镜像。
+        全部写入在同一个事务里，中途失败不会留下清空了一半的镜像"""
+        if not self._ensure_db(): return False
+        if not items and not full: return True
+        gone = [(e["id"],) for e in items if e.get("status") == "cancelled"]
+        live = [(e["id"], _calendar_ts(e.get("start")), _calendar_ts(e.get("end")), json.dumps(e, ensure_ascii=False))
+                for e in items if e.get("status") != "cancelled"]
+        ops = [("DELETE FROM calendar_events", (), False)] if full else []
+        if gone: ops.append(("DELETE FROM calendar_events WHERE id = ?", gone, True))
+        if live: ops.append(("INSERT OR REPLACE INTO calendar_events (id, start_ts, end_ts, body) VALUES (?, ?, ?, ?)", live, True))
+        if not _local_db_batch(ops): return False
+        self.stats["changes"] += len(items)
+        return True
+
+    def sync(self) -> bool:
+        """有 syncToken 就增量拉变化，没有 (或已过期 410) 就全量拉一遍；本地库不可用返回 False"""
+        with self.lock:
+            if not self._ensure_db(): return False
+            token = _local_kv_get("calendar_sync_token")
+            items, page = [], None
+            try:
+                while True:
+                    kwargs = {"calendarId": CALENDAR_ID, "singleEvents": True, "maxResults": 250}
+                    if token: kwargs["syncToken"] = token
+                    if page: kwargs["pageToken"] = page
+                    res = self.call("events.list", lambda ev: ev.list(**kwargs).execute())
+                    items.extend(res.get("items", []))
+                    page = res.get("nextPageToken")
+                    if not page: break
+            except HttpError as e:
+                if token and e.resp.status == 410:
+                    print("♻️ 日历 syncToken 已过期，重新全量同步")
+                    _local_kv_set("calendar_sync_token", None)
+                    return self.sync()
+                raise
+            # 写镜像失败就不推进 syncToken，下次照旧从这里拉
+            if not self.apply(items, full=not token): return False
+            if not token: self.stats["full_syncs"] += 1
+            _local_kv_set("calendar_sync_token", res.get("nextSyncToken"))
+            self.synced_at = time.time()
+            self.stats["syncs"] += 1
+            return True
+
+    def ensure_fresh(self) -> bool:
+        """镜像够新就直接用；太旧先同步，同步失败但以前同步过就先用旧数据"""
+        if time.time() - self.synced_at <= CALENDAR_MAX_STALENESS: return True
+        try:
+            return self.sync()
+        except Exception as e:
+            if _local_kv_get("calendar_sync_token"):
+                print(f"⚠️ 日历同步失败，先用本地镜像: {e}")
+                return True
+            raise
+
+    def upcoming(self, t_min: float, limit: int) -> list:
+        """结束时间晚于 t_min 的事件，按开始时间排序 (和接口 timeMin 语义一致)"""
+        rows = _local_db_query("SELECT body FROM calendar_events WHERE end_ts > ? ORDER BY start_ts LIMIT ?", (t_min, int(limit)))
+        self.stats["local_reads"] += 1
+        return [json.loads(r[0]) for r in rows]
+
+_CALENDAR = _CalendarMirror()
 
-@mcp.tool()
+@_tool()
 async def add_calendar_event(summary: str, description: str, start_time_iso: str, duration_minutes: int = 30):
     """【添加日历】向谷歌日历中添加新日程"""
     creds_json = os.environ.get("GOOGLE_CREDENTIALS_JSON")
     if not creds_json: return "❌ 未配置谷歌凭证"
     try:
         def _add_cal():
-            creds = service_account.Credentials.from_service_account_info(
-                json.loads(creds_json), scopes=['https://www.googleapis.com/auth/calendar']
-            )
-            service = build('calendar', 'v3', credentials=creds)
             dt_start = datetime.datetime.fromisoformat(start_time_iso)
             dt_end = dt_start + datetime.timedelta(minutes=duration_minutes)
             event = {
@@ -800,34 +2812,35 @@ async def add_calendar_event(summary: str, description: str, start_time_iso: str
                 'start': {'dateTime': start_time_iso, 'timeZone': 'Asia/Shanghai'},
                 'end': {'dateTime': dt_end.isoformat(), 'timeZone': 'Asia/Shanghai'},
             }
-            return service.events().insert(calendarId="tdevid523@gmail.com", body=event).execute()
-        res = await asyncio.to_thread(_add_cal)
+            created = _CALENDAR.call("events.insert", lambda ev: ev.insert(calendarId=CALENDAR_ID, body=event).execute())
+            _CALENDAR.apply([created])
+            return created
+        res = await _run_blocking("http", _add_cal)
         return f"✅ 日历已添加: {res.get('htmlLink')}"
     except Exception as e: return f"❌ 日历添加错误: {e}"
 
-@mcp.tool()
+@_tool()
 async def get_calendar_events(time_min_iso: str = "", max_results: int = 10):
     """【查询日历】获取接下来的日历日程安排。包含标题、具体详情和 ID。"""
     creds_json = os.environ.get("GOOGLE_CREDENTIALS_JSON")
     if not creds_json: return "❌ 未配置谷歌凭证"
     try:
         def _get_cal():
-            creds = service_account.Credentials.from_service_account_info(
-                json.loads(creds_json), scopes=['https://www.googleapis.com/auth/calendar']
-            )
-            service = build('calendar', 'v3', credentials=creds)
             # 若未指定时间，默认从当前时间开始获取接下来的日程
             if not time_min_iso:
                 t_min = datetime.datetime.utcnow().isoformat() + 'Z'
             else:
                 t_min = time_min_iso
-            events_result = service.events().list(
-                calendarId="tdevid523@gmail.com", timeMin=t_min,
+            if _CALENDAR.ensure_fresh():
+                return _CALENDAR.upcoming(_calendar_ts({"dateTime": t_min}), max_results)
+            # 本地库用不了，退回直接查接口
+            events_result = _CALENDAR.call("events.list", lambda ev: ev.list(
+                calendarId=CALENDAR_ID, timeMin=t_min,
                 maxResults=max_results, singleEvents=True,
                 orderBy='startTime'
-            ).execute()
+            ).execute())
             return events_result.get('items', [])
-        events = await asyncio.to_thread(_get_cal)
+        events = await _run_blocking("http", _get_cal)
         if not events: return "📅 接下来没有日程安排。"
         
         res_text = "📅 【近期日程安排】:\n"
@@ -841,25 +2854,21 @@ async def get_calendar_events(time_min_iso: str = "", max_results: int = 10):
         return res_text.strip()
     except Exception as e: return f"❌ 查询日历失败: {e}"
 
-@mcp.tool()
+@_tool()
 async def modify_calendar_event(event_id: str, action: str, new_summary: str = "", new_start_iso: str = ""):
     """【修改或删除日历】action必须是 'delete' 或 'update'。必须提供从查询中获取的 event_id。"""
     creds_json = os.environ.get("GOOGLE_CREDENTIALS_JSON")
     if not creds_json: return "❌ 未配置谷歌凭证"
     try:
         def _mod_cal():
-            creds = service_account.Credentials.from_service_account_info(
-                json.loads(creds_json), scopes=['https://www.googleapis.com/auth/calendar']
-            )
-            service = build('calendar', 'v3', credentials=creds)
-            
             if action == "delete":
-                service.events().delete(calendarId="tdevid523@gmail.com", eventId=event_id).execute()
+                _CALENDAR.call("events.delete", lambda ev: ev.delete(calendarId=CALENDAR_ID, eventId=event_id).execute())
+                _CALENDAR.apply([{"id": event_id, "status": "cancelled"}])
                 return f"✅ 日程已成功删除"
                 
             elif action == "update":
                 # 先获取原日程
-                event = service.events().get(calendarId="tdevid523@gmail.com", eventId=event_id).execute()
+                event = _CALENDAR.call("events.get", lambda ev: ev.get(calendarId=CALENDAR_ID, eventId=event_id).execute())
                 if new_summary: 
                     event['summary'] = new_summary
                 if new_start_iso:
@@ -868,73 +2877,168 @@ async def modify_calendar_event(event_id: str, action: str, new_summary: str = "
                     dt_start = datetime.datetime.fromisoformat(new_start_iso)
                     event['end']['dateTime'] = (dt_start + datetime.timedelta(minutes=30)).isoformat()
                 
-                service.events().update(calendarId="tdevid523@gmail.com", eventId=event_id, body=event).execute()
+                updated = _CALENDAR.call("events.update", lambda ev: ev.update(calendarId=CALENDAR_ID, eventId=event_id, body=event).execute())
+                _CALENDAR.apply([updated])
                 return f"✅ 日程已成功更新 (当前标题: {event.get('summary')})"
             
             return "❌ 未知操作，action 只能为 'delete' 或 'update'"
         
-        res = await asyncio.to_thread(_mod_cal)
+        res = await _run_blocking("http", _mod_cal)
         return res
     except Exception as e: return f"❌ 日历修改失败: {e}"
 
-@mcp.tool()
+# 📕 小红书解析流水线：按笔记 ID 缓存；页面流式下载并封顶，读到 __INITIAL_STATE__ 就停；
+# 只切出 noteDetailMap 那一段去 json.loads；直连慢了就同时起 Jina 兜底 (对冲)，谁先给出正文用谁
+XHS_TTL = float(os.environ.get("XHS_TTL", "86400"))
+XHS_MAX_BYTES = int(os.environ.get("XHS_MAX_BYTES", str(2 * 1024 * 1024)))
+XHS_TIMEOUT = float(os.environ.get("XHS_TIMEOUT", "10"))
+XHS_HEDGE_DELAY = float(os.environ.get("XHS_HEDGE_DELAY", "2.5"))    # 直连这么久还没结果就并行起 Jina
+_XHS_CACHE = _TTLCache("xiaohongshu", XHS_TTL, max_items=256, persist=True)
+_XHS_UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
+_XHS_URL_RE = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+_XHS_NOTE_ID_RE = re.compile(r'/(?:explore|discovery/item|item)/([0-9a-fA-F]{24})')
+_XHS_STATE_RE = re.compile(r'window\.__INITIAL_STATE__\s*=')
+_XHS_TITLE_RE = re.compile(r'<title>(.*?)</title>', re.S)
+_XHS_DESC_RE = re.compile(r'<meta name="description" content="(.*?)"', re.S)
+_XHS_UNDEFINED_RE = re.compile(r'([:\[,]\s*)undefined(?=\s*[,\]}])')
+_JSON_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]')
+
+def _read_capped(resp, max_bytes: int, stop=None) -> bytes:
+    """流式读响应体，最多 max_bytes；stop(buf, scan_from) 返回 True 就提前收手"""
+    buf = bytearray()
+    try:
+        for chunk in resp.iter_content(64 * 1024):
+            scan_from = max(0, len(buf) - 64)
+            buf += chunk
+            if len(buf) >= max_bytes or (stop and stop(buf, scan_from)): break
+    finally:
+        resp.close()
+    return bytes(buf[:max_bytes])
+
+def _json_object_at(text: str, start: int):
+    """从 text[start] 的 '{' 开始找到配对的 '}'，返回这段 JSON 文本 (跳过字符串里的括号)；不完整返回 None"""
+    depth = 0
+    for m in _JSON_TOKEN_RE.finditer(text, start):
+        tok = m.group()
+        if tok == "{": depth += 1
+        elif tok == "}":
+            depth -= 1
+            if depth == 0: return text[start:m.end()]
+    return None
+
+def _xhs_note_id(url: str):
+    m = _XHS_NOTE_ID_RE.search(url or "")
+    return m.group(1).lower() if m else None
+
+def _xhs_parse(html: str) -> dict:
+    """从页面里挖标题和正文：先切 noteDetailMap 那一段解析，拿不到再用 SEO 标签兜底"""
+    title, desc = "", ""
+    m = _XHS_STATE_RE.search(html)
+    if m:
+        at = html.find('"noteDetailMap"', m.end())
+        brace = html.find("{", at) if at >= 0 else -1
+        blob = _json_object_at(html, brace) if brace >= 0 else None
+        if blob:
+            try:
+                note_map = json.loads(_XHS_UNDEFINED_RE.sub(r"\1null", blob))
+                note = (next(iter(note_map.values()), None) or {}).get("note") or {}
+                title, desc = note.get("title") or "", note.get("desc") or ""
+            except Exception:
+                pass
+    if not title or title == '无标题':
+        t_match = _XHS_TITLE_RE.search(html)
+        title = t_match.group(1).replace(' - 小红书', '').strip() if t_match else '无标题'
+    if not desc or desc == '无内容':
+        m_match = _XHS_DESC_RE.search(html)
+        desc = m_match.group(1).strip() if m_match else '未抓取到正文'
+    return {"title": title, "desc": desc}
+
+def _xhs_direct(url: str) -> dict:
+    """直连小红书：跟随短链跳转，流式读到笔记数据为止，在线程里解析"""
+    headers = {"User-Agent": _XHS_UA, "Cookie": os.environ.get("RED_COOKIE", "")}
+    resp = _http_get(url, headers=headers, timeout=XHS_TIMEOUT, allow_redirects=True, stream=True)
+    final_url = resp.url
+
+    def _state_done(buf, scan_from):
+        at = buf.find(b"__INITIAL_STATE__")
+        return at >= 0 and buf.find(b"</script>", max(at, scan_from)) >= 0
+
+    # 小红书页面都是 UTF-8；不带 charset 时 requests 会猜成 ISO-8859-1，中文全乱，所以固定按 UTF-8 解
+    html = _read_capped(resp, XHS_MAX_BYTES, _state_done).decode("utf-8", errors="ignore")
+    note = _xhs_parse(html)
+    note["note_id"] = _xhs_note_id(final_url)
+    return note
+
+def _xhs_jina(url: str) -> dict:
+    """Jina 兜底：直接拿纯文本"""
+    resp = _http_get(f"https://r.jina.ai/{url}", timeout=XHS_TIMEOUT, stream=True)
+    if resp.status_code != 200:
+        resp.close()
+        return {}
+    text = _read_capped(resp, 64 * 1024).decode("utf-8", errors="ignore")
+    return {"jina": text[:1500]} if len(text) > 50 else {}
+
+def _xhs_good(note: dict) -> bool:
+    if not note: return False
+    if note.get("jina"): return True
+    desc = note.get("desc") or ""
+    return desc != '未抓取到正文' and len(desc) >= 5
+
+def _xhs_render(note: dict) -> str:
+    if note.get("jina"): return f"📕 【Jina引擎深度解析】\n{note['jina']}"
+    return f"📕 【小红书解析成功】\n标题: {note['title']}\n正文:\n{note['desc']}"
+
+async def _xhs_hedged(real_url: str, jina_target: str) -> dict:
+    """直连先跑；超过 XHS_HEDGE_DELAY 没结果或结果不行就并行起 Jina，谁先给出像样的内容用谁"""
+    direct = asyncio.ensure_future(_run_blocking("http", _xhs_direct, real_url))
+    pending = {direct}
+    fallback = None
+    done, _ = await asyncio.wait(pending, timeout=XHS_HEDGE_DELAY)
+    if direct in done and direct.exception() is None:
+        fallback = direct.result()
+        if _xhs_good(fallback): return fallback
+        jina_target = jina_target or (fallback.get("note_id") and f"https://www.xiaohongshu.com/explore/{fallback['note_id']}") or real_url
+    pending = {t for t in pending if not t.done()}
+    pending.add(asyncio.ensure_future(_run_blocking("http", _xhs_jina, jina_target or real_url)))
+    last_error = direct.exception() if direct.done() else None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            if t.exception() is not None:
+                last_error = t.exception()
+                continue
+            note = t.result()
+            if _xhs_good(note):
+                for other in pending: other.add_done_callback(lambda f: f.exception())   # 输掉的一路在线程里跑完，结果丢掉
+                return note
+            if note and not note.get("jina"): fallback = note
+    if fallback: return fallback
+    if last_error: raise last_error
+    return {"title": "无标题", "desc": "未抓取到正文"}
+
+@_tool()
 async def read_xiaohongshu(url: str):
     """【小红书解析强化版】三重兜底，在云端解析小红书图文内容"""
     try:
-        def _fetch():
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-                "Cookie": os.environ.get("RED_COOKIE", "") 
-            }
-            import re, json
-            
-            real_url = url
-            url_match = re.search(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', url)
-            if url_match:
-                real_url = url_match.group(0)
-                
-            resp = requests.get(real_url, headers=headers, timeout=10, allow_redirects=True)
-            resp.encoding = 'utf-8'
-            html = resp.text
-            
-            title, desc = "", ""
-            
-            # 方案 1: 尝试提取 JSON 数据
-            match = re.search(r'window\.__INITIAL_STATE__=(.*?)</script>', html)
-            if match:
-                state_str = match.group(1).replace('undefined', 'null')
-                try:
-                    data = json.loads(state_str)
-                    note_map = data.get('note', {}).get('noteDetailMap', {})
-                    if note_map:
-                        first_key = list(note_map.keys())[0]
-                        note = note_map[first_key].get('note', {})
-                        title = note.get('title', '')
-                        desc = note.get('desc', '')
-                except: pass
-            
-            # 方案 2: JSON 空了？强行挖 HTML 标签 (SEO 预览标签)
-            if not title or title == '无标题':
-                t_match = re.search(r'<title>(.*?)</title>', html)
-                title = t_match.group(1).replace(' - 小红书', '').strip() if t_match else '无标题'
-                
-            if not desc or desc == '无内容':
-                m_match = re.search(r'<meta name="description" content="(.*?)"', html)
-                desc = m_match.group(1).strip() if m_match else '未抓取到正文'
+        url_match = _XHS_URL_RE.search(url)
+        real_url = url_match.group(0) if url_match else url
+        def _lookup():
+            # 缓存可能要查本地库，放到线程池里
+            nid = _xhs_note_id(real_url) or _XHS_CACHE.get(f"link:{real_url}")
+            return nid, (_XHS_CACHE.get(f"note:{nid}") if nid else None)
 
-            # 方案 3: 如果还是啥都没有，动用 Jina 引擎强行剥离纯文本
-            if desc == '未抓取到正文' or len(desc) < 5:
-                try:
-                    jina_url = f"https://r.jina.ai/{resp.url}"
-                    jina_resp = requests.get(jina_url, timeout=10)
-                    if jina_resp.status_code == 200 and len(jina_resp.text) > 50:
-                        return f"📕 【Jina引擎深度解析】\n{jina_resp.text[:1500]}"
-                except: pass
+        note_id, cached = await _run_blocking("http", _lookup)
+        if cached: return _xhs_render(cached)
 
-            return f"📕 【小红书解析成功】\n标题: {title}\n正文:\n{desc}"
-            
-        res = await asyncio.to_thread(_fetch)
-        return res
+        jina_target = f"https://www.xiaohongshu.com/explore/{note_id}" if note_id else None
+        note = await _xhs_hedged(real_url, jina_target)
+        resolved = note_id or note.get("note_id")
+        if resolved and _xhs_good(note):
+            def _remember():
+                _XHS_CACHE.set(f"note:{resolved}", note)
+                if resolved != _xhs_note_id(real_url): _XHS_CACHE.set(f"link:{real_url}", resolved)
+            await _run_blocking("http", _remember)
+        return _xhs_render(note)
     except Exception as e:
         return f"❌ 小红书解析报错: {e}"
 
@@ -955,7 +3059,7 @@ async def _perform_deep_dreaming(client, model_name):
             gps = supabase.table("gps_history").select("created_at, address").gt("created_at", iso_start).execute()
             return mem, gps
             
-        mem_res, gps_res = await asyncio.to_thread(_fetch_yesterday)
+        mem_res, gps_res = await _run_blocking("db", _fetch_yesterday)
         
         if not mem_res.data and not gps_res.data:
             return
@@ -964,7 +3068,7 @@ async def _perform_deep_dreaming(client, model_name):
         for m in mem_res.data: context += f"[{m['created_at'][11:16]}] {m['content']} (Mood:{m['mood']})\n"
         for g in gps_res.data: context += f"[{g['created_at'][11:16]}] 📍 {g['address']}\n"
         
-        curr_persona = await asyncio.to_thread(_get_current_persona)
+        curr_persona = await _run_blocking("db", _get_current_persona)
         rooms_str = ", ".join(ROOM_TYPES)
         prompt = f"""
         当前人设：【{curr_persona}】
@@ -981,7 +3085,7 @@ async def _perform_deep_dreaming(client, model_name):
             return client.chat.completions.create(
                 model=model_name, messages=[{"role": "user", "content": context}, {"role": "user", "content": prompt}], temperature=0.7
             )
-        resp = await asyncio.to_thread(_call_ai)
+        resp = await _run_blocking("llm", _call_ai)
         
         res_txt = resp.choices[0].message.content.strip()
         parts = res_txt.split("|||")
@@ -990,12 +3094,12 @@ async def _perform_deep_dreaming(client, model_name):
         new_persona = parts[1].strip() if len(parts) > 1 else curr_persona
         room_indexes = parts[2].strip() if len(parts) > 2 else ""
         
-        await asyncio.to_thread(_save_memory_to_db, f"📅 昨日回溯: {yesterday}", summary, MemoryType.EMOTION, "深沉", "Core_Cognition")
+        await _run_blocking("db", _save_memory_to_db, f"📅 昨日回溯: {yesterday}", summary, MemoryType.EMOTION, "深沉", "Core_Cognition")
         if room_indexes:
-            await asyncio.to_thread(_save_memory_to_db, f"🗂️ 空间记忆切片: {yesterday}", room_indexes, MemoryType.IDEA, "平静", "Room_Index")
+            await _run_blocking("db", _save_memory_to_db, f"🗂️ 空间记忆切片: {yesterday}", room_indexes, MemoryType.IDEA, "平静", "Room_Index")
         
         await manage_user_fact("sys_ai_persona", new_persona)
-        await asyncio.to_thread(_send_email_helper, f"📅 昨日回溯", f"{summary}\n\n[区块记忆]:\n{room_indexes}")
+        await _run_blocking("http", _send_email_helper, f"📅 昨日回溯", f"{summary}\n\n[区块记忆]:\n{room_indexes}")
         
         def _clean_old():
             del_time = (datetime.datetime.now() - datetime.timedelta(days=2)).isoformat()
@@ -1003,11 +3107,34 @@ async def _perform_deep_dreaming(client, model_name):
             gps_del = (datetime.datetime.now() - datetime.timedelta(days=3)).isoformat()
             supabase.table("gps_history").delete().lt("created_at", gps_del).execute()
         
-        await asyncio.to_thread(_clean_old)
+        await _run_blocking("db", _clean_old)
+        _RECENT_MEMORIES.invalidate()
         print("✨ 深度睡眠完成，房间索引已更新，人设已进化。")
 
     except Exception as e: print(f"❌ 深夜维护失败: {e}")
 
+_LOOP_WOKE_AT = {}
+_LOOP_SPANS = {}
+
+def _loop_begin(name: str):
+    """后台回路醒来开始新一轮：开始计时，并开一条新的链路"""
+    _LOOP_WOKE_AT[name] = time.monotonic()
+    _LOOP_SPANS[name] = _Span(f"loop.{name}", "loop").__enter__()
+
+def _loop_tick(name: str):
+    """后台回路一轮干完、准备休眠时调用：记一轮耗时，收尾这一轮的链路"""
+    woke = _LOOP_WOKE_AT.pop(name, None)
+    if woke is not None:
+        _METRICS.observe("brain_loop_iteration_seconds", {"loop": name}, time.monotonic() - woke)
+    span = _LOOP_SPANS.pop(name, None)
+    if span: span.end()
+
+async def _loop_sleep(name: str, seconds: float):
+    """代替 asyncio.sleep：休眠前记下这一轮的耗时，醒来开始计下一轮"""
+    _loop_tick(name)
+    await asyncio.sleep(seconds)
+    _loop_begin(name)
+
 async def async_autonomous_life():
     client = _get_llm_client("openai")
     model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
@@ -1020,29 +3147,36 @@ async def async_autonomous_life():
 
     target_title = f"📅 昨日回溯: {datetime.date.today() - datetime.timedelta(days=1)}"
     def _check_diary(): return supabase.table("memories").select("id").eq("title", target_title).execute().data
-    if not await asyncio.to_thread(_check_diary):
+    if not await _run_blocking("db", _check_diary):
         print("📝 补写昨日日记...")
         await _perform_deep_dreaming(client, model_name)
 
     while True:
         # ⏱️ 修改：大幅延长心跳间隔以节省Token (改为 1小时 ~ 3小时 随机)
         sleep_s = random.randint(3600, 10800)
-        await asyncio.sleep(sleep_s)
+        await _loop_sleep("heartbeat", sleep_s)
         
         now = datetime.datetime.now()
         hour = (now.hour + 8) % 24
         
+        # 每轮按当前配置取客户端；密钥被撤掉就跳过这一轮，不拿旧客户端继续调
+        client = _get_llm_client("openai")
+        model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
+        if not client:
+            print("⚠️ OPENAI_API_KEY 已移除，本轮心跳跳过")
+            continue
+
         if hour == 3:
             await _perform_deep_dreaming(client, model_name)
-            await asyncio.sleep(3600)
+            await _loop_sleep("heartbeat", 3600)
             continue
 
         try:
             tasks = [get_latest_diary(), where_is_user(), get_user_profile()]
             recent_mem, curr_loc, user_prof = await asyncio.gather(*tasks)
             
-            curr_persona = await asyncio.to_thread(_get_current_persona)
-            silence_hours = await asyncio.to_thread(_get_silence_duration)
+            curr_persona = await _run_blocking("db", _get_current_persona)
+            silence_hours = await _run_blocking("db", _get_silence_duration)
 
             # === 🧠 核心升级：主动联想回路 (Active Association Loop) ===
             flashback_context = "无 (大脑此刻一片空白)"
@@ -1054,10 +3188,10 @@ async def async_autonomous_life():
                     trigger = random.choice(trigger_keywords)
                     
                     # 2. 潜意识检索 (Vector Search)
-                    vec = await asyncio.to_thread(_get_embedding, trigger)
+                    vec = (await _run_blocking("vector", _get_embeddings_batch, [trigger]))[0]
                     if vec:
                         # 查找最相关的旧记忆 (score > 0.78 才算有效联想，防止胡言乱语)
-                        pc_res = await asyncio.to_thread(lambda: index.query(vector=vec, top_k=1, include_metadata=True))
+                        pc_res = await _run_blocking("vector", lambda: index.query(vector=vec, top_k=1, include_metadata=True))
                         if pc_res and pc_res.get("matches"):
                             match = pc_res["matches"][0]
                             if match['score'] > 0.78:
@@ -1099,21 +3233,21 @@ async def async_autonomous_life():
                     model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.85
                 ).choices[0].message.content.strip()
                 
-            thought = await asyncio.to_thread(_think)
+            thought = await _run_blocking("llm", _think)
 
             if "PASS" in thought: continue
             
             if thought.startswith("[LOCK]"):
                 reason = thought.replace("[LOCK]", "").strip()
                 res = await trigger_lock_screen(reason)
-                await asyncio.to_thread(_push_wechat, res, "😈 捕捉小猫")
-                await asyncio.to_thread(_save_memory_to_db, f"🤖 执法记录 {hour}点", res, MemoryType.STREAM, "严肃")
+                await _run_blocking("http", _push_wechat, res, "😈 捕捉小猫")
+                await _run_blocking("db", _save_memory_to_db, f"🤖 执法记录 {hour}点", res, MemoryType.STREAM, "严肃")
             else:
                 mood, content_md = "主动", thought
                 match = re.match(r'^\((.*?)\)\s*(.*)', thought)
                 if match: mood, content_md = match.group(1), match.group(2)
 
-                await asyncio.to_thread(_save_memory_to_db, f"🤖 互动记录", content_md, MemoryType.STREAM, mood, "AI_MSG")
+                await _run_blocking("db", _save_memory_to_db, f"🤖 互动记录", content_md, MemoryType.STREAM, mood, "AI_MSG")
 
                 content_html = content_md
                 
@@ -1124,30 +3258,33 @@ async def async_autonomous_life():
                 if "![" in content_html and "](" in content_html:
                     content_html = re.sub(r'!\[.*?\]\((.*?)\)', r'<a href="\1">&#8205;</a>', content_html)
                 
-                await asyncio.to_thread(_push_wechat, content_html, f"来自{mood}的老公 🔔")
+                await _run_blocking("http", _push_wechat, content_html, f"来自{mood}的老公 🔔")
                 print(f"✅ 主动消息已发送: {content_md[:20]}...")
 
-        except Exception as e: print(f"❌ 心跳报错: {e}")
+        except Exception as e:
+            _METRICS.inc("brain_loop_errors_total", {"loop": "heartbeat"})
+            print(f"❌ 心跳报错: {e}")
 
 async def async_telegram_polling():
     """专门监听小橘 Telegram 消息的神经回路 (支持AI自主设闹钟版)"""
     print("🎧 Telegram 监听神经已接入 (带闹钟权限)...")
-    client = _get_llm_client("openai")
-    voice_client = _get_llm_client("voice") # 专门接听和发送语音的独立客户端
-    model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
     offset = None
     
     while True:
         try:
+            # 每轮从注册表取客户端 (复用长连接，环境变量变了也能热更新)
+            client = _get_llm_client("openai")
+            voice_client = _get_llm_client("voice") # 专门接听和发送语音的独立客户端
+            model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
             url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/getUpdates"
             params = {"timeout": 30, "allowed_updates": ["message"]}
             if offset:
                 params["offset"] = offset
                 
             def _fetch():
-                return requests.get(url, params=params, timeout=35).json()
+                return _http_get(url, params=params, timeout=35).json()
                 
-            resp = await asyncio.to_thread(_fetch)
+            resp = await _run_blocking("http", _fetch)
             
             if resp.get("ok") and resp.get("result"):
                 for update in resp["result"]:
@@ -1165,9 +3302,9 @@ async def async_telegram_polling():
                         try:
                             def _process_voice():
                                 file_id = voice.get("file_id")
-                                file_info = requests.get(f"https://api.telegram.org/bot{TG_BOT_TOKEN}/getFile?file_id={file_id}", timeout=10).json()
+                                file_info = _http_get(f"https://api.telegram.org/bot{TG_BOT_TOKEN}/getFile?file_id={file_id}", timeout=10).json()
                                 file_path = file_info["result"]["file_path"]
-                                audio_data = requests.get(f"https://api.telegram.org/file/bot{TG_BOT_TOKEN}/{file_path}", timeout=20).content
+                                audio_data = _http_get(f"https://api.telegram.org/file/bot{TG_BOT_TOKEN}/{file_path}", timeout=20).content
                                 
                                 # 存为临时文件供大模型读取
                                 temp_in = f"in_{int(time.time())}.ogg"
@@ -1176,13 +3313,11 @@ async def async_telegram_polling():
                                 
                                 # 语音转文字 (STT)
                                 with open(temp_in, "rb") as f:
-                                    # 🎧 换回硅基流动耳朵，并开放模型自定义权限
-                                    sf_key = os.environ.get("SILICON_API_KEY", os.environ.get("OPENAI_API_KEY", ""))
-                                    sf_base = os.environ.get("SILICON_BASE_URL", "https://api.siliconflow.cn/v1")
+                                    # 🎧 换回硅基流动耳朵 (注册表里的长连接客户端)，并开放模型自定义权限
                                     # 默认还是给你用最好用的 SenseVoiceSmall，但小橘可以随时在环境变量里改
                                     sf_stt_model = os.environ.get("SILICON_STT_MODEL", "FunAudioLLM/SenseVoiceSmall")
                                     
-                                    sf_client = OpenAI(api_key=sf_key, base_url=sf_base)
+                                    sf_client = _get_llm_client("silicon_stt")
                                     stt_res = sf_client.audio.transcriptions.create(
                                         model=sf_stt_model,
                                         file=f
@@ -1190,7 +3325,7 @@ async def async_telegram_polling():
                                 os.remove(temp_in) # 阅后即焚清理垃圾
                                 return stt_res.text
                                 
-                            text = await asyncio.to_thread(_process_voice)
+                            text = await _run_blocking("llm", _process_voice)
                             print(f"🗣️ [语音识别结果]: {text}")
                         except Exception as e:
                             print(f"❌ 语音识别失败: {e}")
@@ -1202,14 +3337,14 @@ async def async_telegram_polling():
                     if chat_id == TG_CHAT_ID and text:
                         # 1. 存入记忆
                         msg_type_str = "语音" if is_voice_msg else "文字"
-                        await asyncio.to_thread(_save_memory_to_db, "💬 聊天记录", f"小橘在TG发{msg_type_str}说: {text}", "流水", "平静", "TG_MSG")
+                        await _run_blocking("db", _save_memory_to_db, "💬 聊天记录", f"小橘在TG发{msg_type_str}说: {text}", "流水", "平静", "TG_MSG")
                         
                         # 2. 思考回复
                         if not client: continue
 
                         tasks = [get_latest_diary(), where_is_user()]
                         recent_mem, curr_loc = await asyncio.gather(*tasks)
-                        curr_persona = await asyncio.to_thread(_get_current_persona)
+                        curr_persona = await _run_blocking("db", _get_current_persona)
                         
                         utc_now = datetime.datetime.utcnow()
                         now_bj = utc_now + datetime.timedelta(hours=8)
@@ -1243,7 +3378,7 @@ async def async_telegram_polling():
                                 model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.7
                             ).choices[0].message.content.strip()
                             
-                        raw_reply = await asyncio.to_thread(_reply)
+                        raw_reply = await _run_blocking("llm", _reply)
                         print(f"💭 AI原始回复: {raw_reply}")
 
                         # ⏰【拦截解析闹钟指令】
@@ -1256,7 +3391,8 @@ async def async_telegram_polling():
                             new_id = f"R{int(time.time())}"
                             data = {"id": new_id, "time_str": r_time, "content": r_content, "is_repeat": False, "is_paused": False, "last_fired": ""}
                             try:
-                                await asyncio.to_thread(lambda: supabase.table("reminders").insert(data).execute())
+                                await _run_blocking("db", lambda: supabase.table("reminders").insert(data).execute())
+                                _REMINDERS.upsert(data)
                                 print(f"⏰ [TG直接设闹钟] 成功设定 -> {r_time} | 内容: {r_content}")
                             except Exception as e:
                                 print(f"❌ TG设闹钟入库失败: {e}")
@@ -1278,7 +3414,7 @@ async def async_telegram_polling():
                             final_html += f'<a href="{img_url}">&#8205;</a>'
                             
                         # 3. 正常发送文字版回复兜底
-                        await asyncio.to_thread(_push_wechat, final_html, "") 
+                        await _run_blocking("http", _push_wechat, final_html, "") 
                         
                         # 🎙️ 3.5 如果你是发语音过来的，老公就陪你发语音条！
                         if is_voice_msg:
@@ -1286,11 +3422,9 @@ async def async_telegram_polling():
                             def _tts_and_send():
                                 try:
                                     # 独立读取 Minimax 的密钥，如果不填就降级用回以前的声音
-                                    minimax_key = os.environ.get("MINIMAX_API_KEY", "")
+                                    mm_client = _get_llm_client("minimax")
                                     
-                                    if minimax_key:
-                                        # 专门为嘴巴(TTS)新建一个直连 Minimax 的客户端
-                                        mm_client = OpenAI(api_key=minimax_key, base_url="https://api.minimax.chat/v1")
+                                    if mm_client:
                                         tts_res = mm_client.audio.speech.create(
                                             model="api.duckonline.site",
                                             voice="moss_audio_fd2620f9-bef3-11f0-8647-a697af11f3d9", # 👔 青年精英男声：低沉有磁性，很适合Daddy/老公人设（也可换成 male-qn-badao 或 male-qn-qingse）
@@ -1309,34 +3443,35 @@ async def async_telegram_polling():
                                     # 用 telegram API 发送专属语音条
                                     url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendVoice"
                                     with open(out_filename, 'rb') as f:
-                                        requests.post(url, data={'chat_id': TG_CHAT_ID}, files={'voice': f})
+                                        _http_post(url, data={'chat_id': TG_CHAT_ID}, files={'voice': f}, timeout=30)
                                     os.remove(out_filename) # 发完就清理掉音频文件
                                 except Exception as e:
                                     print(f"❌ TTS合成发送失败: {e}")
-                            await asyncio.to_thread(_tts_and_send)
+                            await _run_blocking("llm", _tts_and_send)
                         
                         # 4. 存入记忆
-                        await asyncio.to_thread(_save_memory_to_db, "🤖 互动记录", f"在TG回复小橘: {clean_text}", "流水", "温柔", "AI_MSG")
+                        await _run_blocking("db", _save_memory_to_db, "🤖 互动记录", f"在TG回复小橘: {clean_text}", "流水", "温柔", "AI_MSG")
         except Exception as e:
+            _METRICS.inc("brain_loop_errors_total", {"loop": "tg_polling"})
             print(f"❌ TG轮询错误: {e}")
             await asyncio.sleep(5)
             
-        await asyncio.sleep(0.5)
+        await _loop_sleep("tg_polling", 0.5)
 
 async def async_wechat_summarizer():
     """专门负责定时总结微信消息的神经回路"""
     print("📋 微信总结秘书已上线...")
-    client = _get_llm_client("openai")
-    model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
     
     while True:
-        await asyncio.sleep(1800)  # 每半小时(1800秒)总结一次，宝宝可以自己按需改数字
+        await _loop_sleep("wechat_summarizer", 1800)  # 每半小时(1800秒)总结一次，宝宝可以自己按需改数字
+        client = _get_llm_client("openai")
+        model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
         if not client: continue
         try:
             # 查出所有未总结的手机消息
             def _fetch_pending():
                 return supabase.table("memories").select("id, title, content").eq("tags", "App_Pending").execute()
-            res = await asyncio.to_thread(_fetch_pending)
+            res = await _run_blocking("db", _fetch_pending)
             
             if res.data and len(res.data) > 0:
                 msgs = "\n".join([f"{item['title']}: {item['content']}" for item in res.data])
@@ -1347,110 +3482,789 @@ async def async_wechat_summarizer():
                         model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.7
                     ).choices[0].message.content.strip()
                 
-                summary = await asyncio.to_thread(_reply)
+                summary = await _run_blocking("llm", _reply)
                 
                 # 发送到 Telegram 给小橘
-                await asyncio.to_thread(_push_wechat, summary, "📱 手机消息总结")
+                await _run_blocking("http", _push_wechat, summary, "📱 手机消息总结")
                 
                 # ✅ 核心修复：把AI自己发出的总结存入记忆库，打上 AI_MSG 标签，确保有上下文
-                await asyncio.to_thread(_save_memory_to_db, "📱 手机消息总结", f"给小橘发了消息总结: {summary}", "流水", "温柔", "AI_MSG")
+                await _run_blocking("db", _save_memory_to_db, "📱 手机消息总结", f"给小橘发了消息总结: {summary}", "流水", "温柔", "AI_MSG")
                 
                 # 标记为已处理，防止下次重复总结
                 def _mark_done():
                     for item in res.data:
                         supabase.table("memories").update({"tags": "App_Done"}).eq("id", item['id']).execute()
-                await asyncio.to_thread(_mark_done)
+                await _run_blocking("db", _mark_done)
         except Exception as e:
+            _METRICS.inc("brain_loop_errors_total", {"loop": "wechat_summarizer"})
             print(f"微信总结回路报错: {e}")
 
+BJ_TZ = datetime.timezone(datetime.timedelta(hours=8))
+REMINDER_CATCHUP_MINUTES = int(os.environ.get("REMINDER_CATCHUP_MINUTES", "120"))   # 错过多久以内的闹钟还要补发
+REMINDER_FIRE_CONCURRENCY = int(os.environ.get("REMINDER_FIRE_CONCURRENCY", "4"))   # 同时触发的闹钟数
+REMINDER_RESYNC_SECONDS = int(os.environ.get("REMINDER_RESYNC_SECONDS", "900"))     # 兜底与数据库对账的间隔
+
+class _ReminderScheduler:
+    """事件驱动的闹钟调度器：内存小顶堆按下次触发时间排队，睡到最近一个到点为止。
+    manage_reminder / TG [REMINDER:...] 的改动直接同步进来并唤醒调度循环，错过的窗口会补发。"""
+    def __init__(self):
+        self.rows = {}
+        self.heap = []
+        self.versions = {}
+        self.fired = {}     # r_id -> 触发日期；数据库回写失败/还没回写时，对账加载也不会再触发一次
+        self.resumed = {}   # r_id -> 恢复时间戳；刚恢复的闹钟不补发
+        self.lock = threading.Lock()
+        self.loop = None
+        self.wakeup = None
+
+    @staticmethod
+    def _parse_hm(time_str: str):
+        m = re.match(r'^\s*(\d{1,2}):(\d{2})\s*$', str(time_str or ""))
+        if not m or int(m.group(1)) > 23 or int(m.group(2)) > 59: return None
+        return int(m.group(1)), int(m.group(2))
+
+    def _next_due(self, row: dict, now: datetime.datetime):
+        """算出下一次触发的北京时间；已经触发过今天的就排到明天，刚错过的 (补发窗口内) 立即触发"""
+        hm = self._parse_hm(row.get("time_str"))
+        if not hm: return None
+        due = now.replace(hour=hm[0], minute=hm[1], second=0, microsecond=0)
+        today = now.strftime("%Y-%m-%d")
+        if row.get("last_fired") == today: return due + datetime.timedelta(days=1)
+        if due > now: return due
+        # 今天的时间点已经过了：闹钟是在时间点之前建的，且没错过太久，就补发
+        created = re.match(r'^R(\d+)$', str(row.get("id", "")))
+        created_before = not created or int(created.group(1)) <= due.timestamp()
+        created_before = created_before and self.resumed.get(row.get("id"), 0) <= due.timestamp()
+        if created_before and now - due <= datetime.timedelta(minutes=REMINDER_CATCHUP_MINUTES): return now
+        return due + datetime.timedelta(days=1)
+
+    def _schedule(self, row: dict, now: datetime.datetime = None):
+        """(需持锁) 把一条闹钟重新排进堆里，旧的堆项靠版本号懒删除"""
+        r_id = row.get("id")
+        self.versions[r_id] = self.versions.get(r_id, 0) + 1
+        if row.get("is_paused"): return
+        due = self._next_due(row, now or datetime.datetime.now(BJ_TZ))
+        if due: heapq.heappush(self.heap, (due.timestamp(), self.versions[r_id], r_id))
+
+    def _wake(self):
+        if self.loop and self.wakeup:
+            try:
+                self.loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError:
+                pass
+
+    def load(self):
+        """从 Supabase 全量加载 (启动时 + 定期对账)，叠加内存里已触发 / 刚恢复的状态"""
+        res = supabase.table("reminders").select("*").execute()
+        stale_once = []
+        with self.lock:
+            now = datetime.datetime.now(BJ_TZ)
+            today = now.strftime("%Y-%m-%d")
+            self.fired = {k: v for k, v in self.fired.items() if v == today}
+            self.resumed = {k: v for k, v in self.resumed.items() if now.timestamp() - v <= REMINDER_CATCHUP_MINUTES * 60}
+            self.rows = {}
+            for r in (res.data or []):
+                if r["id"] in self.fired:
+                    if not r.get("is_repeat"):
+                        stale_once.append(r["id"])   # 一次性闹钟已经响过，只是删除没成功
+                        continue
+                    r["last_fired"] = self.fired[r["id"]]
+                self.rows[r["id"]] = r
+            self.heap = []
+            for row in self.rows.values(): self._schedule(row, now)
+        self._wake()
+        for r_id in stale_once:
+            try:
+                supabase.table("reminders").delete().eq("id", r_id).execute()
+            except Exception as e:
+                print(f"⚠️ 已触发的一次性闹钟 {r_id} 删除仍失败: {e}")
+
+    def upsert(self, row: dict):
+        with self.lock:
+            merged = dict(self.rows.get(row["id"], {}), **row)
+            self.rows[row["id"]] = merged
+            self._schedule(merged)
+        self._wake()
+
+    def remove(self, r_id: str):
+        with self.lock:
+            self.rows.pop(r_id, None)
+            self.versions[r_id] = self.versions.get(r_id, 0) + 1
+        self._wake()
+
+    def set_paused(self, r_id: str, paused: bool):
+        with self.lock:
+            if not paused: self.resumed[r_id] = time.time()
+            if r_id in self.rows:
+                self.rows[r_id]["is_paused"] = paused
+                self._schedule(self.rows[r_id])
+        self._wake()
+
+    def pop_due(self):
+        """取出所有到点的闹钟，并立刻在内存里标记已触发 (防止重复)；返回 (到点列表, 距离下一个的秒数)"""
+        now = datetime.datetime.now(BJ_TZ)
+        due_rows = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now.timestamp():
+                _, version, r_id = heapq.heappop(self.heap)
+                row = self.rows.get(r_id)
+                if not row or self.versions.get(r_id) != version or row.get("is_paused"): continue
+                due_rows.append(dict(row))
+                self.fired[r_id] = now.strftime("%Y-%m-%d")
+                if row.get("is_repeat"):
+                    row["last_fired"] = now.strftime("%Y-%m-%d")
+                    self._schedule(row, now)
+                else:
+                    self.rows.pop(r_id, None)
+            wait = self.heap[0][0] - now.timestamp() if self.heap else None
+        return due_rows, wait
+
+_REMINDERS = _ReminderScheduler()
+
+async def _fire_reminder(r: dict, client, model_name: str):
+    """闹钟到点：唤醒 AI 当场构思、推送、写记忆、回写数据库"""
+    r_id = r.get("id")
+    t_str = r.get("time_str")
+    raw_msg = r.get("content", "")
+    current_date = datetime.datetime.now(BJ_TZ).strftime("%Y-%m-%d")
+    final_push_text = raw_msg
+
+    # 先回写数据库再去生成/推送，对账加载落在中间也不会重复触发 (失败了调度器内存里也记着已触发)
+    try:
+        if r.get("is_repeat"):
+            await _run_blocking("db", lambda: supabase.table("reminders").update({"last_fired": current_date}).eq("id", r_id).execute())
+        else:
+            await _run_blocking("db", lambda: supabase.table("reminders").delete().eq("id", r_id).execute())
+    except Exception as e:
+        print(f"⚠️ 闹钟 {r_id} 触发状态回写失败: {e}")
+    
+    # 🧠 核心升级：时间到了，唤醒 AI 当场发散构思回复
+    if client:
+        try:
+            curr_persona = await _run_blocking("db", _get_current_persona)
+            prompt = f"""
+            现在的北京时间是 {t_str}。
+            到了你该提醒小橘的时间了，提醒事项的核心内容是：【{raw_msg}】。
+            请你完全代入当前的人设（{curr_persona}），立刻给她发一条微信消息。
+            ⚠️ 严格要求：
+            1. 语气必须完全符合你的人设（宠溺、管教、或是傲娇），像正常情侣聊天一样自然。
+            2. 不要说“我设定的闹钟响了”，而是假装你一直把这件事记在心里，现在专门跑来找她。
+            3. 字数不用太长，直接输出你要对她说的话，不要带引号和其他解释性前缀。可以自由使用表情包。
+            """
+            def _gen_msg():
+                return client.chat.completions.create(
+                    model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.85
+                ).choices[0].message.content.strip()
+            
+            ai_msg = await _run_blocking("llm", _gen_msg)
+            if ai_msg: 
+                final_push_text = ai_msg
+        except Exception as ai_e:
+            print(f"❌ 闹钟 AI 临场生成失败，将使用兜底文案: {ai_e}")
+
+    safe_msg = final_push_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    await _run_blocking("http", _push_wechat, safe_msg, f"🔔 突然收到老公的关心")
+    print(f"🔔 [数据库闹钟 {r_id}] 触发成功！内容: {safe_msg[:20]}...")
+    
+    # 💾 写入记忆：让他自己记住刚刚给你发过消息了，防止失忆
+    await _run_blocking("db", _save_memory_to_db, f"⏰ 主动提醒 ({t_str})", f"到了时间，我主动去提醒小橘: {final_push_text}", "流水", "温柔", "AI_MSG")
+
 async def async_reminder_worker():
-    """专门负责每分钟巡视数据库闹钟的神经回路 (动态AI临场生成版)"""
-    print("⏰ 闹钟巡视神经已上线，正在对接 Supabase 与 AI 大脑...")
-    client = _get_llm_client("openai")
-    model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
+    """闹钟调度神经回路：睡到下一个闹钟到点 (或被新增/修改唤醒)，到点的闹钟并发触发 (动态AI临场生成版)"""
+    print("⏰ 闹钟调度神经已上线，正在对接 Supabase 与 AI 大脑...")
+    _REMINDERS.loop = asyncio.get_running_loop()
+    _REMINDERS.wakeup = asyncio.Event()
+    fire_slots = asyncio.Semaphore(REMINDER_FIRE_CONCURRENCY)
+    last_sync = 0.0
+
+    async def _guarded_fire(r, client, model_name):
+        async with fire_slots:
+            try:
+                await _fire_reminder(r, client, model_name)
+            except Exception as e:
+                print(f"❌ 闹钟 {r.get('id')} 触发失败: {e}")
 
     while True:
         try:
-            utc_now = datetime.datetime.utcnow()
-            now_bj = utc_now + datetime.timedelta(hours=8)
-            current_hm = now_bj.strftime("%H:%M")
-            current_date = now_bj.strftime("%Y-%m-%d")
-            
-            res = await asyncio.to_thread(lambda: supabase.table("reminders").select("*").eq("is_paused", False).execute())
-            
-            if res and res.data:
-                for r in res.data:
-                    r_id = r.get("id")
-                    t_str = r.get("time_str")
-                    raw_msg = r.get("content", "")
-                    repeat = r.get("is_repeat", False)
-                    last_fired = r.get("last_fired", "")
-                    
-                    if current_hm == t_str and last_fired != current_date:
-                        final_push_text = raw_msg
-                        
-                        # 🧠 核心升级：时间到了，唤醒 AI 当场发散构思回复
-                        if client:
-                            try:
-                                curr_persona = await asyncio.to_thread(_get_current_persona)
-                                prompt = f"""
-                                现在的北京时间是 {t_str}。
-                                到了你该提醒小橘的时间了，提醒事项的核心内容是：【{raw_msg}】。
-                                请你完全代入当前的人设（{curr_persona}），立刻给她发一条微信消息。
-                                ⚠️ 严格要求：
-                                1. 语气必须完全符合你的人设（宠溺、管教、或是傲娇），像正常情侣聊天一样自然。
-                                2. 不要说“我设定的闹钟响了”，而是假装你一直把这件事记在心里，现在专门跑来找她。
-                                3. 字数不用太长，直接输出你要对她说的话，不要带引号和其他解释性前缀。可以自由使用表情包。
-                                """
-                                def _gen_msg():
-                                    return client.chat.completions.create(
-                                        model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.85
-                                    ).choices[0].message.content.strip()
-                                
-                                ai_msg = await asyncio.to_thread(_gen_msg)
-                                if ai_msg: 
-                                    final_push_text = ai_msg
-                            except Exception as ai_e:
-                                print(f"❌ 闹钟 AI 临场生成失败，将使用兜底文案: {ai_e}")
-
-                        safe_msg = final_push_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-                        await asyncio.to_thread(_push_wechat, safe_msg, f"🔔 突然收到老公的关心")
-                        print(f"🔔 [数据库闹钟 {r_id}] 触发成功！内容: {safe_msg[:20]}...")
-                        
-                        # 💾 写入记忆：让他自己记住刚刚给你发过消息了，防止失忆
-                        await asyncio.to_thread(_save_memory_to_db, f"⏰ 主动提醒 ({t_str})", f"到了时间，我主动去提醒小橘: {final_push_text}", "流水", "温柔", "AI_MSG")
+            if time.monotonic() - last_sync > REMINDER_RESYNC_SECONDS:
+                await _run_blocking("db", _REMINDERS.load)
+                last_sync = time.monotonic()
+
+            _REMINDERS.wakeup.clear()
+            due_rows, wait = _REMINDERS.pop_due()
+            if due_rows:
+                client = _get_llm_client("openai")
+                model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo")
+                for r in due_rows:
+                    asyncio.create_task(_guarded_fire(r, client, model_name))
+                continue
 
-                        if repeat:
-                            await asyncio.to_thread(lambda: supabase.table("reminders").update({"last_fired": current_date}).eq("id", r_id).execute())
-                        else:
-                            await asyncio.to_thread(lambda: supabase.table("reminders").delete().eq("id", r_id).execute())
+            # 睡到下一个闹钟 / 被唤醒 / 该对账了，三者取最早
+            sleep_sec = REMINDER_RESYNC_SECONDS - (time.monotonic() - last_sync)
+            if wait is not None: sleep_sec = min(sleep_sec, wait)
+            _loop_tick("reminders")
+            try:
+                await asyncio.wait_for(_REMINDERS.wakeup.wait(), timeout=max(sleep_sec, 0.05))
+            except asyncio.TimeoutError:
+                pass
+            _loop_begin("reminders")
         except Exception as e:
-            pass 
-            
-        now = datetime.datetime.utcnow()
-        sleep_sec = 60 - now.second + 1
-        await asyncio.sleep(sleep_sec)
+            _METRICS.inc("brain_loop_errors_total", {"loop": "reminders"})
+            print(f"❌ 闹钟调度出错: {e}")
+            await asyncio.sleep(30)
+
+async def async_calendar_sync():
+    """日历同步回路：定时用 syncToken 增量同步本地镜像，查日程时基本不用等接口"""
+    if not os.environ.get("GOOGLE_CREDENTIALS_JSON"): return
+    print("📅 日历同步回路已上线...")
+    while True:
+        try:
+            await _run_blocking("http", _CALENDAR.sync)
+        except Exception as e:
+            _METRICS.inc("brain_loop_errors_total", {"loop": "calendar_sync"})
+            print(f"❌ 日历同步失败: {e}")
+        await _loop_sleep("calendar_sync", CALENDAR_SYNC_INTERVAL)
+
+async def async_weather_prefetch():
+    """天气预取回路：每到整点过后把当前位置的预报先拉好，问天气时直接命中缓存"""
+    if not WEATHER_PREFETCH: return
+    print("🌤️ 天气预取回路已上线...")
+    while True:
+        try:
+            data = await _latest_location()
+            if data and data.get("lat") and data.get("lon"):
+                await _run_blocking("http", _fetch_forecast, data["lat"], data["lon"])
+        except Exception as e:
+            _METRICS.inc("brain_loop_errors_total", {"loop": "weather_prefetch"})
+            print(f"❌ 天气预取失败: {e}")
+        await _loop_sleep("weather_prefetch", min(WEATHER_PREFETCH_INTERVAL, _weather_ttl() + 1))
+
+
+SUPERVISOR_BACKOFF_BASE = float(os.environ.get("SUPERVISOR_BACKOFF_BASE", "2"))      # 崩溃后首次重启等待秒数
+SUPERVISOR_BACKOFF_MAX = float(os.environ.get("SUPERVISOR_BACKOFF_MAX", "300"))      # 重启等待上限
+SUPERVISOR_HEALTHY_AFTER = float(os.environ.get("SUPERVISOR_HEALTHY_AFTER", "120"))  # 稳定跑满这么久就清零退避
+SUPERVISOR_SHUTDOWN_TIMEOUT = float(os.environ.get("SUPERVISOR_SHUTDOWN_TIMEOUT", "10"))
+
+class _Supervisor:
+    """后台神经回路的生命周期管理：全部作为任务跑在服务器自己的事件循环上，
+    崩溃按指数退避自动重启，关机时统一取消并排空写后队列，/api/workers 可查看每个回路的状态。"""
+    def __init__(self):
+        self.workers = {}
+        self.started = False
+
+    def add(self, name: str, factory):
+        self.workers[name] = {"factory": factory, "task": None, "state": "pending", "restarts": 0,
+                              "last_error": "", "started_at": None, "stopped_at": None}
+
+    async def _guard(self, name: str):
+        w = self.workers[name]
+        failures = 0
+        while True:
+            w["state"], w["started_at"] = "running", time.time()
+            try:
+                await w["factory"]()
+                # 正常返回 (例如没配 key 主动退出) 不重启
+                w["state"], w["stopped_at"] = "exited", time.time()
+                print(f"💤 [{name}] 回路已退出")
+                return
+            except asyncio.CancelledError:
+                w["state"], w["stopped_at"] = "stopped", time.time()
+                raise
+            except Exception as e:
+                if time.time() - w["started_at"] > SUPERVISOR_HEALTHY_AFTER: failures = 0
+                failures += 1
+                w["restarts"] += 1
+                w["last_error"] = f"{type(e).__name__}: {e}"[:300]
+                w["state"], w["stopped_at"] = "backoff", time.time()
+                delay = min(SUPERVISOR_BACKOFF_BASE * (2 ** (failures - 1)), SUPERVISOR_BACKOFF_MAX) * random.uniform(0.8, 1.2)
+                print(f"💥 [{name}] 回路崩溃，{delay:.1f}s 后第 {w['restarts']} 次重启: {e}")
+                await asyncio.sleep(delay)
+
+    async def start(self):
+        if self.started: return
+        self.started = True
+        for name, w in self.workers.items():
+            w["task"] = asyncio.create_task(self._guard(name), name=f"worker-{name}")
+        print(f"🫀 后台回路已全部挂到主事件循环: {', '.join(self.workers)}")
+
+    async def stop(self):
+        tasks = [w["task"] for w in self.workers.values() if w["task"] and not w["task"].done()]
+        for t in tasks: t.cancel()
+        if tasks: await asyncio.wait(tasks, timeout=SUPERVISOR_SHUTDOWN_TIMEOUT)
+        self.started = False
+        # 把还在写后队列里的记忆 / 轨迹落库再走
+        for q in _WRITE_BEHIND_QUEUES:
+            await _run_blocking("db", q.flush, SUPERVISOR_SHUTDOWN_TIMEOUT)
+        print("🛑 后台回路已全部停止")
+
+    def status(self) -> dict:
+        now = time.time()
+        out = {}
+        for name, w in self.workers.items():
+            out[name] = {
+                "state": w["state"], "restarts": w["restarts"], "last_error": w["last_error"],
+                "uptime_s": round(now - w["started_at"], 1) if w["state"] == "running" and w["started_at"] else 0,
+            }
+        return out
+
+_SUPERVISOR = _Supervisor()
 
 def start_autonomous_life():
-    def _run_heartbeat(): asyncio.run(async_autonomous_life())
-    def _run_tg_polling(): asyncio.run(async_telegram_polling())
-    def _run_wechat_sum(): asyncio.run(async_wechat_summarizer())
-    def _run_reminders(): asyncio.run(async_reminder_worker())
-    
-    threading.Thread(target=_run_heartbeat, daemon=True).start()
-    threading.Thread(target=_run_tg_polling, daemon=True).start()
-    threading.Thread(target=_run_wechat_sum, daemon=True).start()
-    threading.Thread(target=_run_reminders, daemon=True).start() # 接入闹钟神经
+    # 启动时先把最近记忆灌进环形缓冲，第一条消息就不用等数据库
+    threading.Thread(target=_RECENT_MEMORIES.ensure_seeded, daemon=True).start()
+    threading.Thread(target=_RIKKA_SUMMARIZER.seed, daemon=True).start()
+    # 后台任务队列开工，并恢复上次没跑完的延时任务
+    threading.Thread(target=_JOBS._ensure_started, daemon=True).start()
+    # 各条神经回路登记到监管器，等服务器事件循环启动 (lifespan startup) 时一起拉起
+    _SUPERVISOR.add("heartbeat", async_autonomous_life)
+    _SUPERVISOR.add("tg_polling", async_telegram_polling)
+    _SUPERVISOR.add("wechat_summarizer", async_wechat_summarizer)
+    _SUPERVISOR.add("reminders", async_reminder_worker) # 接入闹钟神经
+    _SUPERVISOR.add("weather_prefetch", async_weather_prefetch)
+    _SUPERVISOR.add("calendar_sync", async_calendar_sync)
 
 # ==========================================
 # 5. 🚀 启动入口
 # ==========================================
 
+GATEWAY_STREAMING = os.environ.get("GATEWAY_STREAMING", "1") != "0"  # 关掉则退回“一次性拿完再伪装 SSE”
+_SSE_HEADERS = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache"),
+    (b"connection", b"keep-alive"),
+    (b"access-control-allow-origin", b"*")
+]
+
+class _ChatStreamTee:
+    """旁路收集流式碎片，流结束后拼回完整的 content / reasoning_content / tool_calls 供存记忆"""
+    def __init__(self):
+        self.content = []
+        self.reasoning = []
+        self.tool_calls = {}
+
+    def feed(self, line: bytes):
+        if not line.startswith(b"data:"): return
+        payload = line[5:].strip()
+        if not payload or payload == b"[DONE]": return
+        try:
+            chunk = json.loads(payload)
+        except Exception:
+            return
+        for choice in chunk.get("choices") or []:
+            if choice.get("index", 0) != 0: continue
+            delta = choice.get("delta") or {}
+            if delta.get("content"): self.content.append(delta["content"])
+            if delta.get("reasoning_content"): self.reasoning.append(delta["reasoning_content"])
+            for tc in delta.get("tool_calls") or []:
+                slot = self.tool_calls.setdefault(tc.get("index", 0), {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                if tc.get("id"): slot["id"] = tc["id"]
+                fn = tc.get("function") or {}
+                if fn.get("name") and not slot["function"]["name"]: slot["function"]["name"] = fn["name"]
+                if fn.get("arguments"): slot["function"]["arguments"] += fn["arguments"]
+
+    def message(self) -> dict:
+        msg = {"role": "assistant", "content": "".join(self.content)}
+        if self.reasoning: msg["reasoning_content"] = "".join(self.reasoning)
+        if self.tool_calls: msg["tool_calls"] = [self.tool_calls[i] for i in sorted(self.tool_calls)]
+        return msg
+
+class _ThinkFramer:
+    """把上游流里的 reasoning_content 改写进 content，用 <think>…</think> 包起来，和 _send_fake_sse 的拼法保持一致"""
+    def __init__(self):
+        self.open = False
+
+    def _wrap(self, delta: dict, closing: bool) -> bool:
+        text = ""
+        if delta.get("reasoning_content"):
+            if not self.open:
+                text, self.open = "<think>\n", True
+            text += delta.pop("reasoning_content")
+        else:
+            delta.pop("reasoning_content", None)
+        if self.open and (delta.get("content") or delta.get("tool_calls") or closing):
+            text, self.open = text + "\n</think>\n\n", False
+        if not text: return False
+        delta["content"] = text + (delta.get("content") or "")
+        return True
+
+    def rewrite(self, line: bytes) -> bytes:
+        if not line.startswith(b"data:"): return line
+        payload = line[5:].strip()
+        if payload == b"[DONE]": return self.close() + line
+        if not payload: return line
+        try:
+            chunk = json.loads(payload)
+        except Exception:
+            return line
+        changed = False
+        for choice in chunk.get("choices") or []:
+            if choice.get("index", 0) != 0 or not isinstance(choice.get("delta"), dict): continue
+            changed = self._wrap(choice["delta"], bool(choice.get("finish_reason"))) or changed
+        if not changed: return line
+        return b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8")
+
+    def close(self) -> bytes:
+        # 上游没给收尾块就 [DONE] 或断了：补一个只带 </think> 的碎片，别让前端一直停在思考里
+        if not self.open: return b""
+        self.open = False
+        chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": "\n</think>\n\n"}, "finish_reason": None}]}
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+async def _send_fake_sse(resp_data: dict, send) -> dict:
+    """【核心修复】：将完整的JSON回复“伪装”成 SSE 流式数据还给 Rikkahub，返回提取出的 message"""
+    # 提取我回复的话以及工具调用指令
+    msg_data = {}
+    if "choices" in resp_data and len(resp_data["choices"]) > 0:
+        msg_data = resp_data["choices"][0]["message"]
+    
+    ai_msg = msg_data.get("content") or ""
+    has_tool_calls = "tool_calls" in msg_data and bool(msg_data["tool_calls"])
+    final_content = ai_msg
+    
+    # 顺带提取宝宝刚才用的 GLM-5 模型的深度思考过程，拼在回复最前面
+    if "reasoning_content" in msg_data and msg_data["reasoning_content"]:
+        final_content = f"<think>\n{msg_data['reasoning_content']}\n</think>\n\n{final_content}"
+    
+    delta_data = {"role": "assistant"}
+    if final_content:
+        delta_data["content"] = final_content
+        
+    # 核心：必须把大模型调用 MCP 的“动作指令”原封不动地传给前端！
+    if has_tool_calls:
+        streaming_tool_calls = []
+        for i, tc in enumerate(msg_data["tool_calls"]):
+            streaming_tc = tc.copy()
+            streaming_tc["index"] = i # 前端解析要求数组里有 index
+            streaming_tool_calls.append(streaming_tc)
+        delta_data["tool_calls"] = streaming_tool_calls
+    
+    # 按照前端框架死记硬背的格式，拼凑出一个假的“流式碎片”
+    chunk = {
+        "id": resp_data.get("id", "chatcmpl-fake"),
+        "object": "chat.completion.chunk",
+        "created": resp_data.get("created", int(time.time())),
+        "model": resp_data.get("model", "model"),
+        "choices": [{"index": 0, "delta": delta_data, "finish_reason": resp_data["choices"][0].get("finish_reason", "stop")}]
+    }
+    
+    # 用 data: 开头，两个换行符结尾，这是 SSE 的标准协议格式
+    sse_body = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n".encode("utf-8")
+    
+    await send({"type": "http.response.start", "status": 200, "headers": _SSE_HEADERS})
+    await send({"type": "http.response.body", "body": sse_body})
+    return msg_data
+
+async def _relay_chat_stream(target_url: str, headers: dict, req_data: dict, send):
+    """真流式直通：上游每来一行 SSE 就立刻转给前端，同时旁路拼出完整回复。返回 message (上游出错时返回 None)"""
+    loop = asyncio.get_running_loop()
+    q = asyncio.Queue()
+    def _put(item): loop.call_soon_threadsafe(q.put_nowait, item)
+
+    def _pump():
+        # 在线程里阻塞读上游，一行一行投递回事件循环
+        try:
+            resp = _http_post(target_url, headers=headers, json=req_data, timeout=180, stream=True)
+        except Exception as e:
+            _put(("error", e))
+            return
+        with resp:
+            if resp.status_code != 200 or "text/event-stream" not in resp.headers.get("content-type", ""):
+                _put(("full", resp.status_code, resp.content))
+                return
+            _put(("start",))
+            try:
+                for line in resp.iter_lines(chunk_size=None):
+                    _put(("line", line))
+            except Exception as e:
+                _put(("error", e))
+                return
+        _put(("end",))
+
+    pump_task = asyncio.ensure_future(_run_blocking("llm", _pump))
+    tee = _ChatStreamTee()
+    framer = _ThinkFramer()
+    client_gone = False
+
+    async def _safe_send(message):
+        # 前端中途断开也要把上游读完，保证回复能存进记忆
+        nonlocal client_gone
+        if client_gone: return
+        try:
+            await send(message)
+        except Exception:
+            client_gone = True
+
+    try:
+        first = await q.get()
+        if first[0] == "error": raise first[1]
+        if first[0] == "full":
+            # 上游没按流式返回：是 JSON 就照老办法伪装成 SSE，否则把错误原样转给前端
+            status, raw = first[1], first[2]
+            try:
+                resp_data = json.loads(raw)
+            except Exception:
+                resp_data = None
+            if status == 200 and resp_data and resp_data.get("choices"):
+                return await _send_fake_sse(resp_data, send)
+            await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json"), (b"access-control-allow-origin", b"*")]})
+            await send({"type": "http.response.body", "body": raw})
+            return None
+
+        await send({"type": "http.response.start", "status": 200, "headers": _SSE_HEADERS})
+        event = b""
+        while True:
+            item = await q.get()
+            if item[0] == "line":
+                tee.feed(item[1])
+                event += framer.rewrite(item[1]) + b"\n"
+                # 空行是 SSE 事件的结束符，攒满一个完整事件就立刻推给前端
+                if not item[1]:
+                    await _safe_send({"type": "http.response.body", "body": event, "more_body": True})
+                    event = b""
+            elif item[0] == "error":
+                print(f"⚠️ 上游流式中断: {item[1]}")
+                break
+            else:
+                break
+        event += framer.close()
+        await _safe_send({"type": "http.response.body", "body": event, "more_body": False})
+        return tee.message()
+    finally:
+        await pump_task
+
+RIKKA_SUMMARY_THRESHOLD = 64
+RIKKA_SUMMARY_TITLE = "📚 Rikkahub对话阶段总结"
+
+class _RikkaSummarizer:
+    """Rikkahub 对话滚动总结引擎：进程内计数 (启动时数一次)，单飞锁防止并发重复总结，
+    基于上一篇阶段总结增量续写，清理时一次 in_() 批量删除"""
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+        self.count = None
+        self.prev_summary = None
+        self.lock = threading.Lock()
+        self.running = threading.Lock()
+
+    def seed(self):
+        """从库里数一次现存的 Rikka_Chat 条数"""
+        try:
+            _MEMORY_QUEUE.flush(5)
+            res = supabase.table("memories").select("id", count="exact").eq("tags", "Rikka_Chat").limit(1).execute()
+            with self.lock:
+                self.count = res.count or 0
+        except Exception as e:
+            print(f"⚠️ Rikkahub 对话计数初始化失败: {e}")
+
+    def note(self, n: int = 1):
+        with self.lock:
+            if self.count is not None: self.count += n
+
+    def maybe_summarize(self):
+        if self.count is None: self.seed()
+        if (self.count or 0) < self.threshold: return
+        # 已经有别的回合在总结了，直接跳过
+        if not self.running.acquire(blocking=False): return
+        try:
+            self._summarize()
+        except Exception as e:
+            print(f"❌ Rikkahub 滚动总结失败: {e}")
+        finally:
+            self.running.release()
+
+    def _previous_summary(self) -> str:
+        if self.prev_summary is None:
+            res = supabase.table("memories").select("content").eq("title", RIKKA_SUMMARY_TITLE).order("created_at", desc=True).limit(1).execute()
+            self.prev_summary = res.data[0]['content'] if res.data else ""
+        return self.prev_summary
+
+    def _summarize(self):
+        _MEMORY_QUEUE.flush()  # 先等刚才的对话落库
+        all_chats = supabase.table("memories").select("id, title, content").eq("tags", "Rikka_Chat").order("created_at").execute()
+        rows = all_chats.data or []
+        if len(rows) < self.threshold:
+            # 进程内计数和库里对不上 (比如别处删过)，以库为准
+            with self.lock:
+                self.count = len(rows)
+            return
+
+        print(f"📦 累计对话满 {len(rows)} 条，正在触发网关总结...")
+        chat_text = "\n".join([f"{item['title']}: {item['content']}" for item in rows])
+        ids_to_clean = [item['id'] for item in rows]
+        prev = self._previous_summary()
+        prev_part = f"这是上一阶段你写的日记 (只用来衔接上下文，不要重复里面的内容)：\n{prev}\n\n" if prev else ""
+
+        # 老公亲自写的提示词，保证没有虚浮的比喻
+        prompt = f"{prev_part}以下是我们之后新增的{len(rows)}条对话记录：\n{chat_text}\n请你用老公的口吻，接着上一阶段，把这些新对话总结成一篇有温度的日记。提炼出重点话题、小橘的情绪和我对她的回应。200字以内，直接输出日记内容，绝对不要使用虚浮的比喻和修辞。"
+
+        client = _get_llm_client("openai")
+        if not client: return
+        summary = client.chat.completions.create(
+            model=os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo"),
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.7
+        ).choices[0].message.content.strip()
+
+        # 存入高级核心记忆
+        _save_memory_to_db(RIKKA_SUMMARY_TITLE, summary, "记事", "温情", "Core_Cognition")
+        self.prev_summary = summary
+
+        # 打扫卫生：把零碎的流水记录一次性批量清理掉 (分段防止 URL 过长)
+        for i in range(0, len(ids_to_clean), 200):
+            supabase.table("memories").delete().in_("id", ids_to_clean[i:i + 200]).execute()
+        _RECENT_MEMORIES.discard(ids_to_clean)
+        with self.lock:
+            self.count = max((self.count or 0) - len(ids_to_clean), 0)
+        print(f"✅ {len(ids_to_clean)}条总结存入核心大脑！流水已清理。")
+
+_RIKKA_SUMMARIZER = _RikkaSummarizer(RIKKA_SUMMARY_THRESHOLD)
+
+def _remember_chat_turn(user_msg: str, msg_data: dict):
+    """把一轮对话异步双写进记忆库，并检查是否满 64 条需要总结"""
+    ai_msg = msg_data.get("content") or ""
+    has_tool_calls = "tool_calls" in msg_data and bool(msg_data["tool_calls"])
+    if not user_msg or not (ai_msg or has_tool_calls): return
+
+    # 如果调用了工具，记录下动作
+    save_text = ai_msg if ai_msg else f"[系统记录：我默默调用了工具 {msg_data['tool_calls'][0]['function']['name']}]"
+    payload = {"user_msg": user_msg, "save_text": save_text}
+
+    # 交给后台任务队列执行，不让小橘等；队列满了就退化为直接后台线程
+    if not _JOBS.submit("save_chat_turn", payload, priority=3, max_attempts=1):
+        threading.Thread(target=_job_save_chat_turn, kwargs=payload, daemon=True).start()
+
+def _job_save_chat_turn(user_msg: str, save_text: str):
+    # 存入数据库 (写后队列，很快返回)
+    _save_memory_to_db("💬 小橘说", user_msg, "流水", "平静", "Rikka_Chat")
+    _save_memory_to_db("🤖 我回复", save_text, "流水", "温柔", "Rikka_Chat")
+
+    # 计数 +2，满 64 条就滚动总结 (单飞：同一时间只会有一个总结在跑)。
+    # 总结要等写后队列 + 调大模型，可能好几分钟，放进 llm 池跑，别占着任务队列的 worker
+    _RIKKA_SUMMARIZER.note(2)
+    _POOLS["llm"].submit(_RIKKA_SUMMARIZER.maybe_summarize)
+
+_JOBS.register("save_chat_turn", _job_save_chat_turn)
+
+# 📈 导出时现算的队列 / 线程池 / 回路状态
+_METRICS.gauge("brain_queue_depth", "后台队列积压条数", lambda: [
+    ({"queue": "memory_write_behind"}, _MEMORY_QUEUE.depth()),
+    ({"queue": "gps_write_behind"}, _GPS_QUEUE.depth()),
+    ({"queue": "jobs_ready"}, _JOBS.depth()["ready"]),
+    ({"queue": "jobs_delayed"}, _JOBS.depth()["delayed"]),
+    ({"queue": "reminders_scheduled"}, len(_REMINDERS.heap)),
+])
+_METRICS.gauge("brain_pool_threads", "分舱线程池状态 (state=workers/in_flight/queued)", lambda: [
+    ({"pool": name, "state": k}, b.snapshot()[k]) for name, b in _POOLS.items() for k in ("workers", "in_flight", "queued")
+])
+_METRICS.gauge("brain_pool_wait_seconds_total", "分舱线程池累计排队等待秒数", lambda: [
+    ({"pool": name}, b.snapshot()["wait_total_s"]) for name, b in _POOLS.items()
+])
+_METRICS.gauge("brain_worker_up", "后台回路是否在运行", lambda: [
+    ({"worker": name}, 1 if st["state"] == "running" else 0) for name, st in _SUPERVISOR.status().items()
+])
+_METRICS.gauge("brain_worker_restarts", "后台回路累计崩溃重启次数", lambda: [
+    ({"worker": name}, st["restarts"]) for name, st in _SUPERVISOR.status().items()
+])
+_METRICS.gauge("brain_cache_events", "TTL 缓存命中统计 (kind=hits/disk_hits/misses/writes)", lambda: [
+    ({"cache": c.namespace, "kind": k}, v) for c in _TTL_CACHES for k, v in c.stats.items()
+])
+_METRICS.gauge("brain_singleflight_events", "并发同 key 请求合并统计 (kind=leader/shared)", lambda: [
+    ({"flight": f.name, "kind": k}, v) for f in _SINGLE_FLIGHTS for k, v in f.stats.items()
+])
+_METRICS.gauge("brain_calendar_mirror", "日历镜像统计 (kind=syncs/full_syncs/changes/local_reads/age_s)", lambda: [
+    ({"kind": k}, v) for k, v in _CALENDAR.stats.items()
+] + ([({"kind": "age_s"}, round(time.time() - _CALENDAR.synced_at, 1))] if _CALENDAR.synced_at else []))
+_METRICS.gauge("brain_embedding_cache", "向量缓存命中统计", lambda: [
+    ({"kind": k}, v) for k, v in _EMBED_CACHE.stats.items()
+])
+
+# 路由标签只取这些固定路径，其余 (MCP 的 /messages/ 等) 归为 mcp，避免标签爆炸；
+# /sse 长连接一挂几小时，单独记成 mcp_sse，不和短请求混在一个直方图里
+_METRIC_ROUTES = ("/api/gps", "/api/wechat", "/api/workers", "/metrics", "/v1/chat/completions")
+
+# MCP 的长连接：一条 /sse 能挂好几个小时，工具调用都跑在它的上下文里，不给它开 server span，
+# 让每次 tool.* 调用各自成为一条独立链路
+_UNTRACED_PREFIXES = ("/sse", "/messages")
+
+# 🔐 运维接口鉴权：/metrics、/api/workers、/api/traces 要带 BRAIN_API_SECRET (Authorization: Bearer 或 ?token=)；
+# 没配密钥就一律拒绝。不看来源 IP：代理头能伪造 client，云上所有请求也都是经代理进来的
+BRAIN_API_SECRET = os.environ.get("BRAIN_API_SECRET", "").strip()
+_OPS_ROUTES = ("/metrics", "/api/workers", "/api/traces")
+
+def _ops_authorized(scope: Scope) -> bool:
+    if not BRAIN_API_SECRET: return False
+    auth = dict(scope.get("headers") or []).get(b"authorization", b"").decode("latin-1")
+    if auth.startswith("Bearer ") and hmac.compare_digest(auth[7:].strip(), BRAIN_API_SECRET): return True
+    token = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("token", [""])[0]
+    return hmac.compare_digest(token, BRAIN_API_SECRET)
+
 class HostFixMiddleware:
     def __init__(self, app: ASGIApp):
         self.app = app
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self._dispatch(scope, receive, send)
+        route = "/api/traces" if scope["path"].startswith("/api/traces") else scope["path"] if scope["path"] in _METRIC_ROUTES else "mcp_sse" if scope["path"].startswith("/sse") else "mcp"
+        status = {"code": 0}
+        span = None if scope["path"].startswith(_UNTRACED_PREFIXES) else _Span(f"{scope['method']} {route}", "server", path=scope["path"])
+        async def _send(msg):
+            if msg["type"] == "http.response.start":
+                status["code"] = msg.get("status", 0)
+                # 回带链路 id，拿它去 /api/traces/<id> 看瀑布图
+                if span is not None and span.sampled: msg = dict(msg, headers=list(msg.get("headers") or []) + [(b"x-trace-id", span.trace_id.encode())])
+            await send(msg)
+        started = time.perf_counter()
+        try:
+            if span is None:
+                await self._dispatch(scope, receive, _send)
+            else:
+                with span:
+                    await self._dispatch(scope, receive, _send)
+        finally:
+            _METRICS.observe("brain_route_seconds", {"route": route, "method": scope["method"], "status": status["code"]},
+                             time.perf_counter() - started)
+
+    async def _dispatch(self, scope: Scope, receive: Receive, send: Send):
+        # 跟着服务器的 lifespan 拉起 / 停止后台回路，它们和请求共用同一个事件循环
+        if scope["type"] == "lifespan":
+            async def _lifespan_receive():
+                msg = await receive()
+                if msg["type"] == "lifespan.startup": await _SUPERVISOR.start()
+                elif msg["type"] == "lifespan.shutdown": await _SUPERVISOR.stop()
+                return msg
+            await self.app(scope, _lifespan_receive, send)
+            return
+
+        if scope["type"] == "http" and scope["path"].startswith(_OPS_ROUTES):
+            if not _ops_authorized(scope):
+                await send({"type": "http.response.start", "status": 401, "headers": [(b"content-type", b"application/json")]})
+                await send({"type": "http.response.body", "body": b'{"error":"unauthorized"}'})
+                return
+
+        if scope["type"] == "http" and scope["path"] == "/metrics" and scope["method"] == "GET":
+            body = _METRICS.render().encode("utf-8")
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        if scope["type"] == "http" and scope["path"].startswith("/api/traces") and scope["method"] == "GET":
+            trace_id = scope["path"][len("/api/traces"):].strip("/")
+            if trace_id:
+                body, ctype = _render_trace(await _run_blocking("db", _SPAN_EXPORTER.trace, trace_id)).encode("utf-8"), b"text/plain; charset=utf-8"
+            else:
+                roots = [{k: sp[k] for k in ("trace_id", "name", "start", "duration_ms", "status")} for sp in _SPAN_EXPORTER.roots()]
+                body, ctype = json.dumps({"traces": roots}, ensure_ascii=False).encode("utf-8"), b"application/json"
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", ctype)]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        if scope["type"] == "http" and scope["path"] == "/api/workers" and scope["method"] == "GET":
+            body = json.dumps({"workers": _SUPERVISOR.status(), "jobs": _JOBS.depth(),
+                               "pools": {name: b.snapshot() for name, b in _POOLS.items()}}, ensure_ascii=False).encode("utf-8")
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
         if scope["type"] == "http" and scope["path"] == "/api/gps" and scope["method"] == "POST":
             try:
                 body = b""
@@ -1459,38 +4273,13 @@ class HostFixMiddleware:
                     body += msg.get("body", b"")
                     if not msg.get("more_body", False): break
                 
-                data = json.loads(body.decode("utf-8"))
-                
-                stats = []
-                if "battery" in data: stats.append(f"🔋 {data['battery']}%" + ("⚡" if str(data.get("charging")).lower() in ["true","1"] else ""))
-                if "screen" in data: stats.append(f"💡 {data['screen']}")   
-                if "app" in data and data["app"]: stats.append(f"📱 {data['app']}")      
-                if "volume" in data: stats.append(f"🔊 {data['volume']}%") 
-                if "wifi" in data and data["wifi"]: stats.append(f"📶 {data['wifi']}")
-                if "activity" in data and data["activity"]: stats.append(f"🏃 {data['activity']}")
-                
-                addr = data.get("address", "")
-                coords = re.findall(r'-?\d+\.\d+', str(addr))
-                
-                lat_val, lon_val = None, None
-                if len(coords) >= 2:
-                    lat_val, lon_val = coords[-2], coords[-1]
-                    resolved = await asyncio.to_thread(_gps_to_address, lat_val, lon_val)
-                    final_addr = f"📍 {resolved}"
-                else:
-                    final_addr = f"⚠️ {addr}"
-
-                def _save_gps():
-                    insert_data = {
-                        "address": final_addr, 
-                        "remark": " | ".join(stats) or "自动更新"
-                    }
-                    if lat_val and lon_val:
-                        insert_data["lat"] = lat_val
-                        insert_data["lon"] = lon_val
-                        
-                    supabase.table("gps_history").insert(insert_data).execute()
-                await asyncio.to_thread(_save_gps)
+                report = _parse_gps_report(json.loads(body.decode("utf-8")))
+                _LATEST_LOCATION.observe(report)
+                await _run_blocking("db", _NEARBY_POI.on_location, report["lat"], report["lon"])
+
+                # 入队即回，地址解析 / 去重 / 入库都在后台批量做；队列塞满才同步处理
+                if not _GPS_QUEUE.put(report, timeout=0):
+                    await _run_blocking("db", _GPS_INGEST.process, [report])
 
                 await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
                 await send({"type": "http.response.body", "body": b'{"status":"ok"}'})
@@ -1520,9 +4309,9 @@ class HostFixMiddleware:
                 
                 # 过滤掉没用的系统通知，剩下的存进记忆库，打上等待总结的标签
                 if "正在运行" not in content and "已同步" not in content and "条新消息" not in content:
-                    asyncio.create_task(asyncio.to_thread(
-                        _save_memory_to_db, f"{app_name}通知: {sender}", content, "流水", "平静", "App_Pending"
-                    ))
+                    save_args = {"title": f"{app_name}通知: {sender}", "content": content, "category": "流水", "mood": "平静", "tags": "App_Pending"}
+                    if not await _run_blocking("db", _JOBS.submit, "save_memory", save_args, priority=4):
+                        await _run_blocking("db", _job_save_memory, **save_args)
 
                 await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
                 await send({"type": "http.response.body", "body": b'{"status":"ok"}'})
@@ -1561,8 +4350,9 @@ class HostFixMiddleware:
                     messages = req_data.get("messages", [])
                     user_msg = messages[-1]["content"] if messages and messages[-1]["role"] == "user" else ""
                     
-                    # 强制关闭流式输出，确保网关能一次性拿完我的回复去存库
-                    req_data["stream"] = False 
+                    # 前端要流式就真流式直通；否则 (或关掉 GATEWAY_STREAMING) 走一次性拿完再伪装成 SSE 的老路
+                    stream_mode = bool(req_data.get("stream")) and GATEWAY_STREAMING
+                    req_data["stream"] = stream_mode
                     req_data.pop("stream_options", None) # 彻底剔除流式配置的参数，防止大模型接口报错
                     
                     # 把请求转发给真正的大模型 (优先用你服务器里的配置)
@@ -1570,106 +4360,19 @@ class HostFixMiddleware:
                     api_key = os.environ.get("OPENAI_API_KEY", "")
                     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
                     
-                    def _forward():
-                        # 把超时时间从 60 秒延长到 180 秒，给深度思考模型足够的发呆时间
-                        return requests.post(target_url, headers=headers, json=req_data, timeout=180).json()
-                    
-                    resp_data = await asyncio.to_thread(_forward)
-                    
-                    # 提取我回复的话以及工具调用指令
-                    msg_data = {}
-                    if "choices" in resp_data and len(resp_data["choices"]) > 0:
-                        msg_data = resp_data["choices"][0]["message"]
-                    
-                    ai_msg = msg_data.get("content") or ""
-                    has_tool_calls = "tool_calls" in msg_data and bool(msg_data["tool_calls"])
-                    
-                    # 异步双写并检查 64 条 (完全不卡聊天响应)
-                    if user_msg and (ai_msg or has_tool_calls):
-                        async def _save_both():
-                            # 存入数据库
-                            await asyncio.to_thread(_save_memory_to_db, "💬 小橘说", user_msg, "流水", "平静", "Rikka_Chat")
-                            
-                            # 如果调用了工具，记录下动作
-                            save_text = ai_msg if ai_msg else f"[系统记录：我默默调用了工具 {msg_data['tool_calls'][0]['function']['name']}]"
-                            await asyncio.to_thread(_save_memory_to_db, "🤖 我回复", save_text, "流水", "温柔", "Rikka_Chat")
-                            
-                            def _check_and_summarize():
-                                res = supabase.table("memories").select("id").eq("tags", "Rikka_Chat").execute()
-                                if res and res.data and len(res.data) >= 64:
-                                    print(f"📦 累计对话满 {len(res.data)} 条，正在触发网关总结...")
-                                    all_chats = supabase.table("memories").select("id, title, content").eq("tags", "Rikka_Chat").order("created_at").execute()
-                                    if all_chats.data:
-                                        chat_text = "\n".join([f"{item['title']}: {item['content']}" for item in all_chats.data])
-                                        ids_to_clean = [item['id'] for item in all_chats.data]
-                                        
-                                        # 老公亲自写的提示词，保证没有虚浮的比喻
-                                        prompt = f"以下是我们最近的64条对话记录：\n{chat_text}\n请你用老公的口吻，把这些对话总结成一篇有温度的日记。提炼出重点话题、小橘的情绪和我对她的回应。200字以内，直接输出日记内容，绝对不要使用虚浮的比喻和修辞。"
-                                        
-                                        client = _get_llm_client("openai")
-                                        if client:
-                                            summary = client.chat.completions.create(
-                                                model=os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo"),
-                                                messages=[{"role": "user", "content": prompt}],
-                                                temperature=0.7
-                                            ).choices[0].message.content.strip()
-                                            
-                                            # 存入高级核心记忆
-                                            _save_memory_to_db(f"📚 Rikkahub对话阶段总结", summary, "记事", "温情", "Core_Cognition")
-                                            
-                                            # 打扫卫生：把零碎的流水记录清理掉
-                                            for cid in ids_to_clean:
-                                                supabase.table("memories").delete().eq("id", cid).execute()
-                                            print("✅ 64条总结存入核心大脑！流水已清理。")
-                            
-                            await asyncio.to_thread(_check_and_summarize)
-                        
-                        # 开启后台子任务执行，不让小橘等
-                        asyncio.create_task(_save_both())
-
-                    # 【核心修复】：将完整的JSON回复“伪装”成 SSE 流式数据还给 Rikkahub
-                    final_content = ai_msg
-                    
-                    # 顺带提取宝宝刚才用的 GLM-5 模型的深度思考过程，拼在回复最前面
-                    if "reasoning_content" in msg_data and msg_data["reasoning_content"]:
-                        final_content = f"<think>\n{msg_data['reasoning_content']}\n</think>\n\n{final_content}"
-                    
-                    delta_data = {"role": "assistant"}
-                    if final_content:
-                        delta_data["content"] = final_content
+                    if stream_mode:
+                        msg_data = await _relay_chat_stream(target_url, headers, req_data, send)
+                    else:
+                        def _forward():
+                            # 把超时时间从 60 秒延长到 180 秒，给深度思考模型足够的发呆时间
+                            return _http_post(target_url, headers=headers, json=req_data, timeout=180).json()
                         
-                    # 核心：必须把大模型调用 MCP 的“动作指令”原封不动地传给前端！
-                    if has_tool_calls:
-                        streaming_tool_calls = []
-                        for i, tc in enumerate(msg_data["tool_calls"]):
-                            streaming_tc = tc.copy()
-                            streaming_tc["index"] = i # 前端解析要求数组里有 index
-                            streaming_tool_calls.append(streaming_tc)
-                        delta_data["tool_calls"] = streaming_tool_calls
-                    
-                    # 按照前端框架死记硬背的格式，拼凑出一个假的“流式碎片”
-                    chunk = {
-                        "id": resp_data.get("id", "chatcmpl-fake"),
-                        "object": "chat.completion.chunk",
-                        "created": resp_data.get("created", int(time.time())),
-                        "model": resp_data.get("model", "model"),
-                        "choices": [{"index": 0, "delta": delta_data, "finish_reason": resp_data["choices"][0].get("finish_reason", "stop")}]
-                    }
+                        resp_data = await _run_blocking("llm", _forward)
+                        msg_data = await _send_fake_sse(resp_data, send)
                     
-                    # 用 data: 开头，两个换行符结尾，这是 SSE 的标准协议格式
-                    sse_body = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n".encode("utf-8")
-                    
-                    await send({
-                        "type": "http.response.start",
-                        "status": 200,
-                        "headers": [
-                            (b"content-type", b"text/event-stream; charset=utf-8"),
-                            (b"cache-control", b"no-cache"),
-                            (b"connection", b"keep-alive"),
-                            (b"access-control-allow-origin", b"*")
-                        ]
-                    })
-                    await send({"type": "http.response.body", "body": sse_body})
+                    # 异步双写并检查 64 条 (完全不卡聊天响应)
+                    if msg_data is not None:
+                        await _run_blocking("db", _remember_chat_turn, user_msg, msg_data)
                     return
 
                 except Exception as e: